@@ -1,10 +1,31 @@
 # app.py
 
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory
+import io
+import queue
+import datetime
+import hashlib
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory, jsonify, \
+    stream_template, stream_with_context, Response, g, has_request_context
 from functools import wraps
+from contextlib import nullcontext
 from database import Database, hash_senha
-from werkzeug.utils import secure_filename
+import estoque
+from paginacao import paginar, estimar_total, consulta_pagina
+import busca
+import catalogo
+import exportacao
+import arquivamento
+import sincronizacao
+import vendas
+import posicoes
+import migracoes
+import metricas
+import notificacoes
+from cache import criar_cache
+from imagens import ProcessadorImagens, variantes as variantes_imagem, imutavel
+from werkzeug.utils import secure_filename, send_from_directory as enviar_de_diretorio
 
 # --- CONFIGURAÇÃO DA APLICAÇÃO ---
 UPLOAD_FOLDER = 'uploads'
@@ -13,6 +34,18 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 app = Flask(__name__)
 app.secret_key = 'sua_chave_secreta_super_segura_aqui'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['POR_PAGINA'] = int(os.getenv('POR_PAGINA', '50'))
+app.config['MAX_LINHAS_LOTE'] = int(os.getenv('MAX_LINHAS_LOTE', '5000'))
+app.config['MAX_CODIGOS_CONSULTA'] = int(os.getenv('MAX_CODIGOS_CONSULTA', '1000'))
+# Entrega dos arquivos pelo proxy da frente: '' (o Flask lê e envia), 'x-sendfile'
+# (Apache/lighttpd) ou 'x-accel-redirect' (nginx, com uma location internal em ARQUIVOS_PROXY_PREFIXO)
+app.config['ARQUIVOS_PROXY'] = os.getenv('ARQUIVOS_PROXY', '')
+app.config['ARQUIVOS_PROXY_PREFIXO'] = os.getenv('ARQUIVOS_PROXY_PREFIXO', '/_uploads/')
+app.config['USE_X_SENDFILE'] = app.config['ARQUIVOS_PROXY'] == 'x-sendfile'
+# Arquivo morto: movimentações e auditoria mais velhas que a retenção saem das tabelas para esta pasta
+app.config['ARQUIVAMENTO_PASTA'] = os.getenv('ARQUIVAMENTO_PASTA', 'arquivo_morto')
+app.config['ARQUIVAMENTO_RETENCAO_DIAS'] = int(os.getenv('ARQUIVAMENTO_RETENCAO_DIAS', '365'))
+UM_ANO = 365 * 24 * 3600
 
 
 # Função para verificar se a extensão do arquivo é permitida
@@ -21,12 +54,60 @@ def allowed_file(filename):
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-@app.after_request
 def add_ngrok_header(response):
     response.headers.add('ngrok-skip-browser-warning', 'true')
     return response
 
 
+# Só para demonstrações por túnel do ngrok; fora disso é um cabeçalho a mais em toda resposta
+if os.getenv('NGROK', '0') == '1':
+    app.after_request(add_ngrok_header)
+
+
+# --- ARQUIVOS ESTÁTICOS COM VERSÃO NA URL ---
+_versoes_estaticos = {}
+
+
+def versao_estatico(filename):
+    """Hash curto do conteúdo do arquivo, recalculado só quando o mtime muda."""
+    caminho = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(caminho).st_mtime_ns
+    except OSError:
+        return None
+    em_cache = _versoes_estaticos.get(filename)
+    if em_cache and em_cache[0] == mtime:
+        return em_cache[1]
+    with open(caminho, 'rb') as arquivo:
+        versao = hashlib.sha256(arquivo.read()).hexdigest()[:12]
+    _versoes_estaticos[filename] = (mtime, versao)
+    return versao
+
+
+@app.url_defaults
+def versionar_estaticos(endpoint, values):
+    # url_for('static', filename='style.css') -> /static/style.css?v=<hash>
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        versao = versao_estatico(values['filename'])
+        if versao:
+            values['v'] = versao
+
+
+@app.after_request
+def cache_estaticos(response):
+    # Com a versão atual na URL o conteúdo nunca muda; sem ela, o navegador revalida
+    if request.endpoint == 'static' and response.status_code in (200, 304):
+        filename = (request.view_args or {}).get('filename')
+        if filename and request.args.get('v') == versao_estatico(filename):
+            response.cache_control.no_cache = None
+            response.cache_control.max_age = UM_ANO
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+    return response
+
+
 # --- CONEXÃO COM O BANCO DE DADOS ---
 try:
     db = Database()
@@ -35,10 +116,160 @@ except Exception as e:
     exit()
 
 
-# --- ROTA PARA SERVIR IMAGENS ---
+@app.before_request
+def reservar_conexao():
+    if db.modo_pool == 'requisicao':
+        db.reservar_conexao()
+
+
+@app.teardown_request
+def liberar_conexao(exc):
+    db.liberar_conexao()
+    db.preferir_primario(False)
+
+
+# --- LEITURAS NA RÉPLICA (DATABASE_REPLICA_URL, ver replica.py) ---
+# Depois de uma escrita a sessão guarda o LSN do primário e lê de lá até a
+# réplica alcançá-lo, para ninguém ser redirecionado a uma página sem a
+# alteração que acabou de fazer.
+@app.before_request
+def ler_apos_escrever():
+    lsn = session.get('lsn_escrita')
+    if lsn:
+        if db.replica_alcancou(lsn):
+            session.pop('lsn_escrita')
+        else:
+            db.preferir_primario()
+
+
+@app.after_request
+def lembrar_escrita(response):
+    if db.replica is not None and request.method not in ('GET', 'HEAD', 'OPTIONS') and 'usuario_id' in session:
+        try:
+            session['lsn_escrita'] = db.lsn_primario()
+        except Exception as e:
+            print(f"Erro ao obter o LSN do primário: {e}")
+            db.preferir_primario()
+    return response
+
+
+def transmitir(gerador):
+    """
+    Prepara um gerador de resposta em streaming. O Flask roda o teardown
+    (que desfaz preferir_primario) antes do primeiro bloco, então a escolha
+    entre primário e réplica desta requisição é levada junto para o gerador.
+    """
+    no_primario = db.preferindo_primario()
+
+    def gerar():
+        db.preferir_primario(no_primario)
+        try:
+            yield from gerador
+        finally:
+            db.preferir_primario(False)
+
+    return stream_with_context(gerar())
+
+
+def primario(f):
+    """Rota que sempre lê do primário (lê e grava na mesma requisição, por exemplo)."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        db.preferir_primario()
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+# --- MÉTRICAS DAS CONSULTAS (ver metricas.py) ---
+db.metricas.contexto = lambda: g.get('consultas') if has_request_context() else None
+
+
+@app.before_request
+def iniciar_metricas():
+    g.consultas = db.metricas.nova_requisicao(request.endpoint)
+
+
+@app.after_request
+def encerrar_metricas(response):
+    consultas = g.pop('consultas', None)
+    if consultas is not None:
+        db.metricas.encerrar_requisicao(consultas)
+        # Aparece na aba de rede do navegador, junto do tempo da requisição
+        response.headers['Server-Timing'] = f'db;dur={consultas.tempo * 1000:.1f};desc="{consultas.total} consultas"'
+    return response
+
+
+# --- CACHE DAS LISTAS DE REFERÊNCIA ---
+# Com o backend 'local' (padrão) cada processo tem o seu cache, e invalidar só limpa o do
+# processo que fez a alteração: os demais a enxergam ao fim do CACHE_TTL. Vários workers: redis.
+cache = criar_cache(os.getenv('CACHE_BACKEND', 'local'), os.getenv('CACHE_URL'),
+                    ttl=float(os.getenv('CACHE_TTL', '300')))
+
+
+SQL_CATEGORIAS = "SELECT * FROM categorias WHERE usuario_id = %s ORDER BY nome"
+SQL_FORNECEDORES = "SELECT * FROM fornecedores WHERE usuario_id = %s ORDER BY nome"
+
+
+def categorias_do_usuario(user_id):
+    return cache.buscar(f"categorias:{user_id}", lambda: [dict(c) for c in db.executar(
+        SQL_CATEGORIAS, (user_id,), fetch='all')])
+
+
+def fornecedores_do_usuario(user_id):
+    return cache.buscar(f"fornecedores:{user_id}", lambda: [dict(f) for f in db.executar(
+        SQL_FORNECEDORES, (user_id,), fetch='all')])
+
+
+def alertas_do_usuario(user_id):
+    return cache.buscar(f"alertas:{user_id}", lambda: estoque.listar_alertas(db, user_id))
+
+
+# --- IMAGENS DAS BEBIDAS ---
+imagens = ProcessadorImagens(UPLOAD_FOLDER, trabalhadores=int(os.getenv('IMAGENS_TRABALHADORES', '2')))
+
+
+def salvar_imagem_enviada():
+    """Guarda a imagem do formulário, se houver, e devolve o nome para `imagem_url`."""
+    file = request.files.get('imagem')
+    if file and file.filename != '' and allowed_file(file.filename):
+        return imagens.salvar(file, secure_filename(file.filename))
+    return None
+
+
+@app.context_processor
+def funcoes_imagens():
+    return {'variantes_imagem': variantes_imagem}
+
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    caminho = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename))
+    # Variante pedida antes de o pool terminar de gerá-la
+    if not os.path.exists(caminho):
+        imagens.garantir(secure_filename(filename))
+    if imutavel(filename):
+        # O nome já é o hash do conteúdo: serve de ETag forte sem ler o arquivo
+        response = enviar_upload(filename, etag=filename.rsplit('.', 1)[0], max_age=UM_ANO)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        # Imagens antigas, gravadas pelo nome enviado, podem ser sobrescritas: sempre revalidar
+        response = enviar_upload(filename, max_age=0)
+        response.cache_control.no_cache = True
+    return response
+
+
+def enviar_upload(filename, **opcoes):
+    if app.config['ARQUIVOS_PROXY'] != 'x-accel-redirect':
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename, **opcoes)
+    # O nginx lê o arquivo da location internal; aqui só saem os cabeçalhos (e o 304)
+    response = enviar_de_diretorio(os.path.abspath(app.config['UPLOAD_FOLDER']), filename, request.environ,
+                                   use_x_sendfile=True, response_class=app.response_class, **opcoes)
+    del response.headers['X-Sendfile']
+    if response.status_code == 200:
+        response.headers['X-Accel-Redirect'] = app.config['ARQUIVOS_PROXY_PREFIXO'] + filename
+    return response
 
 
 # --- DECORATORS E ROTAS DE AUTENTICAÇÃO ---
@@ -53,6 +284,16 @@ def login_required(f):
     return decorated_function
 
 
+def api_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'usuario_id' not in session:
+            return jsonify({'erro': "Autenticação necessária."}), 401
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -64,6 +305,9 @@ def admin_required(f):
     return decorated_function
 
 
+SQL_LOGIN = "SELECT * FROM usuarios WHERE username = %s AND password_hash = %s"
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if 'usuario_id' in session:
@@ -72,8 +316,7 @@ def login():
         username = request.form['username']
         password = request.form['password']
         password_hash = hash_senha(password)
-        user = db.executar("SELECT * FROM usuarios WHERE username = %s AND password_hash = %s",
-                           (username, password_hash), fetch='one')
+        user = db.executar(SQL_LOGIN, (username, password_hash), fetch='one')
         if user:
             session['usuario_id'] = user['id']
             session['username'] = user['username']
@@ -119,42 +362,63 @@ def logout():
 
 
 # --- ROTAS DE BEBIDAS ---
+def consulta_listagem(user_id, relevancia="0 AS distancia", params_relevancia=(), filtro="", params_filtro=()):
+    """(query, params) da listagem do painel, pronta para `paginar` (ver busca.montar)."""
+    # A subconsulta deixa a paginação ordenar pela relevância calculada no SELECT
+    query = f"""
+        SELECT * FROM (
+            SELECT b.id, b.codigo, b.nome, COALESCE(c.nome, 'Sem Categoria') as categoria,
+                   b.quantidade, b.preco_venda, b.quantidade_minima, b.imagem_url, {relevancia}
+            FROM bebidas b 
+            LEFT JOIN categorias c ON b.categoria_id = c.id
+            WHERE b.usuario_id = %s{filtro}
+        ) AS listagem
+        WHERE TRUE
+    """
+    return query, list(params_relevancia) + [user_id] + list(params_filtro)
+
+
 @app.route('/')
 @login_required
 def index():
     user_id = session['usuario_id']
     termo_busca = request.args.get('busca', '')
     categoria_id_filtro = request.args.get('categoria', '')
-
-    query = """
-        SELECT b.id, b.codigo, b.nome, COALESCE(c.nome, 'Sem Categoria') as categoria,
-               b.quantidade, b.preco_venda, b.quantidade_minima, b.imagem_url
-        FROM bebidas b 
-        LEFT JOIN categorias c ON b.categoria_id = c.id
-        WHERE b.usuario_id = %s AND (LOWER(b.nome) LIKE %s OR LOWER(b.codigo) LIKE %s)
-    """
-    params = [user_id, f'%{termo_busca.lower()}%', f'%{termo_busca.lower()}%']
+    por_pagina = min(max(request.args.get('por_pagina', app.config['POR_PAGINA'], type=int), 1), 200)
+
+    ordem = ['nome', 'id']
+    relevancia, params_relevancia, filtro, params_filtro = "0 AS distancia", [], "", []
+    if termo_busca:
+        id_exato = busca.codigo_exato(db, user_id, termo_busca)
+        if id_exato:
+            # Código de barras lido: mostra só a bebida, sem busca aproximada
+            filtro, params_filtro = " AND b.id = %s", [id_exato]
+        else:
+            relevancia, params_relevancia, filtro, params_filtro = busca.montar(termo_busca, db.busca_indexada)
+            ordem = ['distancia', 'nome', 'id']
 
     # Adiciona o filtro de categoria se um foi selecionado
     if categoria_id_filtro:
-        query += " AND b.categoria_id = %s"
-        params.append(int(categoria_id_filtro))
+        filtro += " AND b.categoria_id = %s"
+        params_filtro.append(int(categoria_id_filtro))
 
-    query += " ORDER BY b.nome"
-
-    bebidas = db.executar(query, tuple(params), fetch='all')
+    query, params = consulta_listagem(user_id, relevancia, params_relevancia, filtro, params_filtro)
+    bebidas = paginar(db, query, params, ordem, ordem, por_pagina,
+                      apos=request.args.get('apos'), antes=request.args.get('antes'))
+    total_estimado = estimar_total(db, query, tuple(params))
 
     # Busca todas as categorias do usuário para popular o menu de filtro
-    categorias = db.executar("SELECT * FROM categorias WHERE usuario_id = %s ORDER BY nome", (user_id,), fetch='all')
+    categorias = categorias_do_usuario(user_id)
 
-    # Busca alertas de estoque baixo
-    alertas = db.executar("SELECT nome FROM bebidas WHERE quantidade <= quantidade_minima AND quantidade_minima > 0 AND usuario_id = %s", (user_id,), fetch='all')
+    # Busca alertas de estoque baixo (mantidos em cache até a próxima mudança)
+    alertas = alertas_do_usuario(user_id)
     if alertas:
-        nomes_bebidas = ", ".join([a['nome'] for a in alertas])
+        nomes_bebidas = ", ".join(alertas)
         flash(f"Alerta de Estoque Baixo! Repor: {nomes_bebidas}", "warning")
 
     return render_template('index.html', bebidas=bebidas, categorias=categorias,
-                           termo_busca=termo_busca, categoria_filtro=categoria_id_filtro)
+                           termo_busca=termo_busca, categoria_filtro=categoria_id_filtro,
+                           por_pagina=por_pagina, total_estimado=total_estimado)
 
 
 @app.route('/bebida/adicionar', methods=['GET', 'POST'])
@@ -162,35 +426,36 @@ def index():
 def adicionar_bebida():
     user_id = session['usuario_id']
     if request.method == 'POST':
-        imagem_url = None
-        if 'imagem' in request.files:
-            file = request.files['imagem']
-            if file and file.filename != '' and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                imagem_url = filename
-
         try:
-            db.executar("""
-                INSERT INTO bebidas (codigo, nome, categoria_id, preco_custo, preco_venda, quantidade,
-                                     quantidade_minima, imagem_url, usuario_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    request.form['codigo'], request.form['nome'], request.form.get('categoria_id') or None,
-                    request.form['preco_custo'], request.form['preco_venda'], request.form['quantidade'],
-                    request.form['quantidade_minima'], imagem_url, user_id
-                ))
+            imagem_url = salvar_imagem_enviada()
+            with db.transacao():
+                estoque.reservar_alertas(db, user_id)
+                nova = db.executar("""
+                    INSERT INTO bebidas (codigo, nome, categoria_id, preco_custo, preco_venda, quantidade,
+                                         quantidade_minima, imagem_url, usuario_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id, quantidade, quantidade_minima
+                    """, (
+                        request.form['codigo'], request.form['nome'], request.form.get('categoria_id') or None,
+                        request.form['preco_custo'], request.form['preco_venda'], request.form['quantidade'],
+                        request.form['quantidade_minima'], imagem_url, user_id
+                    ), fetch='one')
+                transicao = estoque.registrar_transicao(db, user_id, nova['id'], None,
+                                                        (nova['quantidade'], nova['quantidade_minima']))
+            if transicao:
+                cache.invalidar(f"alertas:{user_id}")
             flash("Bebida adicionada com sucesso!", "success")
         except Exception as e:
             flash(f"Erro ao adicionar bebida: {e}", "danger")
         return redirect(url_for('index'))
 
-    categorias = db.executar("SELECT * FROM categorias WHERE usuario_id = %s ORDER BY nome", (user_id,), fetch='all')
+    categorias = categorias_do_usuario(user_id)
     return render_template('gerenciar_bebida.html', titulo="Adicionar Bebida", categorias=categorias, bebida=None)
 
 
 @app.route('/bebida/editar/<int:id>', methods=['GET', 'POST'])
 @login_required
+@primario
 def editar_bebida(id):
     user_id = session['usuario_id']
     bebida = db.executar("SELECT * FROM bebidas WHERE id = %s AND usuario_id = %s", (id, user_id), fetch='one')
@@ -199,31 +464,39 @@ def editar_bebida(id):
         return redirect(url_for('index'))
 
     if request.method == 'POST':
-        imagem_url = bebida['imagem_url']
-        if 'imagem' in request.files:
-            file = request.files['imagem']
-            if file and file.filename != '' and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-                imagem_url = filename
-
         try:
-            db.executar("""
-                UPDATE bebidas
-                SET codigo=%s,nome=%s,categoria_id=%s,preco_custo=%s,preco_venda=%s,
-                    quantidade=%s,quantidade_minima=%s,imagem_url=%s
-                WHERE id = %s AND usuario_id = %s
-                """, (
-                    request.form['codigo'], request.form['nome'], request.form.get('categoria_id') or None,
-                    request.form['preco_custo'], request.form['preco_venda'], request.form['quantidade'],
-                    request.form['quantidade_minima'], imagem_url, id, user_id
-                ))
+            imagem_nova = salvar_imagem_enviada()
+            with db.transacao():
+                estoque.reservar_alertas(db, user_id)
+                # O "antes" da transição é lido com a linha travada: uma movimentação
+                # concorrente espera este commit ou já está refletida aqui
+                anterior = db.executar("""
+                    SELECT quantidade, quantidade_minima, imagem_url FROM bebidas
+                    WHERE id = %s AND usuario_id = %s FOR UPDATE
+                    """, (id, user_id), fetch='one')
+                atualizada = anterior and db.executar("""
+                    UPDATE bebidas
+                    SET codigo=%s,nome=%s,categoria_id=%s,preco_custo=%s,preco_venda=%s,
+                        quantidade=%s,quantidade_minima=%s,imagem_url=%s
+                    WHERE id = %s AND usuario_id = %s
+                    RETURNING id, quantidade, quantidade_minima
+                    """, (
+                        request.form['codigo'], request.form['nome'], request.form.get('categoria_id') or None,
+                        request.form['preco_custo'], request.form['preco_venda'], request.form['quantidade'],
+                        request.form['quantidade_minima'], imagem_nova or anterior['imagem_url'], id, user_id
+                    ), fetch='one')
+                if atualizada:
+                    estoque.registrar_transicao(db, user_id, id, (anterior['quantidade'], anterior['quantidade_minima']),
+                                                (atualizada['quantidade'], atualizada['quantidade_minima']))
+                    estoque.notificar(db, user_id, [atualizada])
+            # O nome também aparece no alerta, então qualquer edição o invalida
+            cache.invalidar(f"alertas:{user_id}")
             flash("Bebida atualizada com sucesso!", "success")
         except Exception as e:
             flash(f"Erro ao atualizar bebida: {e}", "danger")
         return redirect(url_for('index'))
 
-    categorias = db.executar("SELECT * FROM categorias WHERE usuario_id = %s ORDER BY nome", (user_id,), fetch='all')
+    categorias = categorias_do_usuario(user_id)
     return render_template('gerenciar_bebida.html', titulo="Editar Bebida", categorias=categorias, bebida=bebida)
 
 
@@ -232,10 +505,14 @@ def editar_bebida(id):
 def excluir_bebida(id):
     user_id = session['usuario_id']
     try:
-        res = db.executar("DELETE FROM bebidas WHERE id = %s AND usuario_id = %s", (id, user_id))
+        with db.transacao():
+            res = db.executar("DELETE FROM bebidas WHERE id = %s AND usuario_id = %s", (id, user_id))
+            if res > 0:
+                db.registrar_auditoria(user_id, 'Excluir Bebida', f"Bebida ID: {id}")
+                estoque.notificar(db, user_id, [{'id': id}], evento='excluida')
         if res > 0:
+            cache.invalidar(f"alertas:{user_id}")
             flash("Bebida excluída com sucesso.", "success")
-            db.registrar_auditoria(user_id, 'Excluir Bebida', f"Bebida ID: {id}")
         else:
             flash("Bebida não encontrada ou você não tem permissão para excluí-la.", "danger")
     except Exception as e:
@@ -243,6 +520,38 @@ def excluir_bebida(id):
     return redirect(url_for('index'))
 
 
+@app.route('/bebidas/importar', methods=['GET', 'POST'])
+@login_required
+def importar_bebidas():
+    user_id = session['usuario_id']
+    resultado = None
+    if request.method == 'POST':
+        file = request.files.get('arquivo')
+        if not file or file.filename == '':
+            flash("Selecione um arquivo CSV.", "warning")
+            return redirect(request.url)
+        try:
+            # utf-8-sig descarta o BOM que o Excel põe no início do arquivo
+            resultado = catalogo.importar_csv(db, user_id, io.TextIOWrapper(file.stream, encoding='utf-8-sig'))
+            cache.invalidar(f"categorias:{user_id}", f"alertas:{user_id}")
+            flash(f"Importação concluída: {resultado['inseridas']} inserida(s), "
+                  f"{resultado['atualizadas']} atualizada(s), {resultado['invalidas']} linha(s) inválida(s).",
+                  "success" if not resultado['invalidas'] else "warning")
+        except UnicodeDecodeError:
+            flash("O arquivo precisa estar em UTF-8.", "danger")
+        except Exception as e:
+            flash(f"Erro ao importar bebidas: {e}", "danger")
+    return render_template('importar_bebidas.html', resultado=resultado, colunas=catalogo.COLUNAS)
+
+
+@app.route('/bebidas/exportar')
+@login_required
+def exportar_bebidas():
+    nome = f"bebidas-{datetime.date.today().isoformat()}.csv"
+    return Response(catalogo.exportar_csv(db, session['usuario_id']), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{nome}"'})
+
+
 @app.route('/categorias', methods=['GET', 'POST'])
 @login_required
 def gerenciar_categorias():
@@ -251,14 +560,16 @@ def gerenciar_categorias():
         nome = request.form.get('nome')
         try:
             if nome:
-                db.executar("INSERT INTO categorias (nome, usuario_id) VALUES (%s, %s)", (nome, user_id))
+                with db.transacao():
+                    db.executar("INSERT INTO categorias (nome, usuario_id) VALUES (%s, %s)", (nome, user_id))
+                    db.registrar_auditoria(user_id, 'Adicionar Categoria', f"Categoria '{nome}'")
+                cache.invalidar(f"categorias:{user_id}")
                 flash("Categoria adicionada.", "success")
-                db.registrar_auditoria(user_id, 'Adicionar Categoria', f"Categoria '{nome}'")
         except Exception as e:
             flash(f"Erro ao adicionar categoria: {e}", "danger")
         return redirect(url_for('gerenciar_categorias'))
 
-    categorias = db.executar("SELECT * FROM categorias WHERE usuario_id = %s ORDER BY nome", (user_id,), fetch='all')
+    categorias = categorias_do_usuario(user_id)
     return render_template('gerenciar_categorias.html', categorias=categorias)
 
 
@@ -267,10 +578,13 @@ def gerenciar_categorias():
 def excluir_categoria(id):
     user_id = session['usuario_id']
     try:
-        res = db.executar("DELETE FROM categorias WHERE id = %s AND usuario_id = %s", (id, user_id))
+        with db.transacao():
+            res = db.executar("DELETE FROM categorias WHERE id = %s AND usuario_id = %s", (id, user_id))
+            if res > 0:
+                db.registrar_auditoria(user_id, 'Excluir Categoria', f"Categoria ID: {id}")
         if res > 0:
+            cache.invalidar(f"categorias:{user_id}")
             flash("Categoria excluída.", "success")
-            db.registrar_auditoria(user_id, 'Excluir Categoria', f"Categoria ID: {id}")
         else:
             flash("Categoria não encontrada ou você não tem permissão.", "danger")
     except Exception as e:
@@ -290,17 +604,18 @@ def gerenciar_fornecedores():
             user_id
         )
         try:
-            db.executar(
-                "INSERT INTO fornecedores (nome, contato, endereco, cnpj, email, usuario_id) VALUES (%s, %s, %s, %s, %s, %s)",
-                dados)
+            with db.transacao():
+                db.executar(
+                    "INSERT INTO fornecedores (nome, contato, endereco, cnpj, email, usuario_id) VALUES (%s, %s, %s, %s, %s, %s)",
+                    dados)
+                db.registrar_auditoria(user_id, 'Adicionar Fornecedor', f"Fornecedor '{dados[0]}'")
+            cache.invalidar(f"fornecedores:{user_id}")
             flash("Fornecedor adicionado.", "success")
-            db.registrar_auditoria(user_id, 'Adicionar Fornecedor', f"Fornecedor '{dados[0]}'")
         except Exception as e:
             flash(f"Erro ao adicionar fornecedor: {e}", "danger")
         return redirect(url_for('gerenciar_fornecedores'))
 
-    fornecedores = db.executar("SELECT * FROM fornecedores WHERE usuario_id = %s ORDER BY nome", (user_id,),
-                               fetch='all')
+    fornecedores = fornecedores_do_usuario(user_id)
     return render_template('gerenciar_fornecedores.html', fornecedores=fornecedores)
 
 
@@ -309,10 +624,13 @@ def gerenciar_fornecedores():
 def excluir_fornecedor(id):
     user_id = session['usuario_id']
     try:
-        res = db.executar("DELETE FROM fornecedores WHERE id = %s AND usuario_id = %s", (id, user_id))
+        with db.transacao():
+            res = db.executar("DELETE FROM fornecedores WHERE id = %s AND usuario_id = %s", (id, user_id))
+            if res > 0:
+                db.registrar_auditoria(user_id, 'Excluir Fornecedor', f"Fornecedor ID: {id}")
         if res > 0:
+            cache.invalidar(f"fornecedores:{user_id}")
             flash("Fornecedor excluído.", "success")
-            db.registrar_auditoria(user_id, 'Excluir Fornecedor', f"Fornecedor ID: {id}")
         else:
             flash("Fornecedor não encontrado ou você não tem permissão.", "danger")
     except Exception as e:
@@ -332,32 +650,17 @@ def movimentar_estoque():
             observacao = request.form['observacao']
             fornecedor_id = request.form.get('fornecedor_id') or None
 
-            bebida = db.executar("SELECT id, nome, quantidade FROM bebidas WHERE codigo = %s AND usuario_id = %s",
-                                 (codigo_bebida, user_id), fetch='one')
+            try:
+                bebida = estoque.movimentar(db, user_id, codigo_bebida, tipo, quantidade, observacao, fornecedor_id)
+            except estoque.EstoqueInsuficiente as e:
+                flash(str(e), "warning")
+                return redirect(url_for('movimentar_estoque'))
             if not bebida:
                 flash("Bebida com este código não encontrada no seu estoque.", "danger")
                 return redirect(url_for('movimentar_estoque'))
+            if bebida['transicao']:
+                cache.invalidar(f"alertas:{user_id}")
 
-            bebida_id = bebida['id']
-            qtd_atual = bebida['quantidade']
-            nova_qtd = qtd_atual
-
-            if tipo == 'entrada':
-                nova_qtd += quantidade
-            elif tipo == 'saida':
-                if quantidade > qtd_atual:
-                    flash(f"Estoque insuficiente para a saída. Disponível: {qtd_atual}", "warning")
-                    return redirect(url_for('movimentar_estoque'))
-                nova_qtd -= quantidade
-
-            db.executar("UPDATE bebidas SET quantidade = %s WHERE id = %s", (nova_qtd, bebida_id))
-            db.executar(
-                """INSERT INTO movimentacoes (bebida_id, tipo, quantidade, observacao, fornecedor_id, usuario_id)
-                   VALUES (%s, %s, %s, %s, %s, %s)""",
-                (bebida_id, tipo, quantidade, observacao, fornecedor_id, user_id))
-
-            db.registrar_auditoria(user_id, 'Movimentação de Estoque',
-                                   f"Tipo: {tipo}, Bebida: '{bebida['nome']}', Qtd: {quantidade}")
             flash("Movimentação registrada com sucesso!", "success")
             return redirect(url_for('historico_movimentacoes'))
 
@@ -365,24 +668,312 @@ def movimentar_estoque():
             flash(f"Erro ao processar movimentação: {e}", "danger")
             return redirect(url_for('movimentar_estoque'))
 
-    fornecedores = db.executar("SELECT id, nome FROM fornecedores WHERE usuario_id = %s ORDER BY nome", (user_id,),
-                               fetch='all')
+    fornecedores = fornecedores_do_usuario(user_id)
     return render_template('movimentacoes.html', fornecedores=fornecedores)
 
 
+@app.route('/api/movimentacoes/lote', methods=['POST'])
+@api_login_required
+def api_movimentar_lote():
+    """
+    Recebe {"linhas": [{"codigo", "tipo", "quantidade", "observacao"?, "fornecedor_id"?}, ...],
+    "tudo_ou_nada": false} — por exemplo, uma sessão inteira do leitor de código de barras.
+    """
+    user_id = session['usuario_id']
+    corpo = request.get_json(silent=True)
+    linhas = corpo.get('linhas') if isinstance(corpo, dict) else None
+    if not isinstance(linhas, list) or not linhas:
+        return jsonify({'erro': "Envie um objeto JSON com a lista 'linhas'."}), 400
+    if len(linhas) > app.config['MAX_LINHAS_LOTE']:
+        return jsonify({'erro': f"Máximo de {app.config['MAX_LINHAS_LOTE']} linhas por lote."}), 413
+    try:
+        resultado = estoque.movimentar_lote(db, user_id, linhas, bool(corpo.get('tudo_ou_nada')))
+    except Exception as e:
+        return jsonify({'erro': f"Erro ao processar movimentações: {e}"}), 500
+    if resultado['transicoes']:
+        cache.invalidar(f"alertas:{user_id}")
+    return jsonify(resultado)
+
+
+# --- CONSULTA POR CÓDIGO E SINCRONIZAÇÃO DO CATÁLOGO (ver sincronizacao.py) ---
+# Para leitores e caixas: uma consulta indexada por requisição, sem template.
+def responder_bebida(bebida):
+    """JSON da bebida com ETag da versão da linha; If-None-Match igual devolve 304 sem corpo."""
+    if bebida is None:
+        return jsonify({'erro': "Bebida não encontrada."}), 404
+    response = jsonify(dict(bebida))
+    response.set_etag(f"{bebida['id']}.{bebida['versao']}")
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@app.route('/api/bebidas/<int:id>')
+@api_login_required
+def api_bebida(id):
+    return responder_bebida(sincronizacao.por_id(db, session['usuario_id'], id))
+
+
+@app.route('/api/bebidas/codigo/<path:codigo>')
+@api_login_required
+def api_bebida_por_codigo(codigo):
+    return responder_bebida(sincronizacao.por_codigo(db, session['usuario_id'], codigo))
+
+
+@app.route('/api/bebidas/codigos', methods=['POST'])
+@api_login_required
+def api_bebidas_por_codigos():
+    """
+    Recebe {"codigos": ["789...", ...]} ou {"codigos": {"789...": versao_conhecida, ...}};
+    devolve {"bebidas": [...], "inalteradas": [códigos], "nao_encontrados": [códigos]}.
+    """
+    corpo = request.get_json(silent=True)
+    codigos = corpo.get('codigos') if isinstance(corpo, dict) else None
+    if not isinstance(codigos, (list, dict)) or not codigos or not all(isinstance(c, str) for c in codigos):
+        return jsonify({'erro': "Envie um objeto JSON com 'codigos' (lista ou objeto código -> versão)."}), 400
+    if len(codigos) > app.config['MAX_CODIGOS_CONSULTA']:
+        return jsonify({'erro': f"Máximo de {app.config['MAX_CODIGOS_CONSULTA']} códigos por consulta."}), 413
+    bebidas, inalteradas, nao_encontrados = sincronizacao.por_codigos(db, session['usuario_id'], codigos)
+    return jsonify({'bebidas': bebidas, 'inalteradas': inalteradas, 'nao_encontrados': nao_encontrados})
+
+
+@app.route('/api/bebidas/alteracoes')
+@api_login_required
+def api_alteracoes_bebidas():
+    """
+    ?desde=<versao> (0 = catálogo inteiro): bebidas alteradas e ids excluídos
+    desde a versão. Enquanto vier "continuar", chame de novo com
+    ?continuar=<valor>; no fim, guarde "versao" para o próximo ?desde=.
+    """
+    limite = min(max(request.args.get('limite', sincronizacao.LIMITE_ALTERACOES, type=int), 1),
+                 sincronizacao.LIMITE_ALTERACOES)
+    desde = request.args.get('desde', 0, type=int)
+    continuacao = None
+    if request.args.get('continuar'):
+        try:
+            continuacao = tuple(int(parte) for parte in request.args['continuar'].split('.'))
+        except ValueError:
+            continuacao = ()
+        if len(continuacao) != 3:
+            return jsonify({'erro': "Valor de 'continuar' inválido."}), 400
+    bebidas, excluidas, marca, proxima = sincronizacao.alteracoes(db, session['usuario_id'], desde,
+                                                                  continuacao, limite)
+    return jsonify({'bebidas': bebidas, 'excluidas': excluidas,
+                    'versao': None if proxima else marca,
+                    'continuar': '.'.join(map(str, proxima)) if proxima else None})
+
+
+@app.route('/api/alertas')
+@api_login_required
+def api_alertas():
+    alertas = alertas_do_usuario(session['usuario_id'])
+    return jsonify({'total': len(alertas), 'bebidas': alertas})
+
+
+# --- ATUALIZAÇÕES AO VIVO DO ESTOQUE (ver notificacoes.py) ---
+# Uma conexão em LISTEN por processo; cada aba do painel segura uma thread
+# do servidor enquanto o fluxo estiver aberto.
+ouvinte_estoque = notificacoes.Ouvinte(db.pool.db_url, estoque.CANAL,
+                                       tamanho_fila=int(os.getenv('SSE_FILA', '100')))
+SSE_PING = float(os.getenv('SSE_PING', '15'))
+
+
+@app.route('/api/estoque/eventos')
+@api_login_required
+def api_eventos_estoque():
+    """
+    Fluxo text/event-stream com um evento por alteração de estoque do
+    usuário: 'estoque' (id, quantidade, quantidade_minima, alerta),
+    'excluida' (id) ou 'recarregar' quando eventos podem ter se perdido.
+    """
+    user_id = session['usuario_id']
+
+    # Sem stream_with_context nem transmitir(): o fluxo não lê o banco e não deve
+    # segurar o contexto da requisição enquanto a aba estiver aberta
+    def eventos():
+        fila = ouvinte_estoque.assinar(user_id)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    evento, dados = fila.get(timeout=SSE_PING)
+                except queue.Empty:
+                    # Comentário SSE: mantém proxies abertos e revela clientes que já saíram
+                    yield ": ping\n\n"
+                    continue
+                yield notificacoes.formatar_sse(evento, dados)
+        finally:
+            ouvinte_estoque.cancelar(user_id, fila)
+
+    return Response(eventos(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/api/estoque/posicao')
+@api_login_required
+def api_posicao_estoque():
+    """Quantidade e valor de custo de cada bebida no fim do dia `dia` (AAAA-MM-DD)."""
+    try:
+        dia = datetime.date.fromisoformat(request.args['dia'])
+    except (KeyError, ValueError):
+        return jsonify({'erro': "Informe o dia no formato AAAA-MM-DD."}), 400
+    itens, valor_total = posicoes.posicao(db, session['usuario_id'], dia, app.config['ARQUIVAMENTO_PASTA'])
+    return jsonify({'dia': dia.isoformat(), 'valor_total': valor_total, 'itens': itens})
+
+
+@app.route('/api/alertas/eventos')
+@api_login_required
+def api_eventos_alerta():
+    """
+    Eventos depois de ?apos=<posicao>, em ordem; cada um traz a sua
+    `posicao`, e quem acompanha o fluxo guarda a do último recebido.
+    """
+    try:
+        apos = estoque.ler_posicao_alerta(request.args.get('apos', '0'))
+    except ValueError:
+        return jsonify({'erro': "Valor de 'apos' inválido."}), 400
+    eventos = estoque.eventos_alerta(db, session['usuario_id'], apos,
+                                     min(request.args.get('limite', 100, type=int), 1000))
+    return jsonify(eventos)
+
+
+def dia_do_filtro(nome):
+    try:
+        return datetime.date.fromisoformat(request.args.get(nome, ''))
+    except ValueError:
+        return None
+
+
+def filtro_periodo(coluna, params):
+    """
+    Filtros ?de= e ?ate= (dias inclusivos) para o WHERE; datas inválidas são ignoradas.
+    """
+    filtro = ""
+    for nome, condicao in (('de', f" AND {coluna} >= %s"), ('ate', f" AND {coluna} < %s::date + 1")):
+        dia = dia_do_filtro(nome)
+        if dia is None:
+            continue
+        filtro += condicao
+        params.append(dia)
+    return filtro
+
+
+def abrir_fonte(tabela, arquivo, de, ate, usuario_id=None):
+    """`tabela`, ou ela mais o arquivo morto do período com ?arquivo=1 (ver arquivamento.fonte)."""
+    if not arquivo:
+        return nullcontext(tabela)
+    return arquivamento.fonte(db, tabela, app.config['ARQUIVAMENTO_PASTA'], de, ate, usuario_id)
+
+
+def renderizar_historico(template, nome_lista, tabela, consulta, ordem, chaves, usuario_id=None):
+    """
+    Renderiza um histórico do mais recente para o mais antigo. Normalmente
+    mostra uma página por vez; com ?completo=1 envia todas as linhas do
+    período, lidas por um cursor no servidor e renderizadas em streaming.
+    `consulta(fonte)` devolve (query, params) lendo de `fonte` no lugar de
+    `tabela`; com ?arquivo=1 a fonte inclui o arquivo morto do período
+    (só as linhas de `usuario_id`, se informado).
+    """
+    contexto = {
+        'de': request.args.get('de', ''),
+        'ate': request.args.get('ate', ''),
+        'arquivo': request.args.get('arquivo', ''),
+        'por_pagina': min(max(request.args.get('por_pagina', app.config['POR_PAGINA'], type=int), 1), 500),
+    }
+    de, ate = dia_do_filtro('de'), dia_do_filtro('ate')
+    if contexto['arquivo'] and (de is None or ate is None):
+        flash("Para incluir o arquivo morto, informe o período (De e Até).", "warning")
+        contexto['arquivo'] = ''
+
+    def fonte_historico():
+        return abrir_fonte(tabela, contexto['arquivo'], de, ate, usuario_id)
+
+    if request.args.get('completo'):
+        def linhas():
+            # A tabela temporária do arquivo só existe enquanto a transação da fonte estiver aberta
+            with fonte_historico() as fonte:
+                query, params = consulta(fonte)
+                yield from db.iterar(query + " ORDER BY " + ", ".join(f"{c} DESC" for c in ordem), tuple(params))
+
+        contexto[nome_lista] = transmitir(linhas())
+        return app.response_class(stream_template(template, pagina=None, **contexto), mimetype='text/html')
+
+    with fonte_historico() as fonte:
+        query, params = consulta(fonte)
+        pagina = paginar(db, query, params, ordem, chaves, contexto['por_pagina'],
+                         apos=request.args.get('apos'), antes=request.args.get('antes'), decrescente=True)
+    contexto[nome_lista] = pagina
+    return render_template(template, pagina=pagina, **contexto)
+
+
+def responder_exportacao(formato, nome, query, params, colunas, linhas=None):
+    """
+    Resposta em streaming com o resultado de `query` em CSV (COPY) ou XLSX
+    (cursor no servidor): a memória não cresce com o número de linhas. Com
+    `linhas` (um gerador que já lê a consulta), os dois formatos saem dele.
+    """
+    if linhas is None and formato == 'csv':
+        corpo = exportacao.csv(db, query, params)
+    elif formato == 'csv':
+        corpo = exportacao.csv_de_linhas(linhas, colunas)
+    else:
+        corpo = exportacao.xlsx(linhas if linhas is not None else db.iterar(query, params), colunas, planilha=nome)
+    return Response(transmitir(corpo), mimetype=exportacao.FORMATOS[formato],
+                    headers={'Content-Disposition': f'attachment; filename="{nome}.{formato}"',
+                             'X-Accel-Buffering': 'no'})
+
+
+COLUNAS_MOVIMENTACOES = ['id', 'data', 'bebida_nome', 'tipo', 'quantidade', 'username', 'observacao']
+
+
+def consulta_movimentacoes(user_id, fonte='movimentacoes'):
+    params = [user_id]
+    query = f"""
+            SELECT m.id, m.data, b.nome as bebida_nome, m.tipo, m.quantidade, u.username, m.observacao
+            FROM {fonte} m
+                     JOIN bebidas b ON m.bebida_id = b.id
+                     JOIN usuarios u ON m.usuario_id = u.id
+            WHERE m.usuario_id = %s
+            """ + filtro_periodo('m.data', params)
+    return query, params
+
+
 @app.route('/historico-movimentacoes')
 @login_required
 def historico_movimentacoes():
     user_id = session['usuario_id']
-    movs = db.executar("""
-                       SELECT m.data, b.nome as bebida_nome, m.tipo, m.quantidade, u.username, m.observacao
-                       FROM movimentacoes m
-                                JOIN bebidas b ON m.bebida_id = b.id
-                                JOIN usuarios u ON m.usuario_id = u.id
-                       WHERE m.usuario_id = %s
-                       ORDER BY m.data DESC
-                       """, (user_id,), fetch='all')
-    return render_template('historico_movimentacoes.html', movimentacoes=movs)
+    return renderizar_historico('historico_movimentacoes.html', 'movimentacoes', 'movimentacoes',
+                                lambda fonte: consulta_movimentacoes(user_id, fonte),
+                                ['m.data', 'm.id'], ['data', 'id'], usuario_id=user_id)
+
+
+@app.route('/historico-movimentacoes/exportar')
+@login_required
+def exportar_movimentacoes():
+    formato = request.args.get('formato', 'csv')
+    if formato not in exportacao.FORMATOS:
+        flash("Formato de exportação inválido.", "danger")
+        return redirect(url_for('historico_movimentacoes'))
+    user_id = session['usuario_id']
+    # O nome do arquivo sai das datas já validadas, como o filtro: nada do texto cru vai para o cabeçalho
+    de, ate = dia_do_filtro('de'), dia_do_filtro('ate')
+    nome = '-'.join(['movimentacoes'] + [dia.isoformat() for dia in (de, ate) if dia is not None])
+    ordem = " ORDER BY m.data DESC, m.id DESC"
+    if not request.args.get('arquivo'):
+        query, params = consulta_movimentacoes(user_id)
+        return responder_exportacao(formato, nome, query + ordem, tuple(params), COLUNAS_MOVIMENTACOES)
+
+    if de is None or ate is None:
+        flash("Para incluir o arquivo morto, informe o período (De e Até).", "warning")
+        return redirect(url_for('historico_movimentacoes'))
+
+    def linhas():
+        # O COPY do CSV roda em outra conexão, que não vê a tabela temporária do arquivo
+        with abrir_fonte('movimentacoes', True, de, ate, user_id) as fonte:
+            query, params = consulta_movimentacoes(user_id, fonte)
+            yield from db.iterar(query + ordem, tuple(params))
+
+    return responder_exportacao(formato, nome, None, None, COLUNAS_MOVIMENTACOES, linhas=linhas())
 
 
 @app.route('/relatorios', methods=['GET', 'POST'])
@@ -393,27 +984,7 @@ def relatorios():
         data_inicio = request.form['data_inicio']
         data_fim = request.form['data_fim']
 
-        query_mais_vendidos = """
-                              SELECT p.nome, SUM(m.quantidade) as total_vendido
-                              FROM movimentacoes m
-                                       JOIN bebidas p ON m.bebida_id = p.id
-                              WHERE m.tipo = 'saida'
-                                AND m.usuario_id = %s
-                                AND m.data BETWEEN %s AND %s
-                              GROUP BY p.nome
-                              ORDER BY total_vendido DESC
-                              """
-        mais_vendidos = db.executar(query_mais_vendidos, (user_id, data_inicio, data_fim), fetch='all')
-
-        query_valor_total = """
-                            SELECT SUM(m.quantidade * p.preco_venda) as total
-                            FROM movimentacoes m
-                                     JOIN bebidas p ON m.bebida_id = p.id
-                            WHERE m.tipo = 'saida'
-                              AND m.usuario_id = %s
-                              AND m.data BETWEEN %s AND %s
-                            """
-        valor_total = db.executar(query_valor_total, (user_id, data_inicio, data_fim), fetch='one')
+        mais_vendidos, valor_total = vendas.relatorio(db, user_id, data_inicio, data_fim)
 
         return render_template('relatorios.html', mais_vendidos=mais_vendidos, valor_total=valor_total,
                                data_inicio=data_inicio, data_fim=data_fim)
@@ -421,6 +992,24 @@ def relatorios():
     return render_template('relatorios.html', mais_vendidos=None, valor_total=None)
 
 
+@app.route('/relatorios/exportar')
+@login_required
+def exportar_relatorio():
+    formato = request.args.get('formato', 'csv')
+    try:
+        data_inicio = datetime.date.fromisoformat(request.args.get('data_inicio', ''))
+        data_fim = datetime.date.fromisoformat(request.args.get('data_fim', ''))
+    except ValueError:
+        flash("Informe o período do relatório.", "warning")
+        return redirect(url_for('relatorios'))
+    if formato not in exportacao.FORMATOS:
+        flash("Formato de exportação inválido.", "danger")
+        return redirect(url_for('relatorios'))
+    query, params = vendas.consulta_exportacao(db, session['usuario_id'], data_inicio, data_fim)
+    return responder_exportacao(formato, f"vendas-{data_inicio}-{data_fim}", query, params,
+                                vendas.COLUNAS_EXPORTACAO)
+
+
 @app.route('/usuarios', methods=['GET', 'POST'])
 @admin_required
 def gerenciar_usuarios():
@@ -436,16 +1025,22 @@ def gerenciar_usuarios():
                 if not password:
                     flash("Senha é obrigatória para novos usuários.", "warning")
                 else:
-                    db.executar("INSERT INTO usuarios (username, password_hash, nivel_acesso) VALUES (%s, %s, %s)",
-                                (username, hash_senha(password), nivel_acesso))
+                    with db.transacao():
+                        db.executar("INSERT INTO usuarios (username, password_hash, nivel_acesso) VALUES (%s, %s, %s)",
+                                    (username, hash_senha(password), nivel_acesso))
+                        db.registrar_auditoria(session['usuario_id'], 'Adicionar Usuário',
+                                               f"Usuário '{username}' ({nivel_acesso})")
                     flash("Usuário adicionado.", "success")
             elif action == 'update':
-                if password:
-                    db.executar("UPDATE usuarios SET username=%s, password_hash=%s, nivel_acesso=%s WHERE id=%s",
-                                (username, hash_senha(password), nivel_acesso, id))
-                else:
-                    db.executar("UPDATE usuarios SET username=%s, nivel_acesso=%s WHERE id=%s",
-                                (username, nivel_acesso, id))
+                with db.transacao():
+                    if password:
+                        db.executar("UPDATE usuarios SET username=%s, password_hash=%s, nivel_acesso=%s WHERE id=%s",
+                                    (username, hash_senha(password), nivel_acesso, id))
+                    else:
+                        db.executar("UPDATE usuarios SET username=%s, nivel_acesso=%s WHERE id=%s",
+                                    (username, nivel_acesso, id))
+                    db.registrar_auditoria(session['usuario_id'], 'Atualizar Usuário',
+                                           f"Usuário ID: {id} ('{username}', {nivel_acesso})")
                 flash("Usuário atualizado.", "success")
         except Exception as e:
             flash(f"Erro: {e}", "danger")
@@ -462,7 +1057,10 @@ def excluir_usuario(id):
         flash("Você não pode excluir seu próprio usuário.", "warning")
         return redirect(url_for('gerenciar_usuarios'))
     try:
-        db.executar("DELETE FROM usuarios WHERE id=%s", (id,))
+        with db.transacao():
+            db.executar("DELETE FROM usuarios WHERE id=%s", (id,))
+            db.registrar_auditoria(session['usuario_id'], 'Excluir Usuário', f"Usuário ID: {id}")
+        cache.invalidar(f"categorias:{id}", f"fornecedores:{id}")
         flash("Usuário excluído.", "success")
     except Exception as e:
         flash(f"Erro ao excluir: {e}", "danger")
@@ -472,14 +1070,263 @@ def excluir_usuario(id):
 @app.route('/auditoria')
 @admin_required
 def historico_auditoria():
-    auditorias = db.executar("""
-                             SELECT a.data, u.username, a.acao, a.detalhes
-                             FROM auditoria a
-                                      LEFT JOIN usuarios u ON a.usuario_id = u.id
-                             ORDER BY a.data DESC
-                             """, fetch='all')
-    return render_template('historico_auditoria.html', auditorias=auditorias)
+    return renderizar_historico('historico_auditoria.html', 'auditorias', 'auditoria', consulta_auditoria,
+                                ['a.data', 'a.id'], ['data', 'id'])
+
+
+def consulta_auditoria(fonte='auditoria'):
+    params = []
+    query = f"""
+            SELECT a.id, a.data, u.username, a.acao, a.detalhes
+            FROM {fonte} a
+                     LEFT JOIN usuarios u ON a.usuario_id = u.id
+            WHERE TRUE
+            """ + filtro_periodo('a.data', params)
+    return query, params
+
+
+@app.route('/status/pool')
+@admin_required
+def status_pool():
+    return jsonify(db.estatisticas_pool())
+
 
+@app.route('/status/cache')
+@admin_required
+def status_cache():
+    return jsonify(cache.estatisticas())
+
+
+@app.route('/status/imagens')
+@admin_required
+def status_imagens():
+    return jsonify(imagens.estatisticas())
+
+
+@app.route('/status/preparadas')
+@admin_required
+def status_preparadas():
+    return jsonify(db.estatisticas_preparadas())
+
+
+@app.route('/status/replica')
+@admin_required
+def status_replica():
+    return jsonify(db.estatisticas_replica())
+
+
+@app.route('/status/notificacoes')
+@admin_required
+def status_notificacoes():
+    return jsonify(ouvinte_estoque.estatisticas())
+
+
+@app.route('/status/arquivo')
+@admin_required
+def status_arquivo():
+    return jsonify(arquivamento.resumo(db))
+
+
+@app.route('/status/auditoria')
+@admin_required
+def status_auditoria():
+    return jsonify(db.estatisticas_auditoria())
+
+
+@app.route('/metrics')
+def metrics():
+    # Com METRICAS_TOKEN o coletor se autentica por Bearer; sem ele, só administradores
+    token = os.getenv('METRICAS_TOKEN')
+    if token:
+        if request.headers.get('Authorization') != f"Bearer {token}":
+            return Response("Não autorizado.\n", status=401, mimetype='text/plain')
+    elif session.get('nivel_acesso') != 'administrador':
+        return Response("Não autorizado.\n", status=401, mimetype='text/plain')
+
+    def gauges(prefixo, stats):
+        return [(f"{prefixo}_{chave}", 'gauge', f"{prefixo}: {chave}", [(f"{prefixo}_{chave}", {}, valor)])
+                for chave, valor in stats.items() if isinstance(valor, (int, float))]
+
+    familias = db.metricas.familias()
+    familias += gauges('pjs_pool', db.estatisticas_pool())
+    familias += gauges('pjs_cache', cache.estatisticas())
+    familias += gauges('pjs_auditoria', db.estatisticas_auditoria())
+    familias += gauges('pjs_imagens', imagens.estatisticas())
+    familias += gauges('pjs_preparadas', db.estatisticas_preparadas())
+    familias += gauges('pjs_replica', db.estatisticas_replica())
+    familias += gauges('pjs_notificacoes', ouvinte_estoque.estatisticas())
+    return Response(metricas.formatar(familias), mimetype='text/plain; version=0.0.4')
+
+
+# --- COMANDOS DE MANUTENÇÃO (flask --app app <comando>) ---
+@app.cli.command('consolidar-vendas')
+@click.option('--dias-revisados', type=int, default=vendas.DIAS_REVISADOS, show_default=True,
+              help="Dias já consolidados que são refeitos, para pegar vendas confirmadas com atraso.")
+def consolidar_vendas_comando(dias_revisados):
+    """Atualiza a tabela de vendas diárias até o dia anterior (agendar logo depois da meia-noite)."""
+    gravadas = vendas.consolidar(db, dias_revisados)
+    click.echo(f"{gravadas} linha(s) consolidada(s); consolidado até {vendas.consolidado_ate(db)}.")
+
+
+@app.cli.command('verificar-vendas')
+@click.option('--usuario', type=int, default=None, help="Verifica só este usuário.")
+def verificar_vendas_comando(usuario):
+    """Compara as vendas consolidadas com o histórico de movimentações."""
+    divergencias = vendas.verificar(db, usuario)
+    for d in divergencias:
+        click.echo(f"usuario={d['usuario_id']} bebida={d['bebida_id']} dia={d['dia']} "
+                   f"consolidado={d['consolidado']} historico={d['historico']}")
+    click.echo(f"{len(divergencias)} divergência(s).")
+    if divergencias:
+        raise SystemExit(1)
+
+
+@app.cli.command('fotografar-estoque')
+@click.option('--dia', type=click.DateTime(['%Y-%m-%d']), default=None, help="Dia fotografado (padrão: ontem).")
+@click.option('--manter-dias', type=int, default=None,
+              help="Apaga as fotos mais antigas que isso, menos as de fim de mês.")
+def fotografar_estoque_comando(dia, manter_dias):
+    """Grava a posição do estoque no fim do dia (rodar todas as noites)."""
+    # O que mudou fora do histórico desde a última foto é absorvido pela nova: avisa antes
+    for d in posicoes.verificar(db):
+        click.echo(f"divergência: usuario={d['usuario_id']} bebida={d['bebida_id']} "
+                   f"esperado={d['esperado']} atual={d['atual']}")
+    click.echo(f"{posicoes.fotografar(db, dia.date() if dia else None)} posição(ões) gravada(s).")
+    if manter_dias is not None:
+        click.echo(f"{posicoes.podar(db, manter_dias)} posição(ões) antiga(s) apagada(s).")
+
+
+@app.cli.command('verificar-estoque')
+@click.option('--usuario', type=int, default=None, help="Verifica só este usuário.")
+def verificar_estoque_comando(usuario):
+    """Compara o saldo atual com a última foto do estoque mais o histórico."""
+    divergencias = posicoes.verificar(db, usuario)
+    for d in divergencias:
+        click.echo(f"usuario={d['usuario_id']} bebida={d['bebida_id']} ({d['nome']}) foto={d['dia']} "
+                   f"esperado={d['esperado']} atual={d['atual']}")
+    click.echo(f"{len(divergencias)} divergência(s).")
+    if divergencias:
+        raise SystemExit(1)
+
+
+@app.cli.command('arquivar')
+@click.option('--tabela', type=click.Choice(sorted(arquivamento.TABELAS)), default=None,
+              help="Arquiva só esta tabela (padrão: todas).")
+@click.option('--dias', type=int, default=None, help="Retenção em dias (padrão: ARQUIVAMENTO_RETENCAO_DIAS).")
+@click.option('--lote', type=int, default=10000, help="Linhas por arquivo/transação.")
+def arquivar_comando(tabela, dias, lote):
+    """Move as linhas mais velhas que a retenção para o arquivo morto."""
+    dias = app.config['ARQUIVAMENTO_RETENCAO_DIAS'] if dias is None else dias
+    for nome in [tabela] if tabela else sorted(arquivamento.TABELAS):
+        linhas = arquivamento.arquivar(db, nome, app.config['ARQUIVAMENTO_PASTA'], dias, lote)
+        click.echo(f"{nome}: {linhas} linha(s) arquivada(s).")
+
+
+@app.cli.command('restaurar-arquivo')
+@click.option('--tabela', type=click.Choice(sorted(arquivamento.TABELAS)), required=True)
+@click.option('--de', type=click.DateTime(['%Y-%m-%d']), default=None, help="Primeiro dia (padrão: o mais antigo).")
+@click.option('--ate', type=click.DateTime(['%Y-%m-%d']), default=None, help="Último dia (padrão: o mais novo).")
+def restaurar_arquivo_comando(tabela, de, ate):
+    """Devolve à tabela as linhas arquivadas dos meses do período."""
+    restauradas, descartadas = arquivamento.restaurar(db, tabela, app.config['ARQUIVAMENTO_PASTA'],
+                                                      de.date() if de else None, ate.date() if ate else None)
+    click.echo(f"{restauradas} linha(s) restaurada(s); {descartadas} descartada(s).")
+
+
+def consultas_indexadas():
+    """
+    (nome, sql, params) das consultas quentes das rotas e dos comandos, que
+    devem ser atendidas por índices (ver migracoes.verificar_indices). O SQL
+    sai dos mesmos construtores que as rotas usam, com parâmetros de exemplo;
+    os filtros de período dos históricos leem ?de=&ate= de uma requisição
+    simulada.
+    """
+    hoje = datetime.date.today()
+    mes = hoje - datetime.timedelta(days=30)
+    with app.test_request_context(query_string={'de': mes.isoformat(), 'ate': hoje.isoformat()}):
+        listagem = consulta_listagem(1)
+        movimentacoes = consulta_movimentacoes(1)
+        auditoria = consulta_auditoria()
+    cursor_historico = [datetime.datetime.now(), 0]
+    return [
+        ("login", SQL_LOGIN, ('x', 'x')),
+        ("listagem do painel", *consulta_pagina(*listagem, ['nome', 'id'], 50)),
+        ("listagem do painel, página seguinte", *consulta_pagina(*listagem, ['nome', 'id'], 50, ['x', 0])),
+        ("bebida por código (busca)", busca.SQL_CODIGO_EXATO, ('x', 1)),
+        ("bebida por código (API)", sincronizacao.SQL_POR_CODIGO, ('x', 1)),
+        ("alertas de estoque baixo", estoque.SQL_ALERTAS, (1,)),
+        ("categorias do usuário", SQL_CATEGORIAS, (1,)),
+        ("fornecedores do usuário", SQL_FORNECEDORES, (1,)),
+        ("histórico de movimentações", *consulta_pagina(*movimentacoes, ['m.data', 'm.id'], 50, crescente=False)),
+        ("histórico de movimentações, página seguinte",
+         *consulta_pagina(*movimentacoes, ['m.data', 'm.id'], 50, cursor_historico, crescente=False)),
+        ("histórico de auditoria", *consulta_pagina(*auditoria, ['a.data', 'a.id'], 50, crescente=False)),
+        ("histórico de auditoria, página seguinte",
+         *consulta_pagina(*auditoria, ['a.data', 'a.id'], 50, cursor_historico, crescente=False)),
+        ("relatório de vendas", *vendas.consulta_exportacao(db, 1, mes, hoje)),
+        ("consolidação das vendas", *vendas.consulta_consolidacao(hoje - datetime.timedelta(days=1), hoje)),
+        # O que a chave estrangeira roda ao excluir uma bebida (ON DELETE CASCADE)
+        ("movimentações de uma bebida", "DELETE FROM ONLY movimentacoes WHERE bebida_id = %s", (1,)),
+        ("fotos do estoque mais próximas", posicoes.SQL_FOTOS, {'usuario': 1, 'dia': mes}),
+        ("posição entre duas fotos",
+         *posicoes.consulta_posicao(1, mes, {'anterior': mes - datetime.timedelta(days=30), 'posterior': hoje})),
+        ("posição desde a última foto",
+         *posicoes.consulta_posicao(1, mes, {'anterior': mes - datetime.timedelta(days=30), 'posterior': None})),
+        ("eventos de alerta", *estoque.consulta_eventos_alerta(1)),
+        ("bebidas por vários códigos", sincronizacao.SQL_POR_CODIGOS, (1, ['x', 'y'])),
+        ("bebidas alteradas desde uma versão", *sincronizacao.consulta_alteracoes(1, 0, 0, 1001)),
+    ]
+
+
+@app.cli.command('verificar-indices')
+def verificar_indices_comando():
+    """Confere, via EXPLAIN, se as consultas das rotas usam índices."""
+    consultas = consultas_indexadas()
+    falhas = migracoes.verificar_indices(db, consultas)
+    for nome, tabelas in falhas:
+        click.echo(f"{nome}: varredura sequencial em {', '.join(tabelas)}")
+    click.echo(f"{len(consultas) - len(falhas)}/{len(consultas)} consultas usando índices.")
+    if falhas:
+        raise SystemExit(1)
+
+
+@app.cli.command('importar-bebidas')
+@click.argument('arquivo', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--usuario', type=int, required=True, help="Dono das bebidas importadas.")
+def importar_bebidas_comando(arquivo, usuario):
+    """Importa (ou atualiza) bebidas a partir de um CSV."""
+    resultado = catalogo.importar_csv(db, usuario, arquivo)
+    for linha, erro in resultado['erros']:
+        click.echo(f"linha {linha}: {erro}")
+    click.echo(f"{resultado['inseridas']} inserida(s), {resultado['atualizadas']} atualizada(s), "
+               f"{resultado['invalidas']} linha(s) inválida(s).")
+
+
+@app.cli.command('exportar-bebidas')
+@click.argument('arquivo', type=click.File('wb'), default='-')
+@click.option('--usuario', type=int, required=True, help="Dono das bebidas exportadas.")
+def exportar_bebidas_comando(arquivo, usuario):
+    """Exporta as bebidas de um usuário em CSV (para a saída padrão, sem ARQUIVO)."""
+    for bloco in catalogo.exportar_csv(db, usuario):
+        arquivo.write(bloco)
+
+
+@app.cli.command('processar-imagens')
+def processar_imagens_comando():
+    """Passa pelo pipeline as imagens antigas, gravadas pelo nome original."""
+    convertidas = 0
+    for bebida in db.executar("SELECT id, imagem_url FROM bebidas WHERE imagem_url IS NOT NULL", fetch='all'):
+        caminho = os.path.join(app.config['UPLOAD_FOLDER'], bebida['imagem_url'])
+        if variantes_imagem(bebida['imagem_url']) or not os.path.isfile(caminho):
+            continue
+        try:
+            nome = imagens.importar_arquivo(caminho)
+        except Exception as e:
+            click.echo(f"bebida {bebida['id']}: {bebida['imagem_url']} ignorada ({e})")
+            continue
+        db.executar("UPDATE bebidas SET imagem_url = %s WHERE id = %s", (nome, bebida['id']))
+        convertidas += 1
+    click.echo(f"{convertidas} imagem(ns) convertida(s).")
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True, port=5001)
@@ -0,0 +1,221 @@
+"""
+Arquivo morto de `movimentacoes` e `auditoria`.
+
+`arquivar` tira das tabelas as linhas mais velhas que a retenção, em lotes:
+cada lote é um COPY (DELETE ... RETURNING) gravado num arquivo CSV
+comprimido em <pasta>/<tabela>/<AAAA-MM>/, e o arquivo entra no índice
+`arquivamentos` na mesma transação do DELETE. Se algo falhar antes do
+commit, as linhas continuam na tabela e o arquivo, fora do índice, é
+apagado na próxima execução; linha nenhuma fica só no disco sem estar no
+índice, nem some dos dois.
+
+Para ler períodos arquivados, `fonte` carrega numa tabela temporária só
+as linhas do período (e do usuário) pedidos e devolve um trecho SQL que
+junta as duas. Os arquivos têm as linhas de todos os usuários, então o
+período é obrigatório: cada leitura descomprime só os meses dele. Os
+relatórios de vendas não precisam disso: antes de arquivar movimentações,
+as vendas são consolidadas (ver vendas.py) e o arquivamento nunca passa da
+consolidação. `restaurar` devolve as linhas às tabelas; as que continuarem
+mais velhas que a retenção voltam para o arquivo na execução seguinte.
+"""
+import datetime
+import gzip
+import os
+import uuid
+from contextlib import contextmanager
+
+import vendas
+
+# Chave do advisory lock que impede dois arquivamentos (ou restaurações) simultâneos
+CHAVE_LOCK = 7013
+
+TABELAS = {
+    'movimentacoes': ('id', 'bebida_id', 'tipo', 'quantidade', 'data', 'observacao', 'fornecedor_id', 'usuario_id'),
+    'auditoria': ('id', 'usuario_id', 'acao', 'data', 'detalhes'),
+}
+
+# Na volta, referências a registros que sumiram seguem as regras das chaves
+# estrangeiras: movimentação de bebida excluída é descartada (ON DELETE
+# CASCADE); fornecedor ou usuário excluído vira NULL (ON DELETE SET NULL)
+RESTAURAR = {
+    'movimentacoes': """
+        INSERT INTO movimentacoes (id, bebida_id, tipo, quantidade, data, observacao, fornecedor_id, usuario_id)
+        SELECT r.id, r.bebida_id, r.tipo, r.quantidade, r.data, r.observacao, f.id, u.id
+        FROM restauracao r
+                 LEFT JOIN bebidas b ON b.id = r.bebida_id
+                 LEFT JOIN fornecedores f ON f.id = r.fornecedor_id
+                 LEFT JOIN usuarios u ON u.id = r.usuario_id
+        WHERE r.bebida_id IS NULL OR b.id IS NOT NULL
+        ON CONFLICT (id) DO NOTHING""",
+    'auditoria': """
+        INSERT INTO auditoria (id, usuario_id, acao, data, detalhes)
+        SELECT r.id, u.id, r.acao, r.data, r.detalhes
+        FROM restauracao r
+                 LEFT JOIN usuarios u ON u.id = r.usuario_id
+        ON CONFLICT (id) DO NOTHING""",
+}
+
+
+def _verificar_tabela(tabela):
+    if tabela not in TABELAS:
+        raise ValueError(f"Tabela sem arquivamento: {tabela}")
+
+
+def _arquivos(db, tabela, de=None, ate=None):
+    return db.executar("""
+        SELECT id, mes, arquivo, linhas FROM arquivamentos
+        WHERE tabela = %(tabela)s
+          AND (%(de)s::date IS NULL OR mes >= date_trunc('month', %(de)s::date))
+          AND (%(ate)s::date IS NULL OR mes <= %(ate)s::date)
+        ORDER BY mes, id
+        """, {'tabela': tabela, 'de': de, 'ate': ate}, fetch='all')
+
+
+def _limpar_orfaos(db, tabela, pasta):
+    # Chamado com o lock: nenhum lote está gravando, então todo arquivo fora do índice é sobra de falha
+    diretorio = os.path.join(pasta, tabela)
+    if not os.path.isdir(diretorio):
+        return
+    conhecidos = {linha['arquivo'] for linha in db.executar(
+        "SELECT arquivo FROM arquivamentos WHERE tabela = %s", (tabela,), fetch='all')}
+    for raiz, _dirs, nomes in os.walk(diretorio):
+        for nome in nomes:
+            relativo = os.path.relpath(os.path.join(raiz, nome), pasta).replace(os.sep, '/')
+            if relativo not in conhecidos:
+                print(f"Removendo arquivo órfão do arquivamento: {relativo}")
+                os.remove(os.path.join(raiz, nome))
+
+
+def _gravar_lote(db, tabela, pasta, inicio, fim, lote):
+    """Move até `lote` linhas com data em [inicio, fim) para um arquivo novo; devolve quantas."""
+    relativo = f"{tabela}/{inicio:%Y-%m}/{uuid.uuid4().hex}.csv.gz"
+    caminho = os.path.join(pasta, relativo)
+    os.makedirs(os.path.dirname(caminho), exist_ok=True)
+    colunas = ', '.join(TABELAS[tabela])
+    with open(caminho, 'wb') as bruto:
+        with gzip.GzipFile(fileobj=bruto, mode='wb', compresslevel=6) as saida:
+            linhas = db.copiar_para_arquivo(f"""
+                COPY (
+                    DELETE FROM {tabela}
+                    WHERE id IN (SELECT id FROM {tabela}
+                                 WHERE data >= %s AND data < %s
+                                 ORDER BY data, id
+                                 LIMIT %s)
+                    RETURNING {colunas}
+                ) TO STDOUT WITH (FORMAT csv)""", saida, (inicio, fim, lote))
+        bruto.flush()
+        os.fsync(bruto.fileno())
+    if not linhas:
+        os.remove(caminho)
+        return 0
+    db.executar("INSERT INTO arquivamentos (tabela, mes, arquivo, linhas) VALUES (%s, %s, %s, %s)",
+                (tabela, inicio, relativo, linhas))
+    return linhas
+
+
+def arquivar(db, tabela, pasta, dias, lote=10000):
+    """
+    Arquiva as linhas de `tabela` com mais de `dias` dias, do mês mais antigo
+    para o mais novo, um lote por transação. Se outro arquivamento estiver
+    rodando, para sem erro. Devolve o número de linhas arquivadas.
+    """
+    _verificar_tabela(tabela)
+    corte = datetime.date.today() - datetime.timedelta(days=dias)
+    if tabela == 'movimentacoes':
+        # Os relatórios leem da consolidação tudo o que for anterior a ela
+        vendas.consolidar(db)
+        corte = min(corte, vendas.consolidado_ate(db) or corte)
+
+    with db.transacao():
+        if not db.executar("SELECT pg_try_advisory_xact_lock(%s) AS ok", (CHAVE_LOCK,), fetch='one')['ok']:
+            return 0
+        _limpar_orfaos(db, tabela, pasta)
+
+    arquivadas = 0
+    while True:
+        with db.transacao():
+            if not db.executar("SELECT pg_try_advisory_xact_lock(%s) AS ok", (CHAVE_LOCK,), fetch='one')['ok']:
+                return arquivadas
+            primeira = db.executar(f"SELECT MIN(data) AS data FROM {tabela} WHERE data < %s",
+                                   (corte,), fetch='one')['data']
+            if primeira is None:
+                db.executar("""
+                    INSERT INTO arquivamento_limites (tabela, arquivado_ate) VALUES (%s, %s)
+                    ON CONFLICT (tabela) DO UPDATE
+                        SET arquivado_ate = GREATEST(arquivamento_limites.arquivado_ate, EXCLUDED.arquivado_ate)
+                    """, (tabela, corte))
+                return arquivadas
+            inicio = primeira.date().replace(day=1)
+            proximo_mes = (inicio + datetime.timedelta(days=32)).replace(day=1)
+            arquivadas += _gravar_lote(db, tabela, pasta, inicio, min(proximo_mes, corte), lote)
+
+
+@contextmanager
+def fonte(db, tabela, pasta, de, ate, usuario_id=None):
+    """
+    Entrega o trecho SQL a usar no lugar de `tabela` para enxergar também as
+    linhas arquivadas com data entre os dias `de` e `ate` (inclusivos) e,
+    com `usuario_id`, só as desse usuário. Sem nada arquivado no período, é
+    a própria tabela. O bloco roda numa transação, e o trecho só vale
+    dentro dele.
+    """
+    _verificar_tabela(tabela)
+    if de is None or ate is None:
+        raise ValueError("A leitura do arquivo morto exige um período (de e até).")
+    filtro = "data >= %(de)s AND data < %(ate)s::date + 1"
+    if usuario_id is not None:
+        filtro += " AND usuario_id = %(usuario)s"
+    temporaria = f"{tabela}_arquivada"
+    # O índice é lido no primário, na mesma transação que lê a tabela
+    with db.transacao():
+        arquivos = _arquivos(db, tabela, de, ate)
+        if not arquivos:
+            yield tabela
+            return
+        db.executar(f"CREATE TEMP TABLE {temporaria} (LIKE {tabela}) ON COMMIT DROP")
+        for arquivo in arquivos:
+            with gzip.open(os.path.join(pasta, arquivo['arquivo']), 'rb') as entrada:
+                db.copiar_de(f"COPY {temporaria} ({', '.join(TABELAS[tabela])}) FROM STDIN WITH (FORMAT csv) "
+                             f"WHERE {filtro}", entrada, {'de': de, 'ate': ate, 'usuario': usuario_id})
+        db.executar(f"ANALYZE {temporaria}")
+        yield f"(SELECT * FROM {tabela} UNION ALL SELECT * FROM {temporaria})"
+
+
+def restaurar(db, tabela, pasta, de=None, ate=None):
+    """
+    Devolve à tabela as linhas arquivadas dos meses entre `de` e `ate`, um
+    arquivo por transação, e apaga os arquivos restaurados. Devolve
+    (restauradas, descartadas): descartadas são as que já existiam ou cuja
+    bebida foi excluída.
+    """
+    _verificar_tabela(tabela)
+    restauradas = descartadas = 0
+    for arquivo in _arquivos(db, tabela, de, ate):
+        with db.transacao():
+            db.executar("SELECT pg_advisory_xact_lock(%s)", (CHAVE_LOCK,))
+            if not db.executar("SELECT 1 FROM arquivamentos WHERE id = %s FOR UPDATE",
+                               (arquivo['id'],), fetch='one'):
+                continue
+            db.executar(f"CREATE TEMP TABLE restauracao (LIKE {tabela}) ON COMMIT DROP")
+            with gzip.open(os.path.join(pasta, arquivo['arquivo']), 'rb') as entrada:
+                lidas = db.copiar_de(f"COPY restauracao ({', '.join(TABELAS[tabela])}) FROM STDIN WITH (FORMAT csv)",
+                                     entrada)
+            inseridas = db.executar(RESTAURAR[tabela])
+            db.executar("DELETE FROM arquivamentos WHERE id = %s", (arquivo['id'],))
+        os.remove(os.path.join(pasta, arquivo['arquivo']))
+        restauradas += inseridas
+        descartadas += lidas - inseridas
+    return restauradas, descartadas
+
+
+def resumo(db):
+    """Por tabela: arquivos, linhas, mês mais antigo e mais novo e até onde foi arquivado."""
+    linhas = db.executar("""
+        SELECT a.tabela, COUNT(*) AS arquivos, SUM(a.linhas) AS linhas,
+               MIN(a.mes) AS primeiro_mes, MAX(a.mes) AS ultimo_mes, l.arquivado_ate
+        FROM arquivamentos a
+                 LEFT JOIN arquivamento_limites l USING (tabela)
+        GROUP BY a.tabela, l.arquivado_ate
+        """, fetch='all')
+    return {linha['tabela']: {chave: (valor.isoformat() if isinstance(valor, datetime.date) else valor)
+                              for chave, valor in linha.items() if chave != 'tabela'} for linha in linhas}
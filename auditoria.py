@@ -0,0 +1,160 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+POLITICAS = ('bloquear', 'descartar_novo', 'descartar_antigo')
+# De quanto em quanto tempo (segundos) a diferença entre os relógios do app e do banco é medida de novo
+RESSINCRONIZAR = 3600
+
+
+class GravadorAuditoria:
+    """
+    Grava os registros de auditoria em segundo plano. Os eventos entram numa
+    fila limitada e uma thread os insere em lotes (um INSERT de várias linhas)
+    quando o lote enche ou quando passa `intervalo` segundos, o que vier antes.
+
+    Com a fila cheia, `politica` decide: 'bloquear' espera vaga (até
+    `espera_max` segundos), 'descartar_novo' ignora o evento novo e
+    'descartar_antigo' abre espaço jogando fora o mais antigo. Os descartes
+    ficam nos contadores. Ao encerrar o processo a fila é esvaziada no banco.
+
+    A data de cada registro é a hora em que ele foi enfileirado, convertida
+    para o relógio do banco pela diferença medida entre os dois relógios:
+    fila cheia, espera e novas tentativas não atrasam a data, e os registros
+    ordenam junto com os gravados direto no banco.
+    """
+
+    def __init__(self, db, tamanho_fila=10000, tamanho_lote=500, intervalo=1.0,
+                 politica='descartar_novo', espera_max=1.0, tentativas=3):
+        if politica not in POLITICAS:
+            raise ValueError(f"Política de auditoria inválida: {politica}")
+        self.db = db
+        self.tamanho_lote = tamanho_lote
+        self.intervalo = intervalo
+        self.politica = politica
+        self.espera_max = espera_max
+        self.tentativas = tentativas
+        self.tamanho_fila = tamanho_fila
+        self._lock = threading.Lock()
+        self._desvio = None
+        self._medido_em = 0.0
+        self._contadores = {
+            'enfileirados': 0,
+            'gravados': 0,
+            'descartados': 0,
+            'perdidos': 0,
+            'lotes': 0,
+        }
+        self._iniciar()
+        atexit.register(self.encerrar)
+
+    def _iniciar(self):
+        self._pid = os.getpid()
+        self._fila = queue.Queue(maxsize=self.tamanho_fila)
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._laco, name='gravador-auditoria', daemon=True)
+        self._thread.start()
+
+    def _verificar_fork(self):
+        # Um processo filho herda a fila mas não a thread que a esvazia
+        if os.getpid() != self._pid:
+            with self._lock:
+                if os.getpid() != self._pid:
+                    self._iniciar()
+
+    def _contar(self, nome, n=1):
+        with self._lock:
+            self._contadores[nome] += n
+
+    def registrar(self, usuario_id, acao, detalhes=None):
+        self._verificar_fork()
+        # Hora no relógio do app; _gravar converte para o do banco
+        evento = (usuario_id, acao, detalhes, time.time())
+        try:
+            if self.politica == 'bloquear':
+                self._fila.put(evento, timeout=self.espera_max)
+            elif self.politica == 'descartar_novo':
+                self._fila.put_nowait(evento)
+            else:
+                while True:
+                    try:
+                        self._fila.put_nowait(evento)
+                        break
+                    except queue.Full:
+                        try:
+                            self._fila.get_nowait()
+                            self._fila.task_done()
+                            self._contar('descartados')
+                        except queue.Empty:
+                            pass
+        except queue.Full:
+            self._contar('descartados')
+            return
+        self._contar('enfileirados')
+
+    def _medir_relogio(self):
+        """Mede quanto o relógio do banco está à frente do relógio do app (segundos)."""
+        antes = time.time()
+        agora = self.db.executar("SELECT extract(epoch FROM clock_timestamp())::float8 AS agora", fetch='one')
+        depois = time.time()
+        self._desvio = agora['agora'] - (antes + depois) / 2
+        self._medido_em = time.monotonic()
+
+    def _laco(self):
+        while not (self._parar.is_set() and self._fila.empty()):
+            try:
+                lote = [self._fila.get(timeout=self.intervalo)]
+            except queue.Empty:
+                continue
+            prazo = time.monotonic() + self.intervalo
+            while len(lote) < self.tamanho_lote:
+                restante = 0 if self._parar.is_set() else prazo - time.monotonic()
+                try:
+                    lote.append(self._fila.get(timeout=restante) if restante > 0 else self._fila.get_nowait())
+                except queue.Empty:
+                    break
+            self._gravar(lote)
+            for _ in lote:
+                self._fila.task_done()
+
+    def _gravar(self, lote):
+        # O LEFT JOIN anula usuario_id de usuários excluídos enquanto o evento
+        # esperava na fila, em vez de derrubar o lote inteiro pela chave estrangeira.
+        for tentativa in range(self.tentativas):
+            try:
+                if self._desvio is None or time.monotonic() - self._medido_em > RESSINCRONIZAR:
+                    self._medir_relogio()
+                linhas = [(usuario_id, acao, detalhes, quando + self._desvio)
+                          for usuario_id, acao, detalhes, quando in lote]
+                # to_timestamp dá timestamptz, convertido para a coluna no fuso da sessão, como o CURRENT_TIMESTAMP
+                self.db.executar_lote("""
+                    INSERT INTO auditoria (usuario_id, acao, detalhes, data)
+                    SELECT u.id, v.acao, v.detalhes, to_timestamp(v.quando)
+                    FROM (VALUES %s) AS v (usuario_id, acao, detalhes, quando)
+                    LEFT JOIN usuarios u ON u.id = v.usuario_id
+                    """, linhas, valores=True, tamanho_pagina=self.tamanho_lote,
+                    template="(%s::integer, %s::text, %s::text, %s::float8)")
+                self._contar('gravados', len(lote))
+                self._contar('lotes')
+                return
+            except Exception as e:
+                print(f"Erro ao gravar lote de auditoria (tentativa {tentativa + 1}): {e}")
+                time.sleep(min(2 ** tentativa, 5))
+        self._contar('perdidos', len(lote))
+
+    def descarregar(self):
+        """Bloqueia até que todos os eventos já enfileirados estejam no banco."""
+        self._fila.join()
+
+    def encerrar(self):
+        self._parar.set()
+        self._thread.join(timeout=30)
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._contadores)
+        stats['na_fila'] = self._fila.qsize()
+        stats['politica'] = self.politica
+        return stats
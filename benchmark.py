@@ -0,0 +1,471 @@
+"""
+Carga sintética e benchmark das rotas principais.
+
+    # 1. popular um banco SÓ de benchmark (o nome precisa conter "bench")
+    DATABASE_URL=postgresql://postgres@localhost/estoque_bench \\
+        python benchmark.py semear --usuarios 3 --bebidas 20000 --anos 2 --movs-por-dia 300
+
+    # 2. rodar (dentro do processo, pelo test_client, ou contra um servidor com --url)
+    python benchmark.py rodar --sessoes 8 --duracao 30 --saida antes.json
+    python benchmark.py rodar --cenario busca --saida busca.json
+    python benchmark.py rodar --cenario vendedores --sessoes 50
+
+    # 3. comparar duas rodadas; sai com código 1 se alguma rota piorou além da tolerância
+    python benchmark.py comparar antes.json depois.json --tolerancia 0.15
+
+Os dados são gerados com generate_series e setseed, então a mesma escala
+produz sempre o mesmo banco. As sessões simuladas fazem login como
+bench_1..bench_N (senha "bench") e sorteiam rotas com pesos fixos a partir
+de uma semente, para que duas rodadas façam as mesmas requisições.
+"""
+import argparse
+import datetime
+import http.cookiejar
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+SENHA = 'bench'
+PALAVRAS = ['Cerveja', 'Vinho', 'Whisky', 'Vodka', 'Gin', 'Rum', 'Cachaça', 'Licor', 'Suco', 'Refrigerante',
+            'Água', 'Energético', 'Tequila', 'Espumante', 'Sake']
+MARCAS = ['Tinto', 'Branco', 'Rosé', 'Premium', 'Artesanal', 'Pilsen', 'IPA', 'Reserva', 'Ouro', 'Prata',
+          'Limão', 'Laranja', 'Uva', 'Maçã', 'Gelada']
+# Termos da busca, com erros de digitação e sem acentos de propósito
+TERMOS_BUSCA = ['cerveja', 'cervja', 'vinho tinto', 'cachaca', 'whiskey', 'agua', 'gin', 'ipa', 'refri',
+                'licor de laranja', 'B000123', 'premum', 'espumante rose', 'vodka limao']
+
+
+# --- SEMEADURA ---
+
+def semear(db, usuarios, bebidas, anos, movs_por_dia, semente):
+    from database import hash_senha
+    import vendas
+
+    inicio = time.perf_counter()
+    with db.transacao():
+        # A semente vale para a sessão: todos os random() abaixo ficam determinísticos
+        db.executar("SELECT setseed(%s)", (semente,))
+        for n in range(1, usuarios + 1):
+            usuario_id = db.executar("""
+                INSERT INTO usuarios (username, password_hash, nivel_acesso) VALUES (%s, %s, 'operador')
+                ON CONFLICT (username) DO UPDATE SET password_hash = EXCLUDED.password_hash
+                RETURNING id
+                """, (f"bench_{n}", hash_senha(SENHA)), fetch='one')['id']
+            db.executar("DELETE FROM bebidas WHERE usuario_id = %s", (usuario_id,))
+            db.executar("""
+                INSERT INTO categorias (nome, usuario_id)
+                SELECT unnest(%s::text[]), %s
+                ON CONFLICT (nome, usuario_id) DO NOTHING
+                """, (PALAVRAS, usuario_id))
+            db.executar("""
+                INSERT INTO fornecedores (nome, usuario_id)
+                SELECT 'Fornecedor ' || i, %s FROM generate_series(1, 20) AS i
+                ON CONFLICT (nome, usuario_id) DO NOTHING
+                """, (usuario_id,))
+            db.executar("""
+                INSERT INTO bebidas (codigo, nome, categoria_id, preco_custo, preco_venda, quantidade,
+                                     quantidade_minima, usuario_id, criada_em)
+                SELECT 'B' || lpad(i::text, 6, '0'),
+                       p.palavra || ' ' || m.marca || ' ' || i,
+                       c.id,
+                       round((2 + random() * 60)::numeric, 2),
+                       round((4 + random() * 120)::numeric, 2),
+                       (random() * 500)::int,
+                       (random() * 30)::int,
+                       %(usuario)s,
+                       now() - %(dias)s * interval '1 day'
+                FROM generate_series(1, %(bebidas)s) AS i
+                         CROSS JOIN LATERAL (SELECT (%(palavras)s::text[])[1 + (i %% %(n_palavras)s)] AS palavra) p
+                         CROSS JOIN LATERAL (SELECT (%(marcas)s::text[])[1 + ((i / 7) %% %(n_marcas)s)] AS marca) m
+                         JOIN categorias c ON c.nome = p.palavra AND c.usuario_id = %(usuario)s
+                """, {'usuario': usuario_id, 'bebidas': bebidas, 'palavras': PALAVRAS, 'n_palavras': len(PALAVRAS),
+                      'marcas': MARCAS, 'n_marcas': len(MARCAS), 'dias': int(anos * 365)})
+            # Movimentações espalhadas pelos últimos `anos`, com mais saídas que entradas
+            db.executar("""
+                INSERT INTO movimentacoes (bebida_id, tipo, quantidade, data, observacao, fornecedor_id, usuario_id)
+                SELECT b.id,
+                       CASE WHEN r < 0.7 THEN 'saida' WHEN r < 0.95 THEN 'entrada' ELSE 'ajuste' END,
+                       1 + (random() * 12)::int,
+                       now() - (random() * %(dias)s) * interval '1 day',
+                       NULL,
+                       NULL,
+                       %(usuario)s
+                FROM (SELECT random() AS r, 1 + (random() * (%(bebidas)s - 1))::int AS n
+                      FROM generate_series(1, %(total)s)) AS s
+                         JOIN bebidas b ON b.codigo = 'B' || lpad(s.n::text, 6, '0') AND b.usuario_id = %(usuario)s
+                """, {'usuario': usuario_id, 'bebidas': bebidas, 'dias': int(anos * 365),
+                      'total': int(anos * 365 * movs_por_dia)})
+    db.executar("ANALYZE")
+    vendas.consolidar(db)
+    return time.perf_counter() - inicio
+
+
+def escala(db):
+    linhas = db.executar("""
+        SELECT (SELECT COUNT(*) FROM usuarios WHERE username LIKE 'bench\\_%%') AS usuarios,
+               (SELECT COUNT(*) FROM bebidas) AS bebidas,
+               (SELECT COUNT(*) FROM movimentacoes) AS movimentacoes,
+               (SELECT COUNT(*) FROM auditoria) AS auditoria
+        """, fetch='one')
+    return dict(linhas)
+
+
+# --- CLIENTES ---
+
+class ClienteLocal:
+    """Sessão pelo test_client do Flask: mede aplicação + banco, sem rede."""
+
+    def __init__(self, app):
+        self._cliente = app.test_client()
+
+    def get(self, caminho):
+        r = self._cliente.get(caminho)
+        return r.status_code, r.get_data(as_text=True)
+
+    def post(self, caminho, dados=None, json_=None):
+        r = self._cliente.post(caminho, data=dados, json=json_)
+        return r.status_code, r.get_data(as_text=True)
+
+
+class _SemRedirecionar(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ClienteHTTP:
+    """Sessão HTTP de verdade (cookies próprios, sem seguir redirecionamentos)."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self._abrir = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _SemRedirecionar()).open
+
+    def _pedir(self, requisicao):
+        try:
+            with self._abrir(requisicao, timeout=60) as r:
+                return r.status, r.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode('utf-8', 'replace')
+
+    def get(self, caminho):
+        return self._pedir(urllib.request.Request(self.url + caminho))
+
+    def post(self, caminho, dados=None, json_=None):
+        if json_ is not None:
+            corpo, tipo = json.dumps(json_).encode(), 'application/json'
+        else:
+            corpo, tipo = urllib.parse.urlencode(dados or {}).encode(), 'application/x-www-form-urlencoded'
+        return self._pedir(urllib.request.Request(self.url + caminho, data=corpo, headers={'Content-Type': tipo}))
+
+
+# --- CENÁRIOS ---
+
+def _codigo(rnd, bebidas):
+    return f"B{rnd.randint(1, bebidas):06d}"
+
+
+def _listagem_pagina2(cliente, rnd, bebidas):
+    _status, html = cliente.get('/')
+    achou = re.search(r'href="(/\?[^"]*apos=[^"]+)"', html)
+    if not achou:
+        return None
+    return cliente.get(achou.group(1).replace('&amp;', '&'))
+
+
+def _movimentar(cliente, rnd, bebidas):
+    tipo = 'saida' if rnd.random() < 0.7 else 'entrada'
+    return cliente.post('/movimentacoes', {'codigo_bebida': _codigo(rnd, bebidas), 'quantidade': rnd.randint(1, 3),
+                                           'tipo': tipo, 'observacao': 'benchmark', 'fornecedor_id': ''})
+
+
+def _relatorio(cliente, rnd, bebidas):
+    fim = datetime.date.today() - datetime.timedelta(days=rnd.randint(0, 60))
+    inicio = fim - datetime.timedelta(days=rnd.choice([7, 30, 90, 365]))
+    return cliente.post('/relatorios', {'data_inicio': inicio.isoformat(), 'data_fim': fim.isoformat()})
+
+
+def _lote(cliente, rnd, bebidas):
+    linhas = [{'codigo': _codigo(rnd, bebidas), 'tipo': 'entrada', 'quantidade': 1} for _ in range(100)]
+    return cliente.post('/api/movimentacoes/lote', json_={'linhas': linhas})
+
+
+# (nome, peso, função(cliente, rnd, bebidas) -> (status, corpo) ou None para não contar)
+CENARIOS = {
+    'misto': [
+        ('index', 30, lambda c, rnd, n: c.get('/')),
+        ('index_pagina2', 8, _listagem_pagina2),
+        ('index_busca', 15, lambda c, rnd, n: c.get('/?busca=' + urllib.parse.quote(rnd.choice(TERMOS_BUSCA)))),
+        ('movimentar', 20, _movimentar),
+        ('movimentar_lote', 3, _lote),
+        ('historico_movimentacoes', 10, lambda c, rnd, n: c.get('/historico-movimentacoes')),
+        ('relatorios', 6, _relatorio),
+        ('api_alertas', 8, lambda c, rnd, n: c.get('/api/alertas')),
+    ],
+    'busca': [
+        ('index_busca', 1, lambda c, rnd, n: c.get('/?busca=' + urllib.parse.quote(rnd.choice(TERMOS_BUSCA)))),
+        ('index_codigo_exato', 1, lambda c, rnd, n: c.get('/?busca=' + _codigo(rnd, n))),
+    ],
+}
+
+
+def percentil(ordenados, p):
+    if not ordenados:
+        return None
+    return ordenados[min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados) + 0.5)) - 1))]
+
+
+def resumir(amostras, duracao):
+    resultado = {}
+    for nome, medidas in sorted(amostras.items()):
+        tempos = sorted(t for t, _ok in medidas)
+        resultado[nome] = {
+            'requisicoes': len(medidas),
+            'erros': sum(1 for _t, ok in medidas if not ok),
+            'por_segundo': round(len(medidas) / duracao, 2),
+            'media_ms': round(sum(tempos) / len(tempos) * 1000, 2),
+            'p50_ms': round(percentil(tempos, 50) * 1000, 2),
+            'p95_ms': round(percentil(tempos, 95) * 1000, 2),
+            'p99_ms': round(percentil(tempos, 99) * 1000, 2),
+        }
+    return resultado
+
+
+def novo_cliente(args, app):
+    cliente = ClienteHTTP(args.url) if args.url else ClienteLocal(app)
+    return cliente
+
+
+def entrar(cliente, n):
+    status, _ = cliente.post('/login', {'username': f"bench_{n}", 'password': SENHA})
+    if status not in (200, 302):
+        raise SystemExit(f"Login de bench_{n} falhou (HTTP {status}). O banco foi semeado?")
+
+
+def rodar_misto(args, app, bebidas):
+    rotas = CENARIOS[args.cenario]
+    pesos = [peso for _nome, peso, _f in rotas]
+    amostras = {nome: [] for nome, _peso, _f in rotas}
+    lock = threading.Lock()
+    prazo = time.monotonic() + args.aquecimento + args.duracao
+
+    def sessao(i):
+        rnd = random.Random(args.semente * 1000 + i)
+        cliente = novo_cliente(args, app)
+        entrar(cliente, 1 + i % args.usuarios)
+        medir_a_partir = time.monotonic() + args.aquecimento
+        while time.monotonic() < prazo:
+            nome, _peso, funcao = rnd.choices(rotas, weights=pesos)[0]
+            inicio = time.perf_counter()
+            try:
+                resposta = funcao(cliente, rnd, bebidas)
+                ok = resposta is None or resposta[0] < 500
+            except Exception as e:
+                print(f"{nome}: {e}", file=sys.stderr)
+                resposta, ok = (0, ''), False
+            decorrido = time.perf_counter() - inicio
+            if resposta is not None and time.monotonic() >= medir_a_partir:
+                with lock:
+                    amostras[nome].append((decorrido, ok))
+
+    threads = [threading.Thread(target=sessao, args=(i,)) for i in range(args.sessoes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {'rotas': resumir({k: v for k, v in amostras.items() if v}, args.duracao)}
+
+
+def rodar_vendedores(args, app, db):
+    """
+    Todas as sessões vendem, uma unidade por vez, o mesmo código até o
+    estoque acabar. Confere se o total vendido bate exatamente com o
+    estoque inicial (nenhuma venda perdida nem acima do saldo).
+    """
+    estoque_inicial = args.estoque
+    codigo = 'B000001'
+    usuario = db.executar("SELECT id FROM usuarios WHERE username = 'bench_1'", fetch='one')['id']
+    db.executar("UPDATE bebidas SET quantidade = %s WHERE codigo = %s AND usuario_id = %s",
+                (estoque_inicial, codigo, usuario))
+    antes = db.executar("""
+        SELECT COUNT(*) AS n FROM movimentacoes m JOIN bebidas b ON b.id = m.bebida_id
+        WHERE b.codigo = %s AND b.usuario_id = %s AND m.tipo = 'saida'
+        """, (codigo, usuario), fetch='one')['n']
+    amostras = {'vender': []}
+    lock = threading.Lock()
+    barreira = threading.Barrier(args.sessoes)
+
+    def vendedor(_i):
+        cliente = novo_cliente(args, app)
+        entrar(cliente, 1)
+        barreira.wait()
+        while True:
+            inicio = time.perf_counter()
+            status, _ = cliente.post('/movimentacoes', {'codigo_bebida': codigo, 'quantidade': 1, 'tipo': 'saida',
+                                                        'observacao': 'benchmark', 'fornecedor_id': ''})
+            decorrido = time.perf_counter() - inicio
+            with lock:
+                amostras['vender'].append((decorrido, status < 500))
+            # Vendas sem saldo também respondem 302 (de volta ao formulário): quem decide o fim é o estoque
+            if status >= 500 or db.executar("SELECT quantidade FROM bebidas WHERE codigo = %s AND usuario_id = %s",
+                                            (codigo, usuario), fetch='one')['quantidade'] <= 0:
+                break
+
+    inicio = time.monotonic()
+    threads = [threading.Thread(target=vendedor, args=(i,)) for i in range(args.sessoes)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duracao = time.monotonic() - inicio
+    final = db.executar("SELECT quantidade FROM bebidas WHERE codigo = %s AND usuario_id = %s",
+                        (codigo, usuario), fetch='one')['quantidade']
+    vendidas = db.executar("""
+        SELECT COUNT(*) AS n FROM movimentacoes m JOIN bebidas b ON b.id = m.bebida_id
+        WHERE b.codigo = %s AND b.usuario_id = %s AND m.tipo = 'saida'
+        """, (codigo, usuario), fetch='one')['n'] - antes
+    consistente = final == 0 and vendidas == estoque_inicial
+    return {'rotas': resumir(amostras, duracao),
+            'vendedores': {'estoque_inicial': estoque_inicial, 'vendidas': vendidas, 'estoque_final': final,
+                           'consistente': consistente}}
+
+
+def commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# --- COMPARAÇÃO ---
+
+def comparar(base, novo, tolerancia):
+    """Devolve [(rota, métrica, antes, depois, variação)] das rotas que pioraram além da tolerância."""
+    regressoes = []
+    for rota, depois in novo['rotas'].items():
+        antes = base['rotas'].get(rota)
+        if not antes:
+            continue
+        for metrica in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if antes[metrica] and depois[metrica] > antes[metrica] * (1 + tolerancia):
+                regressoes.append((rota, metrica, antes[metrica], depois[metrica],
+                                   depois[metrica] / antes[metrica] - 1))
+        if antes['por_segundo'] and depois['por_segundo'] < antes['por_segundo'] * (1 - tolerancia):
+            regressoes.append((rota, 'por_segundo', antes['por_segundo'], depois['por_segundo'],
+                               depois['por_segundo'] / antes['por_segundo'] - 1))
+    return regressoes
+
+
+def imprimir(resultado):
+    print(f"{'rota':<26}{'req':>8}{'erros':>7}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}  (ms)")
+    for rota, r in resultado['rotas'].items():
+        print(f"{rota:<26}{r['requisicoes']:>8}{r['erros']:>7}{r['por_segundo']:>9}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}")
+    if 'vendedores' in resultado:
+        v = resultado['vendedores']
+        print(f"vendedores: estoque inicial {v['estoque_inicial']}, vendidas {v['vendidas']}, "
+              f"estoque final {v['estoque_final']} -> {'OK' if v['consistente'] else 'INCONSISTENTE'}")
+
+
+def _banco_de_benchmark(forcar):
+    url = os.getenv('DATABASE_URL', '')
+    nome = urllib.parse.urlparse(url).path.lstrip('/')
+    if 'bench' not in nome and not forcar:
+        raise SystemExit(f"O banco '{nome}' não parece ser de benchmark (o nome deve conter 'bench'). "
+                         "Use --forcar se tiver certeza.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Carga sintética e benchmark das rotas.")
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    p = sub.add_parser('semear', help="Popula o banco de DATABASE_URL com dados sintéticos.")
+    p.add_argument('--usuarios', type=int, default=3)
+    p.add_argument('--bebidas', type=int, default=10000, help="Bebidas por usuário.")
+    p.add_argument('--anos', type=float, default=1.0, help="Anos de histórico de movimentações.")
+    p.add_argument('--movs-por-dia', type=int, default=200, help="Movimentações por dia, por usuário.")
+    p.add_argument('--semente', type=float, default=0.42)
+    p.add_argument('--forcar', action='store_true', help="Aceita um banco cujo nome não contém 'bench'.")
+
+    p = sub.add_parser('rodar', help="Dispara sessões concorrentes contra as rotas.")
+    p.add_argument('--cenario', choices=sorted(CENARIOS) + ['vendedores'], default='misto')
+    p.add_argument('--sessoes', type=int, default=8)
+    p.add_argument('--duracao', type=float, default=20.0, help="Segundos medidos.")
+    p.add_argument('--aquecimento', type=float, default=3.0, help="Segundos iniciais descartados.")
+    p.add_argument('--usuarios', type=int, default=None, help="Quantos usuários bench_N usar (padrão: todos).")
+    p.add_argument('--estoque', type=int, default=200, help="Estoque inicial no cenário vendedores.")
+    p.add_argument('--semente', type=int, default=1)
+    p.add_argument('--url', help="Servidor já rodando (ex.: http://localhost:5001); sem ele usa o test_client.")
+    p.add_argument('--saida', help="Grava o resultado neste JSON.")
+    p.add_argument('--forcar', action='store_true')
+
+    p = sub.add_parser('comparar', help="Compara duas rodadas gravadas com --saida.")
+    p.add_argument('base')
+    p.add_argument('novo')
+    p.add_argument('--tolerancia', type=float, default=0.10, help="Piora relativa aceita (0.10 = 10%%).")
+
+    args = parser.parse_args(argv)
+
+    if args.comando == 'comparar':
+        with open(args.base) as f:
+            base = json.load(f)
+        with open(args.novo) as f:
+            novo = json.load(f)
+        imprimir(novo)
+        regressoes = comparar(base, novo, args.tolerancia)
+        for rota, metrica, antes, depois, variacao in regressoes:
+            print(f"REGRESSÃO {rota} {metrica}: {antes} -> {depois} ({variacao:+.0%})")
+        print(f"{len(regressoes)} regressão(ões) acima de {args.tolerancia:.0%}.")
+        return 1 if regressoes else 0
+
+    _banco_de_benchmark(args.forcar)
+    if args.comando == 'semear':
+        from database import Database
+        db = Database()
+        duracao = semear(db, args.usuarios, args.bebidas, args.anos, args.movs_por_dia, args.semente)
+        print(f"Banco semeado em {duracao:.1f}s: {escala(db)}")
+        db.close()
+        return 0
+
+    import app as aplicacao
+    db = aplicacao.db
+    dados = escala(db)
+    if not dados['usuarios']:
+        raise SystemExit("Nenhum usuário bench_N encontrado: rode 'python benchmark.py semear' antes.")
+    args.usuarios = min(args.usuarios or dados['usuarios'], dados['usuarios'])
+    bebidas = db.executar("""
+        SELECT COUNT(*) AS n FROM bebidas b JOIN usuarios u ON u.id = b.usuario_id WHERE u.username = 'bench_1'
+        """, fetch='one')['n']
+    if args.cenario == 'vendedores':
+        resultado = rodar_vendedores(args, aplicacao.app, db)
+    else:
+        resultado = rodar_misto(args, aplicacao.app, bebidas)
+    resultado['execucao'] = {
+        'data': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit_atual(),
+        'cenario': args.cenario,
+        'sessoes': args.sessoes,
+        'duracao': args.duracao,
+        'modo': 'http' if args.url else 'test_client',
+        'escala': dados,
+    }
+    imprimir(resultado)
+    if args.saida:
+        with open(args.saida, 'w') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"Resultado gravado em {args.saida}")
+    if 'vendedores' in resultado and not resultado['vendedores']['consistente']:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+"""
+Busca de bebidas por nome ou código.
+
+Com as extensões pg_trgm e unaccent (ver a migração VERSAO_BUSCA) a busca
+usa índices GIN de trigramas sobre o texto sem acentos, aceita erros de
+digitação e ordena por relevância. Sem elas, cai no LIKE simples.
+"""
+
+# Normalização usada tanto nos índices quanto nas consultas: as duas têm que bater
+NOME_NORMALIZADO = "f_unaccent(lower(b.nome))"
+CODIGO_NORMALIZADO = "lower(b.codigo)"
+
+
+def escapar_like(termo):
+    return termo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+SQL_CODIGO_EXATO = "SELECT id FROM bebidas WHERE codigo = %s AND usuario_id = %s"
+
+
+def codigo_exato(db, usuario_id, termo):
+    """
+    Atalho para leitores de código de barras: se o termo é exatamente o
+    código de uma bebida, devolve o id dela (busca pela UNIQUE (codigo, usuario_id)).
+    """
+    linha = db.executar(SQL_CODIGO_EXATO, (termo, usuario_id), fetch='one')
+    return linha['id'] if linha else None
+
+
+def montar(termo, indexada):
+    """
+    Devolve (coluna_relevancia, params_relevancia, filtro, params_filtro).
+
+    `coluna_relevancia` é uma expressão para o SELECT (apelidada de
+    "distancia": 0 é o melhor resultado) e `filtro` um trecho "AND (...)"
+    para o WHERE. A distância é arredondada para numeric para poder viajar
+    num cursor de paginação sem perder precisão.
+    """
+    padrao = f"%{escapar_like(termo.lower())}%"
+    if not indexada:
+        return ("0::numeric AS distancia", [],
+                f" AND (LOWER(b.nome) LIKE %s OR {CODIGO_NORMALIZADO} LIKE %s)", [padrao, padrao])
+
+    coluna = (f"round((1 - GREATEST(word_similarity(f_unaccent(lower(%s)), {NOME_NORMALIZADO}),"
+              f" similarity(lower(%s), {CODIGO_NORMALIZADO})))::numeric, 4) AS distancia")
+    filtro = (f" AND ({NOME_NORMALIZADO} LIKE f_unaccent(%s)"
+              f" OR {CODIGO_NORMALIZADO} LIKE %s"
+              f" OR f_unaccent(lower(%s)) <%% {NOME_NORMALIZADO})")
+    return coluna, [termo, termo], filtro, [padrao, padrao, termo]
@@ -0,0 +1,175 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class CacheLocal:
+    """
+    LRU em memória, por processo, com validade por item. Em implantações com
+    vários processos cada um tem o seu: uma invalidação só vale para o
+    processo que a fez, e os outros enxergam a mudança ao fim do TTL.
+    """
+
+    def __init__(self, capacidade=1024):
+        self.capacidade = capacidade
+        self._itens = OrderedDict()
+        # Quantas vezes cada chave foi removida (ver Cache.buscar)
+        self._geracoes = {}
+        self._lock = threading.Lock()
+
+    def geracao(self, chave):
+        with self._lock:
+            return self._geracoes.get(chave, 0)
+
+    def obter(self, chave):
+        with self._lock:
+            item = self._itens.get(chave)
+            if item is None:
+                return False, None
+            valor, expira_em = item
+            if expira_em < time.monotonic():
+                del self._itens[chave]
+                return False, None
+            self._itens.move_to_end(chave)
+            return True, valor
+
+    def gravar(self, chave, valor, ttl, geracao=None):
+        """Grava, a não ser que a chave tenha sido removida desde `geracao`; devolve se gravou."""
+        with self._lock:
+            if geracao is not None and self._geracoes.get(chave, 0) != geracao:
+                return False
+            self._itens[chave] = (valor, time.monotonic() + ttl)
+            self._itens.move_to_end(chave)
+            while len(self._itens) > self.capacidade:
+                self._itens.popitem(last=False)
+            return True
+
+    def remover(self, chave):
+        with self._lock:
+            self._itens.pop(chave, None)
+            self._geracoes[chave] = self._geracoes.get(chave, 0) + 1
+
+
+class CacheRedis:
+    """
+    Cache compartilhado entre processos (e máquinas) num Redis. Os valores
+    são gravados em JSON, então precisam ser listas/dicionários simples.
+    """
+
+    def __init__(self, url, prefixo='pjs:'):
+        if redis is None:
+            raise RuntimeError("CACHE_BACKEND=redis exige o pacote 'redis' instalado.")
+        self._cliente = redis.Redis.from_url(url)
+        self.prefixo = prefixo
+
+    def obter(self, chave):
+        bruto = self._cliente.get(self.prefixo + chave)
+        if bruto is None:
+            return False, None
+        return True, json.loads(bruto)
+
+    def geracao(self, chave):
+        return int(self._cliente.get(self.prefixo + 'geracao:' + chave) or 0)
+
+    def gravar(self, chave, valor, ttl, geracao=None):
+        bruto = json.dumps(valor, default=str)
+        if geracao is None:
+            self._cliente.set(self.prefixo + chave, bruto, ex=max(int(ttl), 1))
+            return True
+        # WATCH: uma remoção entre a leitura da geração e o SET cancela a gravação
+        with self._cliente.pipeline() as pipe:
+            try:
+                pipe.watch(self.prefixo + 'geracao:' + chave)
+                if int(pipe.get(self.prefixo + 'geracao:' + chave) or 0) != geracao:
+                    return False
+                pipe.multi()
+                pipe.set(self.prefixo + chave, bruto, ex=max(int(ttl), 1))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def remover(self, chave):
+        with self._cliente.pipeline() as pipe:
+            pipe.delete(self.prefixo + chave)
+            pipe.incr(self.prefixo + 'geracao:' + chave)
+            # Só precisa durar mais que uma leitura do banco
+            pipe.expire(self.prefixo + 'geracao:' + chave, 86400)
+            pipe.execute()
+
+
+class Cache:
+    """
+    Cache de listas de referência (categorias, fornecedores...) que mudam
+    pouco e são lidas em quase toda página. Os itens vencem após `ttl`
+    segundos e as rotas que alteram os dados chamam `invalidar` logo depois
+    do commit. Falhas do backend nunca derrubam a requisição: o valor é
+    carregado direto do banco.
+
+    Cada remoção avança a geração da chave, e um valor carregado só é gravado
+    se a geração não mudou durante a carga: uma leitura que começou antes de
+    um commit não deixa a lista velha no cache até o fim do TTL. Com o
+    backend local a invalidação vale só para o processo que a fez (ver
+    CacheLocal); com vários processos, use CACHE_BACKEND=redis.
+    """
+
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._contadores = {'acertos': 0, 'faltas': 0, 'invalidacoes': 0, 'descartes': 0, 'erros': 0}
+
+    def _contar(self, nome):
+        with self._lock:
+            self._contadores[nome] += 1
+
+    def buscar(self, chave, carregar):
+        try:
+            achou, valor = self.backend.obter(chave)
+            # Lida antes da carga: uma invalidação durante ela impede a gravação
+            geracao = None if achou else self.backend.geracao(chave)
+        except Exception as e:
+            print(f"Erro no cache ao ler '{chave}': {e}")
+            self._contar('erros')
+            return carregar()
+        if achou:
+            self._contar('acertos')
+            return valor
+        self._contar('faltas')
+        valor = carregar()
+        try:
+            if not self.backend.gravar(chave, valor, self.ttl, geracao):
+                self._contar('descartes')
+        except Exception as e:
+            print(f"Erro no cache ao gravar '{chave}': {e}")
+            self._contar('erros')
+        return valor
+
+    def invalidar(self, *chaves):
+        for chave in chaves:
+            try:
+                self.backend.remover(chave)
+                self._contar('invalidacoes')
+            except Exception as e:
+                print(f"Erro no cache ao invalidar '{chave}': {e}")
+                self._contar('erros')
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._contadores)
+        consultas = stats['acertos'] + stats['faltas']
+        stats['taxa_acerto'] = stats['acertos'] / consultas if consultas else 0.0
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+
+def criar_cache(backend='local', url=None, ttl=300, capacidade=1024):
+    if backend == 'redis':
+        return Cache(CacheRedis(url or 'redis://localhost:6379/0'), ttl)
+    return Cache(CacheLocal(capacidade), ttl)
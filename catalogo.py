@@ -0,0 +1,191 @@
+"""
+Importação e exportação do catálogo de bebidas em CSV.
+
+A importação valida cada linha em Python, manda as válidas em blocos por
+COPY para uma tabela temporária e aplica tudo de uma vez com um upsert em
+(codigo, usuario_id). Linhas inválidas são relatadas e puladas, sem
+abortar o restante. A exportação sai direto de um COPY ... TO STDOUT.
+"""
+import csv
+import io
+import math
+
+import estoque
+
+COLUNAS = ['codigo', 'nome', 'categoria', 'preco_custo', 'preco_venda', 'quantidade', 'quantidade_minima']
+OBRIGATORIAS = {'codigo', 'nome'}
+# Erros detalhados guardados no relatório; além disso, só a contagem
+MAX_ERROS_DETALHADOS = 1000
+# Maiores valores que cabem nas colunas: INTEGER e REAL (float4) do PostgreSQL
+MAX_INTEIRO = 2 ** 31 - 1
+MAX_REAL = 3.4028234663852886e38
+
+
+def _numero(valor, conversor):
+    valor = (valor or '').strip()
+    if valor == '':
+        return None
+    # Aceita vírgula decimal, como nas planilhas em português
+    return conversor(valor.replace('.', '').replace(',', '.') if ',' in valor else valor)
+
+
+def validar_linha(linha):
+    """
+    Converte uma linha do CSV (dicionário coluna -> texto) na tupla que vai
+    para a tabela temporária. Levanta ValueError com a mensagem do problema.
+    """
+    codigo = (linha.get('codigo') or '').strip()
+    nome = (linha.get('nome') or '').strip()
+    if not codigo:
+        raise ValueError("código vazio")
+    if not nome:
+        raise ValueError("nome vazio")
+    valores = [codigo, nome, (linha.get('categoria') or '').strip() or None]
+    # NUL não existe em texto UTF-8 do PostgreSQL: o COPY recusaria o lote inteiro
+    for coluna, texto in zip(('codigo', 'nome', 'categoria'), valores):
+        if texto is not None and '\x00' in texto:
+            raise ValueError(f"{coluna} com caractere NUL")
+    for coluna, conversor in (('preco_custo', float), ('preco_venda', float),
+                              ('quantidade', int), ('quantidade_minima', int)):
+        try:
+            numero = _numero(linha.get(coluna), conversor)
+        except ValueError:
+            raise ValueError(f"{coluna} inválido: {linha.get(coluna)!r}")
+        if numero is not None:
+            # nan, inf e valores fora da coluna abortariam o lote inteiro no banco
+            if isinstance(numero, float) and not math.isfinite(numero):
+                raise ValueError(f"{coluna} inválido: {linha.get(coluna)!r}")
+            if numero < 0:
+                raise ValueError(f"{coluna} negativo: {numero}")
+            if numero > (MAX_REAL if conversor is float else MAX_INTEIRO):
+                raise ValueError(f"{coluna} grande demais: {linha.get(coluna)!r}")
+        valores.append(numero)
+    return valores
+
+
+def importar_csv(db, usuario_id, arquivo, tamanho_bloco=5000):
+    """
+    Importa o CSV lido de `arquivo` (texto). A primeira linha deve ter os
+    nomes das colunas (ver COLUNAS; só codigo e nome são obrigatórias) e o
+    separador pode ser vírgula ou ponto e vírgula. Colunas ausentes ou
+    vazias mantêm o valor atual das bebidas já existentes.
+
+    Tudo roda numa transação: ou o lote válido entra inteiro, ou nada entra.
+    Devolve {'inseridas', 'atualizadas', 'invalidas', 'erros': [(linha, msg)]}.
+    """
+    cabecalho = arquivo.readline()
+    separador = ';' if cabecalho.count(';') > cabecalho.count(',') else ','
+    colunas = [c.strip().lower() for c in next(csv.reader([cabecalho], delimiter=separador))]
+    faltando = OBRIGATORIAS - set(colunas)
+    if faltando:
+        raise ValueError(f"Coluna(s) obrigatória(s) ausente(s) no CSV: {', '.join(sorted(faltando))}")
+
+    resultado = {'inseridas': 0, 'atualizadas': 0, 'invalidas': 0, 'erros': []}
+    with db.transacao():
+        estoque.reservar_alertas(db, usuario_id)
+        db.executar("""
+            CREATE TEMP TABLE importacao_bebidas
+            (
+                linha INTEGER, codigo TEXT, nome TEXT, categoria TEXT, preco_custo REAL,
+                preco_venda REAL, quantidade INTEGER, quantidade_minima INTEGER
+            ) ON COMMIT DROP""")
+
+        bloco, escritor, no_bloco = io.StringIO(), None, 0
+        for numero, linha in enumerate(csv.DictReader(arquivo, fieldnames=colunas, delimiter=separador), start=2):
+            try:
+                valores = validar_linha(linha)
+            except ValueError as e:
+                resultado['invalidas'] += 1
+                if len(resultado['erros']) < MAX_ERROS_DETALHADOS:
+                    resultado['erros'].append((numero, str(e)))
+                continue
+            if escritor is None:
+                escritor = csv.writer(bloco)
+            escritor.writerow([numero] + ['' if v is None else v for v in valores])
+            no_bloco += 1
+            if no_bloco >= tamanho_bloco:
+                bloco.seek(0)
+                db.copiar_de("COPY importacao_bebidas FROM STDIN WITH (FORMAT csv)", bloco)
+                bloco, escritor, no_bloco = io.StringIO(), None, 0
+        if no_bloco:
+            bloco.seek(0)
+            db.copiar_de("COPY importacao_bebidas FROM STDIN WITH (FORMAT csv)", bloco)
+
+        # Códigos repetidos no arquivo: vale a última ocorrência
+        db.executar("""
+            CREATE TEMP TABLE importacao_final ON COMMIT DROP AS
+            SELECT DISTINCT ON (codigo) * FROM importacao_bebidas ORDER BY codigo, linha DESC""")
+        db.executar("""
+            INSERT INTO categorias (nome, usuario_id)
+            SELECT DISTINCT categoria, %s FROM importacao_final WHERE categoria IS NOT NULL
+            ON CONFLICT (nome, usuario_id) DO NOTHING""", (usuario_id,))
+
+        # A cópia "antiga" de bebidas no FROM enxerga os valores de antes do
+        # UPDATE, o que permite registrar quem cruzou o estoque mínimo.
+        resultado['atualizadas'] = db.executar("""
+            WITH atualizadas AS (
+                UPDATE bebidas b
+                SET nome = i.nome,
+                    categoria_id = COALESCE(c.id, b.categoria_id),
+                    preco_custo = COALESCE(i.preco_custo, b.preco_custo),
+                    preco_venda = COALESCE(i.preco_venda, b.preco_venda),
+                    quantidade = COALESCE(i.quantidade, b.quantidade),
+                    quantidade_minima = COALESCE(i.quantidade_minima, b.quantidade_minima)
+                FROM importacao_final i
+                         JOIN bebidas antiga ON antiga.codigo = i.codigo AND antiga.usuario_id = %(usuario)s
+                         LEFT JOIN categorias c ON c.nome = i.categoria AND c.usuario_id = %(usuario)s
+                WHERE b.id = antiga.id
+                RETURNING b.id, b.quantidade, b.quantidade_minima,
+                          COALESCE(antiga.quantidade <= antiga.quantidade_minima
+                                   AND antiga.quantidade_minima > 0, FALSE) AS estava,
+                          COALESCE(b.quantidade <= b.quantidade_minima AND b.quantidade_minima > 0, FALSE) AS ficou
+            ), eventos AS (
+                INSERT INTO alertas_estoque (usuario_id, bebida_id, evento, quantidade, quantidade_minima)
+                SELECT %(usuario)s, id, CASE WHEN ficou THEN 'abaixo' ELSE 'normalizado' END,
+                       quantidade, quantidade_minima
+                FROM atualizadas
+                WHERE estava <> ficou
+            )
+            SELECT COUNT(*) AS total FROM atualizadas
+            """, {'usuario': usuario_id}, fetch='one')['total']
+
+        resultado['inseridas'] = db.executar("""
+            WITH inseridas AS (
+                INSERT INTO bebidas (codigo, nome, categoria_id, preco_custo, preco_venda, quantidade,
+                                     quantidade_minima, usuario_id)
+                SELECT i.codigo, i.nome, c.id, i.preco_custo, i.preco_venda, COALESCE(i.quantidade, 0),
+                       COALESCE(i.quantidade_minima, 0), %(usuario)s
+                FROM importacao_final i
+                         LEFT JOIN categorias c ON c.nome = i.categoria AND c.usuario_id = %(usuario)s
+                WHERE NOT EXISTS (SELECT 1 FROM bebidas b WHERE b.codigo = i.codigo AND b.usuario_id = %(usuario)s)
+                ON CONFLICT (codigo, usuario_id) DO NOTHING
+                RETURNING id, quantidade, quantidade_minima
+            ), eventos AS (
+                INSERT INTO alertas_estoque (usuario_id, bebida_id, evento, quantidade, quantidade_minima)
+                SELECT %(usuario)s, id, 'abaixo', quantidade, quantidade_minima
+                FROM inseridas
+                WHERE quantidade <= quantidade_minima AND quantidade_minima > 0
+            )
+            SELECT COUNT(*) AS total FROM inseridas
+            """, {'usuario': usuario_id}, fetch='one')['total']
+
+        db.registrar_auditoria(usuario_id, 'Importar Bebidas',
+                               f"Inseridas: {resultado['inseridas']}, Atualizadas: {resultado['atualizadas']}, "
+                               f"Inválidas: {resultado['invalidas']}")
+    return resultado
+
+
+def exportar_csv(db, usuario_id):
+    """
+    Gera o catálogo do usuário em CSV (bytes, em blocos), com as mesmas
+    colunas aceitas pela importação.
+    """
+    return db.copiar_para("""
+        COPY (
+            SELECT b.codigo, b.nome, c.nome AS categoria, b.preco_custo, b.preco_venda,
+                   b.quantidade, b.quantidade_minima
+            FROM bebidas b
+                     LEFT JOIN categorias c ON b.categoria_id = c.id
+            WHERE b.usuario_id = %s
+            ORDER BY b.nome, b.id
+        ) TO STDOUT WITH (FORMAT csv, HEADER)""", (usuario_id,))
@@ -0,0 +1,364 @@
+import json
+
+
+class EstoqueInsuficiente(Exception):
+    """
+    Levantada quando uma saída pediria mais unidades do que há em estoque.
+    """
+
+    def __init__(self, disponivel):
+        super().__init__(f"Estoque insuficiente para a saída. Disponível: {disponivel}")
+        self.disponivel = disponivel
+
+
+def variacao_estoque(tipo, quantidade):
+    """
+    Quanto um movimento altera `bebidas.quantidade`. Só entradas e saídas
+    mexem no saldo; ajustes e devoluções ficam apenas registrados no histórico.
+    """
+    if tipo == 'entrada':
+        return quantidade
+    if tipo == 'saida':
+        return -quantidade
+    return 0
+
+
+def em_alerta(quantidade, quantidade_minima):
+    """Mesma condição do índice parcial idx_bebidas_estoque_baixo."""
+    return quantidade_minima is not None and quantidade is not None and \
+        quantidade_minima > 0 and quantidade <= quantidade_minima
+
+
+# Advisory lock (compartilhado, com o id do usuário) de quem pode gravar em alertas_estoque
+CHAVE_ALERTAS = 7015
+
+
+def reservar_alertas(db, usuario_id):
+    """
+    Marca a transação como uma que pode gravar eventos de alerta do usuário
+    (ver eventos_alerta). Tem de ser o primeiro comando da transação, antes
+    de ela ganhar um id, em toda transação que grava em `alertas_estoque`.
+    """
+    db.executar("SELECT pg_advisory_xact_lock_shared(%s, %s)", (CHAVE_ALERTAS, usuario_id))
+
+
+def registrar_transicao(db, usuario_id, bebida_id, antes, depois):
+    """
+    Compara o par (quantidade, quantidade_minima) de antes e de depois de uma
+    alteração e, se a bebida entrou ou saiu do estoque baixo, grava o evento
+    em `alertas_estoque`. `antes` é None para bebidas novas. Deve rodar na
+    mesma transação da alteração, aberta com reservar_alertas. Devolve
+    'abaixo', 'normalizado' ou None.
+    """
+    estava = antes is not None and em_alerta(*antes)
+    ficou = em_alerta(*depois)
+    if estava == ficou:
+        return None
+    evento = 'abaixo' if ficou else 'normalizado'
+    db.executar("""
+        INSERT INTO alertas_estoque (usuario_id, bebida_id, evento, quantidade, quantidade_minima)
+        VALUES (%s, %s, %s, %s, %s)
+        """, (usuario_id, bebida_id, evento, depois[0], depois[1]))
+    return evento
+
+
+CANAL = 'pjs_estoque'
+
+
+def notificar(db, usuario_id, bebidas, evento='estoque'):
+    """
+    Avisa os painéis abertos do usuário (ver notificacoes.py) do novo saldo
+    de cada bebida: dicionários com id, quantidade e quantidade_minima, ou
+    só id com evento='excluida'. O NOTIFY é transacional: chamado dentro de
+    `db.transacao()`, só é entregue se o commit acontecer.
+    """
+    mensagens = []
+    for b in bebidas:
+        dados = {'usuario_id': usuario_id, 'evento': evento, 'id': b['id']}
+        if evento == 'estoque':
+            dados.update(quantidade=b['quantidade'], quantidade_minima=b['quantidade_minima'],
+                         alerta=em_alerta(b['quantidade'], b['quantidade_minima']))
+        mensagens.append((CANAL, json.dumps(dados, separators=(',', ':'))))
+    if len(mensagens) == 1:
+        db.executar("SELECT pg_notify(%s, %s)", mensagens[0])
+    elif mensagens:
+        db.executar_lote("SELECT pg_notify(%s, %s)", mensagens, tamanho_pagina=1000)
+
+
+SQL_ALERTAS = """
+    SELECT nome FROM bebidas
+    WHERE quantidade <= quantidade_minima AND quantidade_minima > 0 AND usuario_id = %s
+    ORDER BY nome
+"""
+
+
+def listar_alertas(db, usuario_id):
+    """Nomes das bebidas em estoque baixo, lidos pelo índice parcial."""
+    return [linha['nome'] for linha in db.executar(SQL_ALERTAS, (usuario_id,), fetch='all')]
+
+
+def ler_posicao_alerta(texto):
+    """
+    Converte a posição do fluxo de alertas ('<transacao>.<id>') no par
+    (transacao, id). Um id sozinho, como o fluxo entregava antes da
+    migração 9, vale como (0, id). Levanta ValueError se for inválida.
+    """
+    partes = [int(parte) for parte in texto.split('.')]
+    if len(partes) == 1:
+        partes.insert(0, 0)
+    if len(partes) != 2:
+        raise ValueError(texto)
+    return tuple(partes)
+
+
+def eventos_alerta(db, usuario_id, apos=(0, 0), limite=100):
+    """
+    Eventos de entrada/saída do estoque baixo depois da posição `apos`
+    (transacao, id), em ordem, cada um com a sua `posicao`.
+
+    O id vem de uma sequência, que não segue a ordem de commit: paginar só
+    por ele perderia o evento de uma transação que confirmasse depois de o
+    cliente já ter passado do seu id. Por isso cada evento guarda o id da
+    transação que o gravou e só sai quando nenhuma transação anterior a ela
+    ainda puder gravar eventos do usuário. Um evento ainda não entregue
+    sempre fica depois da última posição entregue.
+
+    Quem pode gravar é quem segura o lock de reservar_alertas do usuário; as
+    demais transações abertas (uma importação de outro usuário, uma sessão
+    no psql) não seguram o fluxo. As que terminaram depois do snapshot
+    seguram até a próxima consulta, porque não dá mais para saber se
+    gravavam. Numa réplica o pg_locks não mostra as transações do primário,
+    e o fluxo espera todas elas (o xmin do snapshot), como antes.
+    """
+    eventos = db.executar(*consulta_eventos_alerta(usuario_id, apos, limite), fetch='all')
+    return [dict(e, posicao=f"{e['transacao']}.{e['id']}") for e in eventos]
+
+
+def consulta_eventos_alerta(usuario_id, apos=(0, 0), limite=100):
+    """(sql, params) de eventos_alerta."""
+    transacao, evento_id = apos
+    # O limite sai na mesma instrução: o snapshot da leitura é o de pg_current_snapshot(),
+    # e o pg_locks, lido depois dele, mostra quem ainda está aberto
+    return """
+        WITH abertas AS (
+            SELECT t.transactionid::text::bigint AS xid, a.pid IS NOT NULL AS grava_alertas
+            FROM pg_locks t
+                     LEFT JOIN pg_locks a ON a.virtualtransaction = t.virtualtransaction AND a.locktype = 'advisory'
+                AND a.classid = %(chave)s::oid AND a.objid = %(usuario)s::oid AND a.objsubid = 2 AND a.granted
+            WHERE t.locktype = 'transactionid' AND t.mode = 'ExclusiveLock' AND t.granted
+        ), limite AS (
+            SELECT LEAST(pg_snapshot_xmax(s)::text::bigint,
+                         (SELECT MIN(x::text::bigint) FROM pg_snapshot_xip(s) x
+                          WHERE NOT EXISTS (SELECT 1 FROM abertas
+                                            WHERE xid = x::text::bigint %% 4294967296 AND NOT grava_alertas))
+                   ) AS transacao
+            FROM pg_current_snapshot() s
+        )
+        SELECT a.id, a.transacao, a.bebida_id, b.nome, a.evento, a.quantidade, a.quantidade_minima, a.data
+        FROM alertas_estoque a
+                 JOIN bebidas b ON a.bebida_id = b.id
+        WHERE a.usuario_id = %(usuario)s AND (a.transacao, a.id) > (%(transacao)s, %(id)s)
+          AND a.transacao < (SELECT transacao FROM limite)
+        ORDER BY a.transacao, a.id
+        LIMIT %(limite)s
+        """, {'chave': CHAVE_ALERTAS, 'usuario': usuario_id, 'transacao': transacao, 'id': evento_id,
+              'limite': limite}
+
+
+def movimentar(db, usuario_id, codigo, tipo, quantidade, observacao=None, fornecedor_id=None):
+    """
+    Aplica uma movimentação de estoque numa única transação: o UPDATE
+    condicional trava a linha da bebida e só passa se houver saldo, e o
+    registro em `movimentacoes` e a auditoria são gravados no mesmo commit.
+
+    Dois caixas vendendo o mesmo código ao mesmo tempo serializam no lock da
+    linha; o segundo reavalia a condição sobre o saldo já atualizado, então
+    não há atualização perdida nem venda acima do estoque. O caminho normal
+    custa quatro comandos (um é o de reservar_alertas) e um commit (meta:
+    < 5 ms no servidor local).
+
+    Devolve um dicionário com id, nome, quantidade e `transicao` (ver
+    registrar_transicao), ou None se o código não existir para o usuário.
+    Levanta EstoqueInsuficiente para saídas sem saldo.
+    """
+    delta = variacao_estoque(tipo, quantidade)
+    condicao_saldo = "AND quantidade >= %s" if tipo == 'saida' else ""
+    params = [delta, codigo, usuario_id]
+    if tipo == 'saida':
+        params.append(quantidade)
+
+    with db.transacao():
+        reservar_alertas(db, usuario_id)
+        bebida = db.executar(f"""
+            UPDATE bebidas SET quantidade = quantidade + %s
+            WHERE codigo = %s AND usuario_id = %s {condicao_saldo}
+            RETURNING id, nome, quantidade, quantidade_minima
+            """, params, fetch='one')
+        if bebida is None:
+            atual = db.executar("SELECT quantidade FROM bebidas WHERE codigo = %s AND usuario_id = %s",
+                                (codigo, usuario_id), fetch='one')
+            if atual is None:
+                return None
+            raise EstoqueInsuficiente(atual['quantidade'])
+
+        db.executar("""
+            WITH mov AS (
+                INSERT INTO movimentacoes (bebida_id, tipo, quantidade, observacao, fornecedor_id, usuario_id)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            )
+            INSERT INTO auditoria (usuario_id, acao, detalhes) VALUES (%s, %s, %s)
+            """, (
+                bebida['id'], tipo, quantidade, observacao, fornecedor_id, usuario_id,
+                usuario_id, 'Movimentação de Estoque',
+                f"Tipo: {tipo}, Bebida: '{bebida['nome']}', Qtd: {quantidade}"
+            ))
+        resultado = dict(bebida)
+        resultado['transicao'] = None
+        if delta:
+            resultado['transicao'] = registrar_transicao(
+                db, usuario_id, bebida['id'],
+                (bebida['quantidade'] - delta, bebida['quantidade_minima']),
+                (bebida['quantidade'], bebida['quantidade_minima']))
+        notificar(db, usuario_id, [bebida])
+    return resultado
+
+
+TIPOS = ('entrada', 'saida', 'devolucao_cliente', 'devolucao_fornecedor', 'ajuste')
+# Maior valor de uma coluna INTEGER (quantidades e saldos) do PostgreSQL
+MAX_INTEIRO = 2 ** 31 - 1
+MAX_OBSERVACAO = 1000
+
+
+def _ler_linha(linha):
+    """Valida uma linha do lote e devolve (codigo, tipo, quantidade, observacao, fornecedor_id)."""
+    if not isinstance(linha, dict):
+        raise ValueError("linha deve ser um objeto")
+    codigo = str(linha.get('codigo') or '').strip()
+    if not codigo:
+        raise ValueError("código vazio")
+    # O banco recusa NUL em texto, o que derrubaria o lote inteiro
+    if '\x00' in codigo:
+        raise ValueError("código inválido")
+    tipo = linha.get('tipo')
+    if tipo not in TIPOS:
+        raise ValueError(f"tipo inválido: {tipo!r}")
+    quantidade = linha.get('quantidade')
+    if isinstance(quantidade, bool) or not isinstance(quantidade, int) or quantidade <= 0:
+        raise ValueError("quantidade deve ser um inteiro positivo")
+    if quantidade > MAX_INTEIRO:
+        raise ValueError("quantidade grande demais")
+    observacao = linha.get('observacao')
+    if observacao is not None and (not isinstance(observacao, str) or '\x00' in observacao):
+        raise ValueError("observacao deve ser um texto")
+    if observacao is not None and len(observacao) > MAX_OBSERVACAO:
+        raise ValueError(f"observacao com mais de {MAX_OBSERVACAO} caracteres")
+    fornecedor_id = linha.get('fornecedor_id')
+    if fornecedor_id is not None and (isinstance(fornecedor_id, bool) or not isinstance(fornecedor_id, int)
+                                      or not 0 < fornecedor_id <= MAX_INTEIRO):
+        raise ValueError("fornecedor_id inválido")
+    return codigo, tipo, quantidade, observacao, fornecedor_id
+
+
+def movimentar_lote(db, usuario_id, linhas, tudo_ou_nada=False):
+    """
+    Aplica uma lista de movimentações (dicionários com codigo, tipo,
+    quantidade e, opcionalmente, observacao e fornecedor_id) numa transação.
+
+    Os códigos são resolvidos numa só consulta, que trava as bebidas em ordem
+    de id (assim lotes concorrentes esperam um pelo outro sem deadlock). As linhas são
+    avaliadas em ordem sobre o saldo corrente do lote, então uma entrada no
+    começo cobre uma saída mais adiante. Linhas inválidas ou sem saldo são
+    rejeitadas e as demais aplicadas; com `tudo_ou_nada`, uma rejeição
+    cancela o lote inteiro. Saldos, histórico e auditoria são gravados com
+    um comando de várias linhas cada.
+
+    Devolve {'aplicadas', 'rejeitadas', 'transicoes', 'resultados'}, com um
+    resultado por linha, na ordem recebida.
+    """
+    resultados = []
+    lidas = []
+    for i, linha in enumerate(linhas):
+        try:
+            lidas.append((i, _ler_linha(linha)))
+            resultados.append(None)
+        except ValueError as e:
+            resultados.append({'linha': i, 'ok': False, 'erro': str(e)})
+
+    with db.transacao():
+        reservar_alertas(db, usuario_id)
+        codigos = sorted({codigo for _, (codigo, *_resto) in lidas})
+        bebidas = {b['codigo']: b for b in db.executar("""
+            SELECT id, codigo, nome, quantidade, quantidade_minima FROM bebidas
+            WHERE usuario_id = %s AND codigo = ANY(%s)
+            ORDER BY id
+            FOR UPDATE
+            """, (usuario_id, codigos), fetch='all')} if codigos else {}
+        ids_fornecedores = sorted({l[4] for _, l in lidas if l[4] is not None})
+        fornecedores = {f['id'] for f in db.executar(
+            "SELECT id FROM fornecedores WHERE usuario_id = %s AND id = ANY(%s)",
+            (usuario_id, ids_fornecedores), fetch='all')} if ids_fornecedores else set()
+
+        saldo = {b['id']: b['quantidade'] for b in bebidas.values()}
+        aplicadas = []
+        for i, (codigo, tipo, quantidade, observacao, fornecedor_id) in lidas:
+            bebida = bebidas.get(codigo)
+            if bebida is None:
+                resultados[i] = {'linha': i, 'ok': False, 'erro': "Bebida com este código não encontrada."}
+                continue
+            if fornecedor_id is not None and fornecedor_id not in fornecedores:
+                resultados[i] = {'linha': i, 'ok': False, 'erro': "Fornecedor não encontrado."}
+                continue
+            if tipo == 'saida' and saldo[bebida['id']] < quantidade:
+                erro = EstoqueInsuficiente(saldo[bebida['id']])
+                resultados[i] = {'linha': i, 'ok': False, 'erro': str(erro), 'disponivel': erro.disponivel}
+                continue
+            # Várias entradas somadas podem passar do maior saldo que cabe na coluna
+            if saldo[bebida['id']] + variacao_estoque(tipo, quantidade) > MAX_INTEIRO:
+                resultados[i] = {'linha': i, 'ok': False, 'erro': "Saldo resultante grande demais."}
+                continue
+            saldo[bebida['id']] += variacao_estoque(tipo, quantidade)
+            aplicadas.append((i, bebida, tipo, quantidade, observacao, fornecedor_id))
+            resultados[i] = {'linha': i, 'ok': True, 'bebida_id': bebida['id'], 'quantidade': saldo[bebida['id']]}
+
+        rejeitadas = len(resultados) - len(aplicadas)
+        if tudo_ou_nada and rejeitadas:
+            for i, *_resto in aplicadas:
+                resultados[i] = {'linha': i, 'ok': False, 'erro': "Lote cancelado por outras linhas rejeitadas."}
+            return {'aplicadas': 0, 'rejeitadas': len(resultados), 'transicoes': 0, 'resultados': resultados}
+
+        alteradas = [b for b in bebidas.values() if saldo[b['id']] != b['quantidade']]
+        if alteradas:
+            db.executar_lote("""
+                UPDATE bebidas b SET quantidade = v.quantidade
+                FROM (VALUES %s) AS v (id, quantidade)
+                WHERE b.id = v.id
+                """, [(b['id'], saldo[b['id']]) for b in alteradas], valores=True,
+                tamanho_pagina=1000, template="(%s::integer, %s::integer)")
+        if aplicadas:
+            db.executar_lote("""
+                INSERT INTO movimentacoes (bebida_id, tipo, quantidade, observacao, fornecedor_id, usuario_id)
+                VALUES %s
+                """, [(b['id'], tipo, q, obs, forn, usuario_id) for _, b, tipo, q, obs, forn in aplicadas],
+                valores=True, tamanho_pagina=1000)
+            db.executar_lote("INSERT INTO auditoria (usuario_id, acao, detalhes) VALUES %s", [
+                (usuario_id, 'Movimentação de Estoque', f"Tipo: {tipo}, Bebida: '{b['nome']}', Qtd: {q}")
+                for _, b, tipo, q, _obs, _forn in aplicadas], valores=True, tamanho_pagina=1000)
+
+        # Só conta o saldo final de cada bebida, como se o lote fosse um movimento só
+        eventos = []
+        for b in alteradas:
+            estava = em_alerta(b['quantidade'], b['quantidade_minima'])
+            ficou = em_alerta(saldo[b['id']], b['quantidade_minima'])
+            if estava != ficou:
+                eventos.append((usuario_id, b['id'], 'abaixo' if ficou else 'normalizado',
+                                saldo[b['id']], b['quantidade_minima']))
+        if eventos:
+            db.executar_lote("""
+                INSERT INTO alertas_estoque (usuario_id, bebida_id, evento, quantidade, quantidade_minima)
+                VALUES %s
+                """, eventos, valores=True, tamanho_pagina=1000)
+        notificar(db, usuario_id, [{'id': b['id'], 'quantidade': saldo[b['id']],
+                                    'quantidade_minima': b['quantidade_minima']} for b in alteradas])
+
+    return {'aplicadas': len(aplicadas), 'rejeitadas': rejeitadas, 'transicoes': len(eventos),
+            'resultados': resultados}
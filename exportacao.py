@@ -0,0 +1,166 @@
+"""
+Exportação de consultas em CSV e XLSX, em streaming.
+
+O CSV sai direto de um COPY ... TO STDOUT (Database.copiar_para), ou, quando
+a consulta só existe na transação da requisição (lendo o arquivo morto),
+de um cursor no servidor como o XLSX. O XLSX é
+montado aqui mesmo, sem dependências: um .xlsx é um zip de arquivos XML, e
+o zipfile consegue gravar num destino que só aceita escrita, então as
+linhas lidas do cursor no servidor (Database.iterar) viram XML, são
+comprimidas e saem em blocos enquanto a consulta ainda está rodando. As
+strings vão inline em cada célula (sem a tabela de strings compartilhadas,
+que exigiria conhecer todas antes de começar).
+"""
+import datetime
+import decimal
+import io
+import re
+import zipfile
+from csv import writer as escritor_csv
+from xml.sax.saxutils import escape
+
+FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Caracteres de controle que o XML 1.0 não aceita
+INVALIDOS_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+EPOCA_EXCEL = datetime.datetime(1899, 12, 30)
+
+# Estilos das células: 0 = padrão, 1 = data, 2 = data e hora
+ESTILO_DATA, ESTILO_DATA_HORA = 1, 2
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+
+_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="{nome}" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="1"><numFmt numFmtId="164" formatCode="dd/mm/yyyy hh:mm:ss"/></numFmts>
+<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="3">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+</cellXfs>
+</styleSheet>"""
+
+
+def csv(db, sql, params=()):
+    """Blocos de bytes do resultado de `sql` em CSV com cabeçalho."""
+    return db.copiar_para(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER)", params)
+
+
+def csv_de_linhas(linhas, colunas, tamanho_bloco=65536):
+    """Blocos de bytes em CSV com cabeçalho, a partir de qualquer iterável de sequências."""
+    buffer = io.StringIO()
+    escritor = escritor_csv(buffer, lineterminator='\n')
+    escritor.writerow(colunas)
+    for valores in linhas:
+        escritor.writerow(valores)
+        if buffer.tell() >= tamanho_bloco:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def _celula(valor):
+    if valor is None:
+        return '<c/>'
+    if isinstance(valor, bool):
+        return f'<c t="b"><v>{int(valor)}</v></c>'
+    if isinstance(valor, (int, float, decimal.Decimal)):
+        return f'<c><v>{valor}</v></c>'
+    if isinstance(valor, datetime.datetime):
+        serial = (valor.replace(tzinfo=None) - EPOCA_EXCEL).total_seconds() / 86400
+        return f'<c s="{ESTILO_DATA_HORA}"><v>{serial!r}</v></c>'
+    if isinstance(valor, datetime.date):
+        return f'<c s="{ESTILO_DATA}"><v>{(valor - EPOCA_EXCEL.date()).days}</v></c>'
+    texto = escape(INVALIDOS_XML.sub('', str(valor)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+
+def _linha(valores):
+    return '<row>' + ''.join(_celula(v) for v in valores) + '</row>'
+
+
+class _Saida:
+    """Destino só de escrita para o zipfile; os blocos prontos ficam em `blocos`."""
+
+    def __init__(self):
+        self.blocos = []
+
+    def write(self, dados):
+        self.blocos.append(bytes(dados))
+        return len(dados)
+
+    def flush(self):
+        pass
+
+    def retirar(self):
+        dados = b''.join(self.blocos)
+        self.blocos.clear()
+        return dados
+
+
+def xlsx(linhas, colunas, planilha='Dados', tamanho_bloco=65536):
+    """
+    Gera um .xlsx de uma planilha em blocos de bytes. `linhas` é qualquer
+    iterável de sequências na ordem de `colunas` (o cabeçalho). Números,
+    datas e booleanos viram células tipadas; o resto, texto.
+    """
+    saida = _Saida()
+    with zipfile.ZipFile(saida, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as pacote:
+        pacote.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        pacote.writestr('_rels/.rels', _RELS)
+        pacote.writestr('xl/workbook.xml', _WORKBOOK.format(nome=escape(planilha[:31], {'"': '&quot;'})))
+        pacote.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+        pacote.writestr('xl/styles.xml', _STYLES)
+        yield saida.retirar()
+        with pacote.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as folha:
+            folha.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" '
+                        b'activePane="bottomLeft" state="frozen"/></sheetView></sheetViews><sheetData>')
+            folha.write(_linha(colunas).encode())
+            pendente = []
+            tamanho = 0
+            for valores in linhas:
+                xml = _linha(valores)
+                pendente.append(xml)
+                tamanho += len(xml)
+                if tamanho >= tamanho_bloco:
+                    folha.write(''.join(pendente).encode())
+                    pendente.clear()
+                    tamanho = 0
+                    if saida.blocos:
+                        yield saida.retirar()
+            folha.write(''.join(pendente).encode())
+            folha.write(b'</sheetData></worksheet>')
+    yield saida.retirar()
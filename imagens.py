@@ -0,0 +1,239 @@
+"""
+Armazenamento das imagens das bebidas.
+
+Cada arquivo enviado é guardado pelo SHA-256 do conteúdo, então o mesmo
+arquivo enviado duas vezes ocupa espaço uma vez só e dois "image.png"
+diferentes nunca se sobrescrevem. O upload bruto fica em `originais/`
+(fora do alcance da rota /uploads) e um pool de threads gera, fora da
+requisição, as versões servidas, todas sem metadados (EXIF, GPS...):
+
+    <hash>.<ext>        original limitado a LADO_MAXIMO px
+    <hash>.webp         o mesmo em WebP
+    <hash>-mini.jpg     miniatura quadrada da listagem
+    <hash>-mini.webp    a miniatura em WebP
+
+Sem o Pillow instalado a imagem é guardada como veio (ainda pelo hash) e
+a listagem usa o original.
+"""
+import hashlib
+import io
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+LADO_MAXIMO = 1600
+# A listagem mostra 50x50; o dobro cobre telas de alta densidade
+LADO_MINIATURA = 100
+FUNDO = (30, 30, 30)  # cor dos cards do tema, para imagens com transparência
+FORMATOS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+NOME_GERENCIADO = re.compile(r'^([0-9a-f]{64})\.(jpg|png|gif|webp)$')
+ARQUIVO_GERENCIADO = re.compile(r'^[0-9a-f]{64}(-mini)?\.(jpg|png|gif|webp)$')
+
+
+def variantes(nome):
+    """
+    Nomes dos arquivos derivados de `imagem_url`, ou None para imagens
+    antigas (gravadas pelo nome original) ou quando não há Pillow.
+    """
+    achou = NOME_GERENCIADO.match(nome or '')
+    if not achou or Image is None:
+        return None
+    digest = achou.group(1)
+    return {'original': nome, 'webp': f"{digest}.webp",
+            'mini': f"{digest}-mini.jpg", 'mini_webp': f"{digest}-mini.webp"}
+
+
+def imutavel(nome_arquivo):
+    """
+    Arquivos com nome derivado do hash nunca mudam de conteúdo: uma imagem
+    nova ganha outro nome. Podem ir para o cache do navegador para sempre.
+    """
+    return bool(ARQUIVO_GERENCIADO.match(nome_arquivo or ''))
+
+
+def _achatar(imagem):
+    # JPEG não tem transparência: o fundo vira a cor dos cards
+    if imagem.mode in ('RGBA', 'LA'):
+        fundo = Image.new('RGB', imagem.size, FUNDO)
+        fundo.paste(imagem, mask=imagem.getchannel('A'))
+        return fundo
+    return imagem.convert('RGB')
+
+
+def _escritor(dados):
+    def escrever(caminho):
+        with open(caminho, 'wb') as arquivo:
+            arquivo.write(dados)
+
+    return escrever
+
+
+def _gravar_atomico(caminho, salvar):
+    # Grava num temporário e renomeia: quem lê nunca vê um arquivo pela metade
+    temporario = f"{caminho}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        salvar(temporario)
+        os.replace(temporario, caminho)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+
+class ProcessadorImagens:
+    """
+    Guarda os uploads pelo hash e gera as variantes num ThreadPoolExecutor
+    (o Pillow libera o GIL ao decodificar e redimensionar). `garantir`
+    permite que a rota de arquivos espere, ou gere na hora, uma variante
+    pedida antes de o pool terminar.
+    """
+
+    def __init__(self, pasta, trabalhadores=2, qualidade=82):
+        self.pasta = pasta
+        self.pasta_originais = os.path.join(pasta, 'originais')
+        os.makedirs(self.pasta_originais, exist_ok=True)
+        self.trabalhadores = trabalhadores
+        self.qualidade = qualidade
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pendentes = {}
+        self._contadores = {'enviadas': 0, 'duplicadas': 0, 'processadas': 0, 'erros': 0}
+        if Image is None:
+            print("Aviso: Pillow não instalado; as imagens serão guardadas sem miniaturas.")
+
+    def _executor(self):
+        # Um processo filho herda o executor mas não as threads dele
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(max_workers=self.trabalhadores, thread_name_prefix='imagens')
+                self._pendentes = {}
+            return self._pool
+
+    def _contar(self, nome):
+        with self._lock:
+            self._contadores[nome] += 1
+
+    def salvar(self, arquivo, nome_enviado):
+        """
+        Guarda o upload (um FileStorage ou qualquer objeto com read()) e
+        devolve o nome a gravar em `bebidas.imagem_url`. Levanta ValueError
+        se o conteúdo não for uma imagem reconhecida.
+        """
+        dados = arquivo.read()
+        digest = hashlib.sha256(dados).hexdigest()
+        if Image is not None:
+            try:
+                with Image.open(io.BytesIO(dados)) as img:
+                    extensao = FORMATOS.get(img.format)
+            except Exception:
+                extensao = None
+            if extensao is None:
+                raise ValueError("Arquivo de imagem inválido ou em formato não suportado.")
+        else:
+            extensao = nome_enviado.rsplit('.', 1)[-1].lower().replace('jpeg', 'jpg')
+        nome = f"{digest}.{extensao}"
+        self._contar('enviadas')
+
+        bruto = os.path.join(self.pasta_originais, nome)
+        if os.path.exists(bruto):
+            self._contar('duplicadas')
+        else:
+            _gravar_atomico(bruto, _escritor(dados))
+        if Image is None:
+            if not os.path.exists(os.path.join(self.pasta, nome)):
+                _gravar_atomico(os.path.join(self.pasta, nome), _escritor(dados))
+        elif not self._pronta(nome):
+            self._agendar(nome)
+        return nome
+
+    def _pronta(self, nome):
+        return all(os.path.exists(os.path.join(self.pasta, v)) for v in variantes(nome).values())
+
+    def _agendar(self, nome):
+        executor = self._executor()
+        with self._lock:
+            futuro = self._pendentes.get(nome)
+            if futuro is None:
+                futuro = executor.submit(self._processar, nome)
+                self._pendentes[nome] = futuro
+                futuro.add_done_callback(lambda _f: self._pendentes.pop(nome, None))
+        return futuro
+
+    def _processar(self, nome):
+        try:
+            nomes = variantes(nome)
+            destino = lambda chave: os.path.join(self.pasta, nomes[chave])
+            with Image.open(os.path.join(self.pasta_originais, nome)) as img:
+                img.seek(0)
+                # Aplica a rotação do EXIF antes de descartá-lo
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((LADO_MAXIMO, LADO_MAXIMO))
+                # Só os pixels são copiados: EXIF, ICC de câmera e afins ficam para trás
+                limpa = Image.new(img.mode if img.mode in ('RGB', 'RGBA', 'L', 'LA') else 'RGBA', img.size)
+                limpa.paste(img.convert(limpa.mode))
+                extensao = nome.rsplit('.', 1)[1]
+                if extensao == 'jpg':
+                    salvar_original = lambda c: limpa.convert('RGB').save(c, 'JPEG', quality=self.qualidade,
+                                                                          optimize=True, progressive=True)
+                elif extensao == 'webp':
+                    salvar_original = lambda c: limpa.save(c, 'WEBP', quality=self.qualidade)
+                elif extensao == 'gif':
+                    salvar_original = lambda c: limpa.save(c, 'GIF')
+                else:
+                    salvar_original = lambda c: limpa.save(c, 'PNG', optimize=True)
+                _gravar_atomico(destino('original'), salvar_original)
+                if nomes['webp'] != nomes['original']:
+                    _gravar_atomico(destino('webp'), lambda c: limpa.save(c, 'WEBP', quality=self.qualidade))
+
+                mini = ImageOps.fit(limpa, (LADO_MINIATURA, LADO_MINIATURA), Image.LANCZOS)
+                _gravar_atomico(destino('mini_webp'), lambda c: mini.save(c, 'WEBP', quality=self.qualidade))
+                _gravar_atomico(destino('mini'), lambda c: _achatar(mini).save(c, 'JPEG', quality=self.qualidade,
+                                                                            optimize=True))
+            self._contar('processadas')
+        except Exception as e:
+            print(f"Erro ao processar a imagem '{nome}': {e}")
+            self._contar('erros')
+            raise
+
+    def garantir(self, nome_arquivo, espera=10):
+        """
+        Chamado quando um arquivo pedido a /uploads não existe: se for uma
+        variante de um original guardado, espera o processamento (ou o faz,
+        se nenhum worker deste processo estiver cuidando dele). Devolve True
+        se o arquivo passou a existir.
+        """
+        if Image is None:
+            return False
+        base = re.sub(r'-mini(\.\w+)$', r'\1', nome_arquivo)
+        digest = base.split('.', 1)[0]
+        for extensao in FORMATOS.values():
+            nome = f"{digest}.{extensao}"
+            if variantes(nome) and os.path.exists(os.path.join(self.pasta_originais, nome)) \
+                    and nome_arquivo in variantes(nome).values():
+                try:
+                    self._agendar(nome).result(timeout=espera)
+                except Exception:
+                    return False
+                return os.path.exists(os.path.join(self.pasta, nome_arquivo))
+        return False
+
+    def importar_arquivo(self, caminho):
+        """Passa um arquivo já existente (upload antigo) pelo pipeline; devolve o novo nome."""
+        with open(caminho, 'rb') as arquivo:
+            nome = self.salvar(arquivo, os.path.basename(caminho))
+        if Image is not None and not self._pronta(nome):
+            self._agendar(nome).result()
+        return nome
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._contadores)
+            stats['pendentes'] = len(self._pendentes)
+        stats['pillow'] = Image is not None
+        return stats
@@ -0,0 +1,206 @@
+"""
+Métricas das consultas ao banco, no formato texto do Prometheus.
+
+`Database` mede cada comando com `Metricas.medir` e as medidas são
+agrupadas pelo SQL normalizado (literais e parâmetros viram "?"): um
+histograma de latência, linhas e erros por consulta. Quando há uma
+requisição em andamento (ver `contexto`) as consultas também são somadas
+nela, o que dá o total por rota e denuncia N+1: a mesma consulta repetida
+muitas vezes numa única requisição.
+"""
+import re
+import threading
+import time
+
+BALDES = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+OUTRAS = 'outras'
+
+
+def normalizar(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r"%\(\w+\)s|%s|\$\d+", '?', sql)
+    sql = re.sub(r"(?<![\w.])\d+(?:\.\d+)?\b", '?', sql)
+    sql = re.sub(r"\s+", ' ', sql).strip()
+    return re.sub(r"\bIN \(\?(?:, ?\?)*\)", 'IN (...)', sql, flags=re.IGNORECASE)
+
+
+def mascarar(params):
+    """Os parâmetros com cada valor trocado pelo nome do seu tipo, para logs."""
+    if isinstance(params, dict):
+        return {chave: type(valor).__name__ for chave, valor in params.items()}
+    if isinstance(params, (list, tuple)):
+        return [type(valor).__name__ for valor in params]
+    return type(params).__name__
+
+
+class Histograma:
+    def __init__(self):
+        self.baldes = [0] * len(BALDES)
+        self.contagem = 0
+        self.soma = 0.0
+
+    def observar(self, valor):
+        self.contagem += 1
+        self.soma += valor
+        for i, limite in enumerate(BALDES):
+            if valor <= limite:
+                self.baldes[i] += 1
+                break
+
+    def amostras(self, nome, rotulos):
+        acumulado = 0
+        for limite, n in zip(BALDES, self.baldes):
+            acumulado += n
+            yield f"{nome}_bucket", {**rotulos, 'le': repr(limite)}, acumulado
+        yield f"{nome}_bucket", {**rotulos, 'le': '+Inf'}, self.contagem
+        yield f"{nome}_sum", rotulos, self.soma
+        yield f"{nome}_count", rotulos, self.contagem
+
+
+class ConsultasRequisicao:
+    """Totais das consultas de uma requisição (fica em flask.g)."""
+
+    def __init__(self, rota):
+        self.rota = rota or 'desconhecida'
+        self.total = 0
+        self.tempo = 0.0
+        self.por_consulta = {}
+
+
+class _Medida:
+    __slots__ = ('metricas', 'sql', 'params', 'inicio', 'linhas')
+
+    def __init__(self, metricas, sql, params):
+        self.metricas = metricas
+        self.sql = sql
+        self.params = params
+        self.linhas = 0
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, tb):
+        self.metricas.registrar(self.sql, time.perf_counter() - self.inicio, self.linhas, self.params,
+                                erro=tipo is not None)
+        return False
+
+
+class Metricas:
+    """
+    `limiar_lento` (segundos) manda a consulta, com parâmetros e rota, para o
+    log; `limiar_n_mais_um` é quantas execuções da mesma consulta numa só
+    requisição contam como suspeita de N+1. Para não crescer sem limite, só
+    as primeiras `max_consultas` consultas distintas ganham série própria.
+    """
+
+    def __init__(self, limiar_lento=0.5, limiar_n_mais_um=10, max_consultas=500):
+        self.limiar_lento = limiar_lento
+        self.limiar_n_mais_um = limiar_n_mais_um
+        self.max_consultas = max_consultas
+        # Devolve a ConsultasRequisicao em andamento ou None; o app troca por uma que lê flask.g
+        self.contexto = lambda: None
+        self._lock = threading.Lock()
+        self._normalizadas = {}
+        self._consultas = {}
+        self._rotas = {}
+        self._n_mais_um = {}
+
+    def medir(self, sql, params=None):
+        return _Medida(self, sql, params)
+
+    def _normalizada(self, sql):
+        normalizada = self._normalizadas.get(sql)
+        if normalizada is None:
+            normalizada = normalizar(sql)
+            if len(self._normalizadas) > 5000:
+                self._normalizadas.clear()
+            self._normalizadas[sql] = normalizada
+        return normalizada
+
+    def registrar(self, sql, duracao, linhas=0, params=None, erro=False):
+        consulta = self._normalizada(sql)
+        requisicao = self.contexto()
+        with self._lock:
+            dados = self._consultas.get(consulta)
+            if dados is None:
+                if len(self._consultas) >= self.max_consultas:
+                    consulta = OUTRAS
+                dados = self._consultas.setdefault(consulta, {
+                    'latencia': Histograma(), 'linhas': 0, 'erros': 0, 'lentas': 0})
+            dados['latencia'].observar(duracao)
+            dados['linhas'] += max(linhas or 0, 0)
+            dados['erros'] += erro
+            lenta = duracao >= self.limiar_lento
+            dados['lentas'] += lenta
+            if requisicao is not None:
+                requisicao.total += 1
+                requisicao.tempo += duracao
+                requisicao.por_consulta[consulta] = requisicao.por_consulta.get(consulta, 0) + 1
+        if lenta:
+            rota = requisicao.rota if requisicao is not None else '-'
+            # Só os tipos dos parâmetros: os valores incluem hashes de senha e dados de usuários
+            print(f"Consulta lenta ({duracao * 1000:.1f} ms, rota {rota}): {consulta} "
+                  f"params={mascarar(params)}")
+
+    def nova_requisicao(self, rota):
+        return ConsultasRequisicao(rota)
+
+    def encerrar_requisicao(self, requisicao):
+        """Soma os totais da requisição na rota e avisa das consultas repetidas demais."""
+        repetidas = [(c, n) for c, n in requisicao.por_consulta.items() if n >= self.limiar_n_mais_um]
+        with self._lock:
+            rota = self._rotas.setdefault(requisicao.rota, {'consultas': Histograma(), 'tempo': Histograma()})
+            rota['consultas'].observar(requisicao.total)
+            rota['tempo'].observar(requisicao.tempo)
+            for consulta, _n in repetidas:
+                chave = (requisicao.rota, consulta)
+                self._n_mais_um[chave] = self._n_mais_um.get(chave, 0) + 1
+        for consulta, n in repetidas:
+            print(f"Possível N+1 na rota {requisicao.rota}: {n} execuções de {consulta}")
+
+    def familias(self):
+        """Lista de (nome, tipo, ajuda, amostras) no formato de `formatar`."""
+        with self._lock:
+            latencia, linhas, erros, lentas = [], [], [], []
+            for consulta, dados in self._consultas.items():
+                rotulos = {'consulta': consulta}
+                latencia.extend(dados['latencia'].amostras('pjs_db_consulta_segundos', rotulos))
+                linhas.append(('pjs_db_linhas_total', rotulos, dados['linhas']))
+                erros.append(('pjs_db_erros_total', rotulos, dados['erros']))
+                lentas.append(('pjs_db_consultas_lentas_total', rotulos, dados['lentas']))
+            por_rota, tempo_rota = [], []
+            for rota, dados in self._rotas.items():
+                por_rota.extend(dados['consultas'].amostras('pjs_requisicao_consultas', {'rota': rota}))
+                tempo_rota.extend(dados['tempo'].amostras('pjs_requisicao_db_segundos', {'rota': rota}))
+            n_mais_um = [('pjs_db_n_mais_um_total', {'rota': rota, 'consulta': consulta}, n)
+                         for (rota, consulta), n in self._n_mais_um.items()]
+        return [
+            ('pjs_db_consulta_segundos', 'histogram', "Latência por consulta (SQL normalizado).", latencia),
+            ('pjs_db_linhas_total', 'counter', "Linhas devolvidas ou afetadas por consulta.", linhas),
+            ('pjs_db_erros_total', 'counter', "Execuções que terminaram em erro.", erros),
+            ('pjs_db_consultas_lentas_total', 'counter', "Execuções acima do limiar de consulta lenta.", lentas),
+            ('pjs_requisicao_consultas', 'histogram', "Consultas ao banco por requisição, por rota.", por_rota),
+            ('pjs_requisicao_db_segundos', 'histogram', "Tempo no banco por requisição, por rota.", tempo_rota),
+            ('pjs_db_n_mais_um_total', 'counter',
+             "Requisições em que uma mesma consulta passou do limiar de repetições.", n_mais_um),
+        ]
+
+
+def _rotulo(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatar(familias):
+    """Gera o texto do Prometheus para (nome, tipo, ajuda, [(amostra, rotulos, valor)])."""
+    linhas = []
+    for nome, tipo, ajuda, amostras in familias:
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} {tipo}")
+        for amostra, rotulos, valor in amostras:
+            if rotulos:
+                texto = ','.join(f'{chave}="{_rotulo(v)}"' for chave, v in rotulos.items())
+                linhas.append(f"{amostra}{{{texto}}} {float(valor)!r}")
+            else:
+                linhas.append(f"{amostra} {float(valor)!r}")
+    return '\n'.join(linhas) + '\n'
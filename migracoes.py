@@ -0,0 +1,304 @@
+"""
+Migrações versionadas do esquema.
+
+Cada migração é aplicada uma única vez, na sua própria transação, e
+registrada em `schema_migracoes`. Na partida do processo basta uma consulta
+para ver que não há nada pendente; se houver, cada migração roda sob um
+advisory lock, então vários workers podem subir juntos sem aplicar a
+mesma coisa duas vezes.
+
+Migrações são só acrescentadas ao fim da lista, nunca editadas depois de
+publicadas. As opcionais (que dependem de extensões que podem não existir
+no servidor) são puladas se falharem e tentadas de novo na próxima partida.
+"""
+
+# Chave do advisory lock das migrações
+CHAVE_LOCK = 7009
+
+# Versão que instala a busca por trigramas (ver busca.py)
+VERSAO_BUSCA = 3
+
+
+class Migracao:
+    def __init__(self, versao, descricao, scripts, opcional=False):
+        self.versao = versao
+        self.descricao = descricao
+        self.scripts = scripts
+        self.opcional = opcional
+
+
+MIGRACOES = [
+    Migracao(1, "Tabelas iniciais", [
+        '''CREATE TABLE IF NOT EXISTS usuarios
+        (
+            id SERIAL PRIMARY KEY,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            nivel_acesso TEXT CHECK (
+                nivel_acesso IN ('administrador', 'operador')
+            ) NOT NULL DEFAULT 'operador'
+        );''',
+        '''CREATE TABLE IF NOT EXISTS categorias
+        (
+            id SERIAL PRIMARY KEY,
+            nome TEXT NOT NULL,
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+            UNIQUE (nome, usuario_id)
+        );''',
+        '''CREATE TABLE IF NOT EXISTS fornecedores
+        (
+            id SERIAL PRIMARY KEY,
+            nome TEXT NOT NULL,
+            contato TEXT,
+            endereco TEXT,
+            cnpj TEXT,
+            email TEXT,
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+            UNIQUE (nome, usuario_id)
+        );''',
+        '''CREATE TABLE IF NOT EXISTS bebidas
+        (
+            id SERIAL PRIMARY KEY,
+            codigo TEXT,
+            nome TEXT NOT NULL,
+            categoria_id INTEGER REFERENCES categorias(id) ON DELETE SET NULL,
+            preco_custo REAL,
+            preco_venda REAL,
+            quantidade INTEGER DEFAULT 0,
+            quantidade_minima INTEGER DEFAULT 0,
+            imagem_url TEXT, -- NOVO CAMPO PARA A IMAGEM
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+            UNIQUE (codigo, usuario_id)
+        );''',
+        '''CREATE TABLE IF NOT EXISTS movimentacoes
+        (
+            id SERIAL PRIMARY KEY,
+            bebida_id INTEGER REFERENCES bebidas(id) ON DELETE CASCADE,
+            tipo TEXT CHECK (
+                                tipo IN(
+                                'entrada',
+                                'saida',
+                                'devolucao_cliente',
+                                'devolucao_fornecedor',
+                                'ajuste'
+                                       )
+            ),
+            quantidade INTEGER,
+            data TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            observacao TEXT,
+            fornecedor_id INTEGER REFERENCES fornecedores(id) ON DELETE SET NULL,
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE SET NULL
+        );''',
+        '''CREATE TABLE IF NOT EXISTS auditoria
+        (
+            id SERIAL PRIMARY KEY,
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE SET NULL,
+            acao TEXT NOT NULL,
+            data TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            detalhes TEXT
+        );'''
+    ]),
+    Migracao(2, "Vendas diárias consolidadas", [
+        '''CREATE TABLE IF NOT EXISTS vendas_diarias
+        (
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+            bebida_id INTEGER REFERENCES bebidas(id) ON DELETE CASCADE,
+            dia DATE NOT NULL,
+            quantidade BIGINT NOT NULL,
+            PRIMARY KEY (usuario_id, dia, bebida_id)
+        );''',
+        '''CREATE TABLE IF NOT EXISTS vendas_consolidacao
+        (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            consolidado_ate DATE NOT NULL
+        );'''
+    ]),
+    Migracao(VERSAO_BUSCA, "Busca por trigramas sem acentos", [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE EXTENSION IF NOT EXISTS unaccent",
+        # unaccent() é só STABLE; o invólucro IMMUTABLE permite usá-la em índices
+        """CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS
+           $func$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $func$
+           LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT""",
+        "CREATE INDEX IF NOT EXISTS idx_bebidas_nome_trgm ON bebidas USING gin (f_unaccent(lower(nome)) gin_trgm_ops)",
+        "CREATE INDEX IF NOT EXISTS idx_bebidas_codigo_trgm ON bebidas USING gin (lower(codigo) gin_trgm_ops)"
+    ], opcional=True),
+    Migracao(4, "Índices das consultas das rotas", [
+        # Listagem paginada do painel, ordenada por (nome, id) dentro de cada usuário;
+        # também atende os filtros por usuario_id em bebidas
+        'CREATE INDEX IF NOT EXISTS idx_bebidas_usuario_nome ON bebidas (usuario_id, nome, id)',
+        # Históricos paginados do mais recente para o mais antigo, e os relatórios por período
+        'CREATE INDEX IF NOT EXISTS idx_movimentacoes_usuario_data ON movimentacoes (usuario_id, data DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_auditoria_data ON auditoria (data DESC, id DESC)',
+        # Junções e ON DELETE das chaves estrangeiras
+        'CREATE INDEX IF NOT EXISTS idx_movimentacoes_bebida ON movimentacoes (bebida_id)',
+        'CREATE INDEX IF NOT EXISTS idx_movimentacoes_fornecedor ON movimentacoes (fornecedor_id)',
+        'CREATE INDEX IF NOT EXISTS idx_bebidas_categoria ON bebidas (categoria_id)',
+        'CREATE INDEX IF NOT EXISTS idx_auditoria_usuario ON auditoria (usuario_id)',
+        # Listas de categorias e fornecedores de cada usuário, já na ordem de exibição
+        'CREATE INDEX IF NOT EXISTS idx_categorias_usuario_nome ON categorias (usuario_id, nome)',
+        'CREATE INDEX IF NOT EXISTS idx_fornecedores_usuario_nome ON fornecedores (usuario_id, nome)',
+    ]),
+    Migracao(5, "Alertas de estoque baixo", [
+        # Só as bebidas em alerta entram no índice: listá-las custa o tamanho do alerta, não do catálogo
+        """CREATE INDEX IF NOT EXISTS idx_bebidas_estoque_baixo ON bebidas (usuario_id, nome)
+           WHERE quantidade <= quantidade_minima AND quantidade_minima > 0""",
+        '''CREATE TABLE IF NOT EXISTS alertas_estoque
+        (
+            id BIGSERIAL PRIMARY KEY,
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+            bebida_id INTEGER REFERENCES bebidas(id) ON DELETE CASCADE,
+            evento TEXT CHECK (evento IN ('abaixo', 'normalizado')) NOT NULL,
+            quantidade INTEGER,
+            quantidade_minima INTEGER,
+            data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );''',
+        'CREATE INDEX IF NOT EXISTS idx_alertas_estoque_usuario ON alertas_estoque (usuario_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_alertas_estoque_bebida ON alertas_estoque (bebida_id)',
+    ]),
+    Migracao(6, "Posições diárias do estoque", [
+        # Bebidas anteriores a esta migração ficam com NULL: existiam desde sempre
+        'ALTER TABLE bebidas ADD COLUMN IF NOT EXISTS criada_em TIMESTAMP',
+        'ALTER TABLE bebidas ALTER COLUMN criada_em SET DEFAULT CURRENT_TIMESTAMP',
+        '''CREATE TABLE IF NOT EXISTS posicoes_estoque
+        (
+            usuario_id INTEGER REFERENCES usuarios(id) ON DELETE CASCADE,
+            dia DATE NOT NULL,
+            bebida_id INTEGER REFERENCES bebidas(id) ON DELETE CASCADE,
+            quantidade INTEGER NOT NULL,
+            preco_custo REAL,
+            PRIMARY KEY (usuario_id, dia, bebida_id)
+        );''',
+        'CREATE INDEX IF NOT EXISTS idx_posicoes_estoque_bebida ON posicoes_estoque (bebida_id)',
+        # A foto da noite desconta as movimentações posteriores de todos os usuários de uma vez
+        'CREATE INDEX IF NOT EXISTS idx_movimentacoes_data ON movimentacoes (data)',
+    ]),
+    Migracao(7, "Arquivo morto", [
+        # Um registro por arquivo gravado por arquivamento.py; o caminho é relativo à pasta do arquivo
+        '''CREATE TABLE IF NOT EXISTS arquivamentos
+        (
+            id BIGSERIAL PRIMARY KEY,
+            tabela TEXT NOT NULL,
+            mes DATE NOT NULL,
+            arquivo TEXT NOT NULL UNIQUE,
+            linhas INTEGER NOT NULL,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );''',
+        'CREATE INDEX IF NOT EXISTS idx_arquivamentos_tabela_mes ON arquivamentos (tabela, mes)',
+        '''CREATE TABLE IF NOT EXISTS arquivamento_limites
+        (
+            tabela TEXT PRIMARY KEY,
+            arquivado_ate DATE NOT NULL
+        );''',
+    ]),
+    Migracao(8, "Versão por bebida para sincronização", [
+        # Versão = id da transação que gravou a linha por último (ver sincronizacao.py); 0 = antes desta migração
+        'ALTER TABLE bebidas ADD COLUMN IF NOT EXISTS versao BIGINT NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_bebidas_usuario_versao ON bebidas (usuario_id, versao, id)',
+        '''CREATE TABLE IF NOT EXISTS bebidas_excluidas
+        (
+            bebida_id INTEGER PRIMARY KEY,
+            usuario_id INTEGER,
+            codigo TEXT,
+            versao BIGINT NOT NULL
+        );''',
+        'CREATE INDEX IF NOT EXISTS idx_bebidas_excluidas_usuario_versao ON bebidas_excluidas (usuario_id, versao, bebida_id)',
+        """CREATE OR REPLACE FUNCTION bebidas_versionar() RETURNS trigger AS
+           $func$
+           BEGIN
+               IF TG_OP = 'DELETE' THEN
+                   INSERT INTO bebidas_excluidas (bebida_id, usuario_id, codigo, versao)
+                   VALUES (OLD.id, OLD.usuario_id, OLD.codigo, pg_current_xact_id()::text::bigint)
+                   ON CONFLICT (bebida_id) DO NOTHING;
+                   RETURN OLD;
+               END IF;
+               NEW.versao := pg_current_xact_id()::text::bigint;
+               RETURN NEW;
+           END
+           $func$ LANGUAGE plpgsql""",
+        'DROP TRIGGER IF EXISTS bebidas_versao ON bebidas',
+        """CREATE TRIGGER bebidas_versao BEFORE INSERT OR UPDATE ON bebidas
+           FOR EACH ROW EXECUTE FUNCTION bebidas_versionar()""",
+        'DROP TRIGGER IF EXISTS bebidas_exclusao ON bebidas',
+        """CREATE TRIGGER bebidas_exclusao AFTER DELETE ON bebidas
+           FOR EACH ROW EXECUTE FUNCTION bebidas_versionar()""",
+    ]),
+    Migracao(9, "Fluxo de alertas na ordem de commit", [
+        # Transação que gravou o evento (ver estoque.eventos_alerta); 0 = antes desta migração
+        'ALTER TABLE alertas_estoque ADD COLUMN IF NOT EXISTS transacao BIGINT NOT NULL DEFAULT 0',
+        'ALTER TABLE alertas_estoque ALTER COLUMN transacao SET DEFAULT pg_current_xact_id()::text::bigint',
+        'CREATE INDEX IF NOT EXISTS idx_alertas_estoque_usuario_transacao ON alertas_estoque (usuario_id, transacao, id)',
+        'DROP INDEX IF EXISTS idx_alertas_estoque_usuario',
+    ]),
+]
+
+
+def _aplicadas(db):
+    if db.executar("SELECT to_regclass('schema_migracoes') AS tabela", fetch='one')['tabela'] is None:
+        return set()
+    return {linha['versao'] for linha in db.executar("SELECT versao FROM schema_migracoes", fetch='all')}
+
+
+def aplicar(db):
+    """
+    Aplica as migrações pendentes e devolve o conjunto de versões aplicadas.
+    """
+    aplicadas = _aplicadas(db)
+    pendentes = [m for m in MIGRACOES if m.versao not in aplicadas]
+    if not pendentes:
+        return aplicadas
+
+    with db.transacao():
+        db.executar("SELECT pg_advisory_xact_lock(%s)", (CHAVE_LOCK,))
+        db.executar("""CREATE TABLE IF NOT EXISTS schema_migracoes
+                       (
+                           versao INTEGER PRIMARY KEY,
+                           descricao TEXT NOT NULL,
+                           aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                       )""")
+    for migracao in pendentes:
+        try:
+            with db.transacao():
+                db.executar("SELECT pg_advisory_xact_lock(%s)", (CHAVE_LOCK,))
+                # Outro worker pode ter aplicado enquanto esperávamos o lock
+                if db.executar("SELECT 1 FROM schema_migracoes WHERE versao = %s",
+                               (migracao.versao,), fetch='one'):
+                    aplicadas.add(migracao.versao)
+                    continue
+                for script in migracao.scripts:
+                    db.executar(script)
+                db.executar("INSERT INTO schema_migracoes (versao, descricao) VALUES (%s, %s)",
+                            (migracao.versao, migracao.descricao))
+            aplicadas.add(migracao.versao)
+            print(f"Migração {migracao.versao} aplicada: {migracao.descricao}")
+        except Exception as e:
+            if not migracao.opcional:
+                raise
+            print(f"Aviso: migração opcional {migracao.versao} ({migracao.descricao}) não aplicada. Erro: {e}")
+    return aplicadas
+
+
+def _varreduras_sequenciais(plano):
+    if plano.get('Node Type') == 'Seq Scan':
+        yield plano['Relation Name']
+    for filho in plano.get('Plans', []):
+        yield from _varreduras_sequenciais(filho)
+
+
+def verificar_indices(db, consultas):
+    """
+    Roda EXPLAIN em cada (nome, sql, params) de `consultas` (no app, as de
+    consultas_indexadas, montadas pelo código das rotas) com enable_seqscan
+    desligado: assim o planejador usa um índice sempre que existir um que
+    sirva, mesmo com tabelas pequenas, e qualquer Seq Scan que sobrar indica
+    índice faltando. Devolve [(nome, [tabelas varridas])] só com as falhas.
+    """
+    falhas = []
+    with db.transacao():
+        db.executar("SET LOCAL enable_seqscan = off")
+        for nome, query, params in consultas:
+            plano = db.executar("EXPLAIN (FORMAT JSON) " + query, params, fetch='one')[0][0]['Plan']
+            tabelas = sorted(set(_varreduras_sequenciais(plano)))
+            if tabelas:
+                falhas.append((nome, tabelas))
+    return falhas
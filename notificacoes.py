@@ -0,0 +1,139 @@
+"""
+Eventos do PostgreSQL (LISTEN/NOTIFY) repassados aos navegadores por SSE.
+
+Quem altera o estoque chama pg_notify dentro da própria transação (ver
+estoque.notificar), então o evento só sai depois do commit. Cada processo
+mantém uma única conexão em LISTEN, numa thread, e distribui as mensagens
+para as filas dos assinantes do mesmo usuário; cada aba aberta do painel é
+um assinante. A conexão de escuta é sempre com o primário: NOTIFY não
+chega às réplicas.
+
+Se a escuta cair, ou a fila de um assinante encher, os eventos do período
+se perdem; o assinante recebe então um evento 'recarregar'.
+"""
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+def formatar_sse(evento, dados):
+    """Um evento no formato text/event-stream."""
+    return f"event: {evento}\ndata: {json.dumps(dados, separators=(',', ':'))}\n\n"
+
+
+class Ouvinte:
+    def __init__(self, db_url, canal, tamanho_fila=100, espera_reconexao=1.0):
+        self.db_url = db_url
+        self.canal = canal
+        self.tamanho_fila = tamanho_fila
+        self.espera_reconexao = espera_reconexao
+        self._lock = threading.Lock()
+        self._assinantes = {}
+        self._contadores = {'recebidos': 0, 'entregues': 0, 'descartados': 0, 'reconexoes': 0}
+        self.conectado = False
+        self._pid = None
+        self._thread = None
+
+    def _iniciar(self):
+        # A thread sobe só no primeiro assinante: comandos de CLI nunca abrem a conexão de escuta
+        self._pid = os.getpid()
+        self._assinantes = {}
+        self._thread = threading.Thread(target=self._laco, name='ouvinte-notificacoes', daemon=True)
+        self._thread.start()
+
+    def assinar(self, chave):
+        """Fila que recebe (evento, dados) das notificações endereçadas a `chave`."""
+        fila = queue.Queue(maxsize=self.tamanho_fila)
+        with self._lock:
+            # Depois de um fork a thread de escuta ficou no processo pai
+            if self._pid != os.getpid():
+                self._iniciar()
+            self._assinantes.setdefault(chave, set()).add(fila)
+        return fila
+
+    def cancelar(self, chave, fila):
+        with self._lock:
+            filas = self._assinantes.get(chave)
+            if filas is not None:
+                filas.discard(fila)
+                if not filas:
+                    del self._assinantes[chave]
+
+    def _entregar(self, fila, evento, dados):
+        try:
+            fila.put_nowait((evento, dados))
+            return True
+        except queue.Full:
+            # Cliente lento: troca o acumulado por um pedido de recarga
+            with fila.mutex:
+                fila.queue.clear()
+            fila.put_nowait(('recarregar', {}))
+            return False
+
+    def _distribuir(self, payload):
+        try:
+            dados = json.loads(payload)
+            chave = dados.pop('usuario_id')
+            evento = dados.pop('evento')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            print(f"Notificação inválida no canal {self.canal}: {payload[:200]}")
+            return
+        with self._lock:
+            filas = list(self._assinantes.get(chave, ()))
+        entregues = sum(self._entregar(fila, evento, dados) for fila in filas)
+        with self._lock:
+            self._contadores['recebidos'] += 1
+            self._contadores['entregues'] += entregues
+            self._contadores['descartados'] += len(filas) - entregues
+
+    def _avisar_todos(self, evento):
+        with self._lock:
+            filas = [fila for filas in self._assinantes.values() for fila in filas]
+        for fila in filas:
+            self._entregar(fila, evento, {})
+
+    def _laco(self):
+        primeira = True
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.db_url, client_encoding='UTF8')
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.canal}")
+                self.conectado = True
+                if not primeira:
+                    # O que foi notificado enquanto a escuta estava fora se perdeu
+                    self._avisar_todos('recarregar')
+                primeira = False
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        # Nada em 30 s: confirma que a conexão continua viva
+                        with conn.cursor() as cursor:
+                            cursor.execute("SELECT 1")
+                    conn.poll()
+                    while conn.notifies:
+                        self._distribuir(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Erro na escuta do canal {self.canal}, reconectando: {e}")
+            finally:
+                self.conectado = False
+                if conn is not None and not conn.closed:
+                    conn.close()
+            with self._lock:
+                self._contadores['reconexoes'] += 1
+            time.sleep(self.espera_reconexao)
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._contadores)
+            stats['assinantes'] = sum(len(filas) for filas in self._assinantes.values())
+            stats['usuarios'] = len(self._assinantes)
+        stats['conectado'] = self.conectado
+        return stats
@@ -0,0 +1,108 @@
+import base64
+import json
+
+
+class Pagina:
+    """
+    Uma página de resultados com os tokens para a página seguinte e a
+    anterior (None quando não há para onde ir).
+    """
+
+    def __init__(self, itens, proxima=None, anterior=None):
+        self.itens = itens
+        self.proxima = proxima
+        self.anterior = anterior
+
+    def __iter__(self):
+        return iter(self.itens)
+
+    def __len__(self):
+        return len(self.itens)
+
+
+def codificar_cursor(valores):
+    bruto = json.dumps(list(valores), default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(bruto.encode()).decode().rstrip('=')
+
+
+def decodificar_cursor(token, tamanho):
+    """
+    Devolve a lista de valores do token, ou None se ele vier vazio,
+    adulterado ou com o número errado de colunas.
+    """
+    if not token:
+        return None
+    try:
+        bruto = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        valores = json.loads(bruto)
+    except ValueError:
+        return None
+    if not isinstance(valores, list) or len(valores) != tamanho:
+        return None
+    return valores
+
+
+def consulta_pagina(query, params, ordem, por_pagina, cursor=None, crescente=True):
+    """
+    (sql, params) de uma página: `query` com o filtro do cursor (a tupla de
+    `ordem` depois de `cursor`, ou antes dele se não for `crescente`), a
+    ordenação e um LIMIT de uma linha a mais, para saber se há próxima.
+    """
+    sql = query
+    params = list(params)
+    if cursor is not None:
+        colunas = ", ".join(ordem)
+        marcadores = ", ".join(["%s"] * len(ordem))
+        sql += f" AND ({colunas}) {'>' if crescente else '<'} ({marcadores})"
+        params += cursor
+    direcao = 'ASC' if crescente else 'DESC'
+    sql += " ORDER BY " + ", ".join(f"{coluna} {direcao}" for coluna in ordem) + " LIMIT %s"
+    params.append(por_pagina + 1)
+    return sql, tuple(params)
+
+
+def paginar(db, query, params, ordem, chaves, por_pagina, apos=None, antes=None, decrescente=False):
+    """
+    Paginação por chave (keyset): em vez de OFFSET, filtra pela tupla de
+    ordenação da última linha vista, então o custo de cada página não cresce
+    com a posição nem com o tamanho da tabela.
+
+    `query` é um SELECT que já termina numa cláusula WHERE (o filtro do
+    cursor entra com AND). `ordem` são as expressões SQL da ordenação, que
+    devem formar uma chave única (por exemplo b.nome, b.id), e `chaves` os
+    nomes dessas colunas nas linhas devolvidas. `apos`/`antes` são tokens
+    gerados por uma página anterior.
+    """
+    cursor = decodificar_cursor(antes, len(ordem))
+    para_tras = cursor is not None
+    if not para_tras:
+        cursor = decodificar_cursor(apos, len(ordem))
+
+    # Voltando uma página, a varredura corre no sentido inverso e o resultado é desvirado no fim
+    crescente = decrescente == para_tras
+    sql, params = consulta_pagina(query, params, ordem, por_pagina, cursor, crescente)
+
+    linhas = db.executar(sql, params, fetch='all')
+    ha_mais = len(linhas) > por_pagina
+    linhas = linhas[:por_pagina]
+    if para_tras:
+        linhas.reverse()
+    if not linhas:
+        return Pagina(linhas)
+
+    def token(linha):
+        return codificar_cursor(linha[chave] for chave in chaves)
+
+    if para_tras:
+        return Pagina(linhas, proxima=token(linhas[-1]), anterior=token(linhas[0]) if ha_mais else None)
+    return Pagina(linhas, proxima=token(linhas[-1]) if ha_mais else None,
+                  anterior=token(linhas[0]) if cursor is not None else None)
+
+
+def estimar_total(db, query, params):
+    """
+    Estimativa do número de linhas segundo o planejador (EXPLAIN), sem
+    varrer a tabela como faria um COUNT(*). Serve para mostrar "cerca de N".
+    """
+    plano = db.executar("EXPLAIN (FORMAT JSON) " + query, params, fetch='one')[0]
+    return int(plano[0]['Plan']['Plan Rows'])
@@ -0,0 +1,169 @@
+"""
+Posição do estoque em datas passadas.
+
+`posicoes_estoque` guarda, por usuário e dia, a quantidade e o custo de
+cada bebida no fim daquele dia (uma "foto", tirada todas as noites pelo
+comando fotografar-estoque). A posição numa data qualquer parte da foto
+mais próxima e aplica só as movimentações entre ela e a data: para a
+frente a partir da foto anterior ou, para bebidas que ainda não estavam
+nela, para trás a partir da foto seguinte (ou do saldo atual).
+
+Só entradas e saídas mexem no saldo (ver estoque.variacao_estoque). O que
+muda `bebidas.quantidade` sem passar pelo histórico (edição manual,
+importação de CSV) entra na próxima foto; `verificar` aponta essas
+diferenças entre o saldo atual e a última foto mais o histórico.
+"""
+import datetime
+from contextlib import nullcontext
+
+import arquivamento
+
+# Chave do advisory lock que impede duas fotos simultâneas
+CHAVE_LOCK = 7011
+
+# Mesma regra de estoque.variacao_estoque, em SQL
+VARIACAO = "CASE tipo WHEN 'entrada' THEN quantidade WHEN 'saida' THEN -quantidade ELSE 0 END"
+
+
+def fotografar(db, dia=None):
+    """
+    Grava a posição de todas as bebidas no fim de `dia` (padrão: ontem), a
+    partir do saldo atual menos as movimentações posteriores. Refazer a foto
+    de um dia a substitui. Se outra foto já estiver sendo tirada, não faz
+    nada. Devolve o número de linhas gravadas.
+    """
+    with db.transacao():
+        if not db.executar("SELECT pg_try_advisory_xact_lock(%s) AS ok", (CHAVE_LOCK,), fetch='one')['ok']:
+            return 0
+        hoje = db.executar("SELECT CURRENT_DATE AS hoje", fetch='one')['hoje']
+        dia = dia or hoje - datetime.timedelta(days=1)
+        if dia >= hoje:
+            raise ValueError("Só dá para fotografar dias já encerrados.")
+        return db.executar(*consulta_foto(dia))
+
+
+def consulta_foto(dia):
+    """(sql, params) do upsert da foto de todas as bebidas no fim de `dia`."""
+    return f"""
+            INSERT INTO posicoes_estoque (usuario_id, dia, bebida_id, quantidade, preco_custo)
+            SELECT b.usuario_id, %(dia)s, b.id, b.quantidade - COALESCE(m.variacao, 0), b.preco_custo
+            FROM bebidas b
+                     LEFT JOIN (SELECT bebida_id, SUM({VARIACAO}) AS variacao
+                                FROM movimentacoes
+                                WHERE data >= %(dia)s::date + 1
+                                GROUP BY bebida_id) m ON m.bebida_id = b.id
+            WHERE b.usuario_id IS NOT NULL AND (b.criada_em IS NULL OR b.criada_em < %(dia)s::date + 1)
+            ON CONFLICT (usuario_id, dia, bebida_id) DO UPDATE
+                SET quantidade = EXCLUDED.quantidade, preco_custo = EXCLUDED.preco_custo
+            """, {'dia': dia}
+
+
+def podar(db, manter_dias):
+    """
+    Apaga as fotos com mais de `manter_dias` dias, menos as de fim de mês.
+    Devolve o número de linhas apagadas.
+    """
+    return db.executar("""
+        DELETE FROM posicoes_estoque
+        WHERE dia < CURRENT_DATE - %s::integer
+          AND dia <> (date_trunc('month', dia) + INTERVAL '1 month - 1 day')::date
+        """, (manter_dias,))
+
+
+def posicao(db, usuario_id, dia, pasta_arquivo=None):
+    """
+    Devolve (itens, valor_total) no fim de `dia`: itens com bebida_id,
+    codigo, nome, quantidade, preco_custo e valor (quantidade * preco_custo,
+    com o custo da foto usada), em ordem de nome. Com `pasta_arquivo`, as
+    movimentações já arquivadas do intervalo também entram na conta.
+    """
+    fotos = db.executar(SQL_FOTOS, {'usuario': usuario_id, 'dia': dia}, fetch='one')
+    inicio = (fotos['anterior'] or dia) + datetime.timedelta(days=1)
+    if pasta_arquivo is None:
+        fonte = nullcontext('movimentacoes')
+    else:
+        # Sem foto depois, o período vai até hoje: o arquivo nunca tem nada mais novo que isso
+        fonte = arquivamento.fonte(db, 'movimentacoes', pasta_arquivo, inicio,
+                                   fotos['posterior'] or datetime.date.today(), usuario_id)
+    with fonte as movimentacoes:
+        itens = db.executar(*consulta_posicao(usuario_id, dia, fotos, movimentacoes), fetch='all')
+    itens = [dict(item, valor=item['quantidade'] * (item['preco_custo'] or 0)) for item in itens]
+    return itens, sum(item['valor'] for item in itens)
+
+
+SQL_FOTOS = """
+    SELECT (SELECT MAX(dia) FROM posicoes_estoque WHERE usuario_id = %(usuario)s AND dia <= %(dia)s) AS anterior,
+           (SELECT MIN(dia) FROM posicoes_estoque WHERE usuario_id = %(usuario)s AND dia > %(dia)s) AS posterior
+"""
+
+
+def consulta_posicao(usuario_id, dia, fotos, movimentacoes='movimentacoes'):
+    """
+    (sql, params) da posição no fim de `dia` entre as fotos `anterior` e
+    `posterior` de `fotos` (o resultado de SQL_FOTOS), lendo as
+    movimentações de `movimentacoes`.
+    """
+    params = {'usuario': usuario_id, 'dia': dia, 'anterior': fotos['anterior'], 'posterior': fotos['posterior']}
+    # Sem foto depois da data, o ponto de partida para trás é o saldo atual
+    if fotos['posterior'] is None:
+        posterior = "SELECT id AS bebida_id, quantidade, preco_custo FROM bebidas WHERE usuario_id = %(usuario)s"
+    else:
+        posterior = """SELECT bebida_id, quantidade, preco_custo FROM posicoes_estoque
+                       WHERE usuario_id = %(usuario)s AND dia = %(posterior)s"""
+    return f"""
+        WITH anterior AS (
+            SELECT bebida_id, quantidade, preco_custo FROM posicoes_estoque
+            WHERE usuario_id = %(usuario)s AND dia = %(anterior)s
+        ), posterior AS ({posterior}),
+        variacoes AS (
+            SELECT bebida_id,
+                   SUM({VARIACAO}) FILTER (WHERE data < %(dia)s::date + 1) AS antes,
+                   SUM({VARIACAO}) FILTER (WHERE data >= %(dia)s::date + 1) AS depois
+            FROM {movimentacoes} m
+            WHERE usuario_id = %(usuario)s
+              AND data >= COALESCE(%(anterior)s::date, %(dia)s::date) + 1
+              AND (%(posterior)s::date IS NULL OR data < %(posterior)s::date + 1)
+            GROUP BY bebida_id
+        )
+        SELECT b.id AS bebida_id, b.codigo, b.nome,
+               CASE WHEN a.bebida_id IS NOT NULL THEN a.quantidade + COALESCE(v.antes, 0)
+                    ELSE p.quantidade - COALESCE(v.depois, 0) END AS quantidade,
+               COALESCE(a.preco_custo, p.preco_custo) AS preco_custo
+        FROM bebidas b
+                 LEFT JOIN anterior a ON a.bebida_id = b.id
+                 LEFT JOIN posterior p ON p.bebida_id = b.id
+                 LEFT JOIN variacoes v ON v.bebida_id = b.id
+        WHERE b.usuario_id = %(usuario)s
+          AND (a.bebida_id IS NOT NULL
+               OR (p.bebida_id IS NOT NULL AND (b.criada_em IS NULL OR b.criada_em < %(dia)s::date + 1)))
+        ORDER BY b.nome, b.id
+        """, params
+
+
+def verificar(db, usuario_id=None):
+    """
+    Compara o saldo atual de cada bebida com a última foto do usuário mais as
+    movimentações desde então. Devolve as divergências (usuario_id,
+    bebida_id, nome, dia, esperado, atual); bebidas criadas depois da foto
+    ficam de fora.
+    """
+    return db.executar(f"""
+        WITH ultima AS (
+            SELECT usuario_id, MAX(dia) AS dia FROM posicoes_estoque
+            WHERE %(usuario)s::integer IS NULL OR usuario_id = %(usuario)s
+            GROUP BY usuario_id
+        ), variacoes AS (
+            SELECT m.bebida_id, SUM({VARIACAO}) AS variacao
+            FROM movimentacoes m
+                     JOIN ultima u ON m.usuario_id = u.usuario_id AND m.data >= u.dia + 1
+            GROUP BY m.bebida_id
+        )
+        SELECT b.usuario_id, b.id AS bebida_id, b.nome, u.dia,
+               f.quantidade + COALESCE(v.variacao, 0) AS esperado, b.quantidade AS atual
+        FROM ultima u
+                 JOIN posicoes_estoque f ON f.usuario_id = u.usuario_id AND f.dia = u.dia
+                 JOIN bebidas b ON b.id = f.bebida_id
+                 LEFT JOIN variacoes v ON v.bebida_id = b.id
+        WHERE b.quantidade IS DISTINCT FROM f.quantidade + COALESCE(v.variacao, 0)
+        ORDER BY b.usuario_id, b.nome, b.id
+        """, {'usuario': usuario_id}, fetch='all')
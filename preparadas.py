@@ -0,0 +1,173 @@
+"""
+Instruções preparadas no servidor para as consultas mais repetidas.
+
+Com DB_PREPARAR=1, `Database.executar` troca o texto SQL por PREPARE/EXECUTE
+depois que a mesma consulta aparece DB_PREPARAR_APOS vezes. O PostgreSQL
+então analisa a consulta uma vez por conexão e, quando o plano genérico
+compensa, deixa também de replanejá-la a cada chamada.
+
+Cada conexão (ConexaoPreparada) guarda suas instruções num LRU limitado; a
+que sai do LRU recebe DEALLOCATE. Como o cache mora na própria conexão,
+uma reconexão começa do zero e conexões diferentes do pool nunca
+confundem os nomes. PREPARE não é transacional: um ROLLBACK não desfaz a
+instrução, então o cache continua válido depois de erros.
+"""
+import json
+import re
+import threading
+from collections import OrderedDict
+
+import psycopg2
+import psycopg2.extensions
+
+PLACEHOLDER = re.compile(r"%%|%s|%\((\w+)\)s")
+PREPARAVEIS = ('select', 'insert', 'update', 'delete', 'with', 'values')
+
+
+class ConexaoPreparada(psycopg2.extensions.connection):
+    """Conexão que lembra das instruções preparadas nela: SQL -> nome, em ordem de uso."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = OrderedDict()
+        self.proximo_nome = 0
+
+
+def converter(query):
+    """
+    Reescreve os placeholders do psycopg2 (%s ou %(nome)s) como $1, $2...
+    Devolve (sql, chaves): `chaves` diz, em ordem, que índice ou nome dos
+    params vai em cada $n. None se a consulta misturar os dois estilos.
+    """
+    chaves = []
+    posicoes = {}
+
+    def trocar(achou):
+        if achou.group(0) == '%%':
+            return '%'
+        nome = achou.group(1)
+        if nome is None:
+            chaves.append(len(chaves))
+            return f"${len(chaves)}"
+        if nome not in posicoes:
+            chaves.append(nome)
+            posicoes[nome] = len(chaves)
+        return f"${posicoes[nome]}"
+
+    sql = PLACEHOLDER.sub(trocar, query)
+    if len({type(c) for c in chaves}) > 1:
+        return None
+    return sql, chaves
+
+
+class Preparador:
+    def __init__(self, max_por_conexao=100, usar_apos=2):
+        self.max_por_conexao = max_por_conexao
+        self.usar_apos = usar_apos
+        self._lock = threading.Lock()
+        self._vistas = {}
+        self._convertidas = {}
+        self._recusadas = set()
+        # Tempo de planejamento medido (EXPLAIN SUMMARY) na primeira preparação de cada
+        # consulta. A economia é uma estimativa por cima: cada reuso conta um
+        # planejamento, mas enquanto o servidor preferir planos customizados ele replaneja.
+        self._planejamento = {}
+        self._contadores = {'preparadas': 0, 'reutilizadas': 0, 'desalocadas': 0, 'recusadas': 0,
+                            'planejamento_economizado_ms': 0.0}
+
+    def _contar(self, nome, n=1):
+        with self._lock:
+            self._contadores[nome] += n
+
+    def _candidata(self, query):
+        if query in self._recusadas:
+            return None
+        with self._lock:
+            if len(self._vistas) > 10000:
+                self._vistas.clear()
+            vistas = self._vistas[query] = self._vistas.get(query, 0) + 1
+        if vistas < self.usar_apos:
+            return None
+        convertida = self._convertidas.get(query)
+        if convertida is None:
+            if not query.lstrip().lower().startswith(PREPARAVEIS):
+                convertida = False
+            else:
+                convertida = converter(query) or False
+            self._convertidas[query] = convertida
+        return convertida or None
+
+    def _preparar(self, conn, cursor, query, sql, params):
+        nome = f"pjs_{conn.proximo_nome}"
+        conn.proximo_nome += 1
+        # Num SAVEPOINT para que um PREPARE recusado (tipo de parâmetro que
+        # o servidor não consegue deduzir, por exemplo) não aborte a transação
+        cursor.execute("SAVEPOINT pjs_preparar")
+        try:
+            if query not in self._planejamento:
+                cursor.execute("EXPLAIN (SUMMARY, FORMAT JSON) " + query, params)
+                plano = cursor.fetchone()[0]
+                plano = json.loads(plano) if isinstance(plano, str) else plano
+                self._planejamento[query] = plano[0].get('Planning Time', 0.0)
+            cursor.execute(f"PREPARE {nome} AS {sql}")
+            cursor.execute("RELEASE SAVEPOINT pjs_preparar")
+        except psycopg2.Error as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT pjs_preparar")
+            cursor.execute("RELEASE SAVEPOINT pjs_preparar")
+            print(f"Consulta não será preparada: {str(e).strip()}")
+            self._recusadas.add(query)
+            self._contar('recusadas')
+            return None
+        conn.preparadas[query] = nome
+        self._contar('preparadas')
+        while len(conn.preparadas) > self.max_por_conexao:
+            _sql, antigo = conn.preparadas.popitem(last=False)
+            cursor.execute(f"DEALLOCATE {antigo}")
+            self._contar('desalocadas')
+        return nome
+
+    def executar(self, conn, cursor, query, params):
+        """
+        Executa `query` via EXECUTE se ela já é (ou acabou de virar) uma
+        instrução preparada nesta conexão. Devolve False quando a consulta
+        deve seguir pelo caminho normal, sem ter executado nada.
+        """
+        if not isinstance(conn, ConexaoPreparada):
+            return False
+        candidata = self._candidata(query)
+        if candidata is None:
+            return False
+        sql, chaves = candidata
+        if chaves and not params:
+            return False
+        valores = [params[c] for c in chaves]
+
+        nome = conn.preparadas.get(query)
+        if nome is None:
+            nome = self._preparar(conn, cursor, query, sql, params)
+            if nome is None:
+                return False
+        else:
+            conn.preparadas.move_to_end(query)
+            with self._lock:
+                self._contadores['reutilizadas'] += 1
+                self._contadores['planejamento_economizado_ms'] += self._planejamento.get(query, 0.0)
+
+        argumentos = f" ({', '.join(['%s'] * len(valores))})" if valores else ""
+        try:
+            cursor.execute(f"EXECUTE {nome}{argumentos}", valores)
+        except psycopg2.Error as e:
+            # Ex.: "cached plan must not change result type" depois de um ALTER TABLE.
+            # Esquece a instrução; a próxima chamada prepara de novo com outro nome.
+            if e.pgcode == '0A000':
+                conn.preparadas.pop(query, None)
+            raise
+        return True
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._contadores)
+        stats['planejamento_economizado_ms'] = round(stats['planejamento_economizado_ms'], 3)
+        stats['consultas_medidas'] = len(self._planejamento)
+        stats['max_por_conexao'] = self.max_por_conexao
+        return stats
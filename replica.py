@@ -0,0 +1,124 @@
+"""
+Leituras numa réplica do PostgreSQL (DATABASE_REPLICA_URL).
+
+`Database.executar` manda para a réplica as consultas só de leitura feitas
+fora de transação; escritas, transações e SELECT ... FOR UPDATE continuam
+no primário. A cada DB_REPLICA_INTERVALO segundos o atraso da réplica é
+medido (LSN reproduzido contra o LSN atual do primário); acima de
+DB_REPLICA_ATRASO_MAX segundos, ou com a réplica fora do ar, tudo volta
+para o primário até a próxima verificação.
+
+Para uma sessão enxergar o que acabou de gravar, o app guarda o LSN do
+primário depois de cada escrita e lê do primário até a réplica alcançá-lo.
+"""
+import re
+import threading
+import time
+
+import psycopg2
+
+# Comandos e funções que escrevem ou travam: nunca vão para a réplica
+ESCRITA = re.compile(
+    r"\b(insert|update|delete|merge|for\s+(no\s+key\s+)?update|for\s+(key\s+)?share|nextval|setval"
+    r"|pg_(try_)?advisory\w*|pg_notify|set_config|analyze)\b", re.IGNORECASE)
+
+
+COPY_SAIDA = re.compile(r"\s*copy\b.*\bto\s+stdout\b", re.IGNORECASE | re.DOTALL)
+
+
+def somente_leitura(query):
+    inicio = query.lstrip()[:7].lower()
+    leitura = inicio.startswith(('select', 'with', 'explain')) or COPY_SAIDA.match(query) is not None
+    return leitura and not ESCRITA.search(query)
+
+
+def lsn_para_int(lsn):
+    """'16/B374D848' -> posição no WAL em bytes."""
+    alto, baixo = lsn.split('/')
+    return (int(alto, 16) << 32) + int(baixo, 16)
+
+
+class Replica:
+    def __init__(self, pool, lsn_primario, atraso_max=5.0, intervalo=1.0):
+        self.pool = pool
+        # Função que devolve o LSN atual do primário (texto)
+        self._lsn_primario = lsn_primario
+        self.atraso_max = atraso_max
+        self.intervalo = intervalo
+        self._lock = threading.Lock()
+        self._verificando = threading.Lock()
+        self._verificada_em = float('-inf')
+        self.disponivel_agora = False
+        self.lsn_reproduzido = 0
+        self.atraso = None
+        self._contadores = {'leituras': 0, 'desvios_primario': 0, 'falhas': 0}
+
+    def contar(self, nome):
+        with self._lock:
+            self._contadores[nome] += 1
+
+    def disponivel(self):
+        """Estado da última verificação, refeita quando passa `intervalo`."""
+        if time.monotonic() - self._verificada_em >= self.intervalo:
+            # Só uma thread verifica; as outras seguem com o estado anterior
+            if self._verificando.acquire(blocking=False):
+                try:
+                    self._verificar()
+                finally:
+                    self._verificando.release()
+        return self.disponivel_agora
+
+    def _verificar(self):
+        self._verificada_em = time.monotonic()
+        try:
+            primario = lsn_para_int(self._lsn_primario())
+            conn = self.pool.obter()
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn()::text,
+                               EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                        """)
+                    em_recuperacao, reproduzido, desde_ultima = cursor.fetchone()
+                conn.rollback()
+            finally:
+                self.pool.devolver(conn)
+        except Exception as e:
+            if self.disponivel_agora:
+                print(f"Réplica indisponível, lendo do primário: {e}")
+            self.disponivel_agora = False
+            self.atraso = None
+            return
+        if not em_recuperacao or reproduzido is None:
+            if self.disponivel_agora or self.atraso is None:
+                print("Aviso: DATABASE_REPLICA_URL não aponta para uma réplica em recuperação; ignorando.")
+            self.disponivel_agora = False
+            self.atraso = None
+            return
+        self.lsn_reproduzido = lsn_para_int(reproduzido)
+        # Em dia com o primário, o tempo desde a última transação reproduzida não é atraso
+        self.atraso = 0.0 if self.lsn_reproduzido >= primario else float(desde_ultima or 0.0)
+        disponivel = self.atraso <= self.atraso_max
+        if disponivel != self.disponivel_agora:
+            print(f"Réplica {'disponível' if disponivel else 'atrasada'} (atraso: {self.atraso:.1f}s).")
+        self.disponivel_agora = disponivel
+
+    def alcancou(self, lsn):
+        """A réplica já reproduziu o WAL até `lsn` (texto de pg_current_wal_lsn)?"""
+        return self.disponivel() and self.lsn_reproduzido >= lsn_para_int(lsn)
+
+    def falhou(self, erro):
+        # Conexão perdida no meio de uma leitura: volta ao primário até a próxima verificação
+        self.contar('falhas')
+        if isinstance(erro, (psycopg2.OperationalError, psycopg2.InterfaceError)) or \
+                not isinstance(erro, psycopg2.Error):
+            self.disponivel_agora = False
+
+    def estatisticas(self):
+        with self._lock:
+            stats = dict(self._contadores)
+        stats['disponivel'] = self.disponivel_agora
+        stats['atraso'] = self.atraso
+        stats['atraso_max'] = self.atraso_max
+        stats['pool'] = self.pool.estatisticas()
+        return stats
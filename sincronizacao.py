@@ -0,0 +1,120 @@
+"""
+Consulta de bebidas por código e sincronização do catálogo, para leitores
+de código de barras e caixas que mantêm uma cópia local.
+
+Cada bebida tem uma `versao`: o id da transação que a gravou por último,
+posto por trigger (migração 8) em qualquer INSERT ou UPDATE, venha de onde
+vier. Exclusões deixam um registro em `bebidas_excluidas` com a versão da
+transação que excluiu.
+
+Ids de transação não saem na ordem de commit: uma transação antiga pode
+confirmar depois de uma mais nova. Por isso a marca devolvida a quem
+sincroniza é o xmin do snapshot da própria consulta (a transação mais
+antiga ainda em andamento): tudo abaixo dele já terminou e foi visto. A
+próxima sincronização pede `versao >= marca` e pode receber de novo
+algumas linhas, nunca perder uma.
+"""
+
+CAMPOS = """
+    b.id, b.codigo, b.nome, c.nome AS categoria, b.preco_custo, b.preco_venda,
+    b.quantidade, b.quantidade_minima, b.imagem_url, b.versao
+"""
+
+LIMITE_ALTERACOES = 1000
+
+
+SQL_POR_CODIGO = f"""
+    SELECT {CAMPOS}
+    FROM bebidas b LEFT JOIN categorias c ON c.id = b.categoria_id
+    WHERE b.codigo = %s AND b.usuario_id = %s
+"""
+
+SQL_POR_ID = f"""
+    SELECT {CAMPOS}
+    FROM bebidas b LEFT JOIN categorias c ON c.id = b.categoria_id
+    WHERE b.id = %s AND b.usuario_id = %s
+"""
+
+SQL_POR_CODIGOS = f"""
+    SELECT {CAMPOS}
+    FROM bebidas b LEFT JOIN categorias c ON c.id = b.categoria_id
+    WHERE b.usuario_id = %s AND b.codigo = ANY(%s)
+"""
+
+
+def por_codigo(db, usuario_id, codigo):
+    return db.executar(SQL_POR_CODIGO, (codigo, usuario_id), fetch='one')
+
+
+def por_id(db, usuario_id, bebida_id):
+    return db.executar(SQL_POR_ID, (bebida_id, usuario_id), fetch='one')
+
+
+def por_codigos(db, usuario_id, codigos):
+    """
+    Consulta vários códigos de uma vez. `codigos` é uma lista ou um
+    dicionário código -> versão que o cliente já tem; os códigos cuja versão
+    não mudou voltam só em `inalteradas`. Devolve (bebidas, inalteradas,
+    nao_encontrados).
+    """
+    conhecidas = codigos if isinstance(codigos, dict) else {}
+    linhas = db.executar(SQL_POR_CODIGOS, (usuario_id, list(codigos)), fetch='all')
+    encontrados = {linha['codigo'] for linha in linhas}
+    bebidas, inalteradas = [], []
+    for linha in linhas:
+        if conhecidas.get(linha['codigo']) == linha['versao']:
+            inalteradas.append(linha['codigo'])
+        else:
+            bebidas.append(dict(linha))
+    return bebidas, inalteradas, [c for c in codigos if c not in encontrados]
+
+
+def alteracoes(db, usuario_id, desde=0, continuacao=None, limite=LIMITE_ALTERACOES):
+    """
+    Bebidas alteradas ou excluídas com versão >= `desde`, em ordem de
+    (versao, id), no máximo `limite` por chamada. Devolve (bebidas,
+    excluidas, marca, proxima): `excluidas` são ids; `proxima` é a
+    `continuacao` a passar para a página seguinte, ou None se esta foi a
+    última; `marca` é o `desde` da próxima sincronização.
+    """
+    # A marca é a da primeira página: o que confirmar durante a paginação com versão
+    # abaixo da posição atual fica acima dela e volta na próxima sincronização
+    marca, versao, bebida_id = continuacao if continuacao is not None else (None, desde, 0)
+    linhas = db.executar(*consulta_alteracoes(usuario_id, versao, bebida_id, limite + 1), fetch='all')
+    marca = linhas[0]['marca'] if marca is None else min(marca, linhas[0]['marca'])
+    linhas = [linha for linha in linhas if linha['alterada'] is not None]
+    proxima = None
+    if len(linhas) > limite:
+        linhas = linhas[:limite]
+        proxima = (marca, linhas[-1]['versao_alterada'], linhas[-1]['alterada'])
+    bebidas = [{chave: linha[chave] for chave in linha.keys()
+                if chave not in ('marca', 'excluida', 'alterada', 'versao_alterada')}
+               for linha in linhas if not linha['excluida']]
+    excluidas = [linha['alterada'] for linha in linhas if linha['excluida']]
+    return bebidas, excluidas, marca, proxima
+
+
+def consulta_alteracoes(usuario_id, versao, bebida_id, limite):
+    """(sql, params) das até `limite` alterações depois de (versao, bebida_id), com a marca."""
+    params = {'usuario': usuario_id, 'versao': versao, 'id': bebida_id, 'limite': limite}
+    # Marca e linhas na mesma instrução: o mesmo snapshot, no mesmo servidor (primário ou réplica)
+    return f"""
+        WITH alteradas AS (
+            (SELECT id, versao, FALSE AS excluida FROM bebidas
+             WHERE usuario_id = %(usuario)s AND (versao, id) > (%(versao)s, %(id)s)
+             ORDER BY versao, id LIMIT %(limite)s)
+            UNION ALL
+            (SELECT bebida_id, versao, TRUE FROM bebidas_excluidas
+             WHERE usuario_id = %(usuario)s AND (versao, bebida_id) > (%(versao)s, %(id)s)
+             ORDER BY versao, bebida_id LIMIT %(limite)s)
+            ORDER BY versao, id
+            LIMIT %(limite)s
+        )
+        SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS marca,
+               a.excluida, a.id AS alterada, a.versao AS versao_alterada, {CAMPOS}
+        FROM (SELECT 1) um
+                 LEFT JOIN alteradas a ON TRUE
+                 LEFT JOIN bebidas b ON b.id = a.id AND NOT a.excluida
+                 LEFT JOIN categorias c ON c.id = b.categoria_id
+        ORDER BY a.versao, a.id
+        """, params
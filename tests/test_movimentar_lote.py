@@ -0,0 +1,60 @@
+"""
+Linhas inválidas de /api/movimentacoes/lote voltam como erro da linha, sem
+derrubar o lote. Roda contra o PostgreSQL de DATABASE_URL (um banco de
+teste: o app aplica as migrações ao importar).
+"""
+import os
+import unittest
+import uuid
+
+if not os.getenv('DATABASE_URL'):
+    raise unittest.SkipTest("DATABASE_URL não definida")
+
+import estoque  # noqa: E402
+from app import app, db  # noqa: E402
+
+
+class MovimentarLoteTest(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.username = f"teste_lote_{uuid.uuid4().hex[:8]}"
+        usuario = db.executar("INSERT INTO usuarios (username, password_hash) VALUES (%s, 'x') RETURNING id",
+                              (self.username,), fetch='one')
+        self.usuario_id = usuario['id']
+        db.executar("INSERT INTO bebidas (codigo, nome, quantidade, usuario_id) VALUES ('L1', 'Lote', 10, %s)",
+                    (self.usuario_id,))
+        self.cliente = app.test_client()
+        with self.cliente.session_transaction() as sessao:
+            sessao['usuario_id'] = self.usuario_id
+            sessao['username'] = self.username
+            sessao['nivel_acesso'] = 'operador'
+
+    def tearDown(self):
+        db.executar("DELETE FROM usuarios WHERE id = %s", (self.usuario_id,))
+
+    def lote(self, linhas):
+        return self.cliente.post('/api/movimentacoes/lote', json={'linhas': linhas})
+
+    def test_linhas_fora_dos_limites_sao_rejeitadas_por_linha(self):
+        grande = estoque.MAX_INTEIRO - 20
+        r = self.lote([
+            {'codigo': 'L1', 'tipo': 'entrada', 'quantidade': 2 ** 40},
+            {'codigo': 'L1', 'tipo': 'entrada', 'quantidade': 1, 'observacao': {'a': 1}},
+            {'codigo': 'L1', 'tipo': 'entrada', 'quantidade': 1, 'observacao': 'x' * (estoque.MAX_OBSERVACAO + 1)},
+            {'codigo': 'L1', 'tipo': 'entrada', 'quantidade': 1, 'observacao': 'a\x00b'},
+            {'codigo': 'L\x001', 'tipo': 'entrada', 'quantidade': 1},
+            {'codigo': 'L1', 'tipo': 'entrada', 'quantidade': 1, 'fornecedor_id': 2 ** 40},
+            {'codigo': 'L1', 'tipo': 'entrada', 'quantidade': grande},
+            {'codigo': 'L1', 'tipo': 'entrada', 'quantidade': grande},
+            {'codigo': 'L1', 'tipo': 'saida', 'quantidade': 3, 'observacao': 'ok'},
+        ])
+        self.assertEqual(r.status_code, 200, r.data)
+        resultados = r.get_json()['resultados']
+        self.assertEqual([res['ok'] for res in resultados], [False] * 6 + [True, False, True])
+        self.assertEqual(r.get_json()['aplicadas'], 2)
+        saldo = db.executar("SELECT quantidade FROM bebidas WHERE usuario_id = %s", (self.usuario_id,), fetch='one')
+        self.assertEqual(saldo['quantidade'], 10 + grande - 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""
+Consolidação diária das vendas (movimentações do tipo 'saida').
+
+`vendas_diarias` guarda, por usuário, bebida e dia, o total vendido nos
+dias já fechados; `vendas_consolidacao.consolidado_ate` marca o primeiro dia
+ainda não consolidado. Os relatórios leem a tabela consolidada até essa
+marca e só varrem `movimentacoes` a partir dela (em geral, o dia corrente).
+
+A consolidação roda fora das requisições, pelo comando `flask
+consolidar-vendas` (agendado para logo depois da meia-noite). Sem ela os
+relatórios continuam certos, só varrem mais linhas brutas.
+"""
+import datetime
+
+# Chave do advisory lock que impede duas consolidações simultâneas
+CHAVE_LOCK = 7007
+DIAS_POR_ETAPA = 31
+# Dias já consolidados que cada execução refaz: uma venda com data de ontem cuja
+# transação confirmou depois da consolidação de ontem entra na seguinte
+DIAS_REVISADOS = 2
+
+
+def consolidado_ate(db):
+    linha = db.executar("SELECT consolidado_ate FROM vendas_consolidacao", fetch='one')
+    return linha['consolidado_ate'] if linha else None
+
+
+def consolidar(db, dias_revisados=DIAS_REVISADOS):
+    """
+    Refaz os últimos `dias_revisados` dias consolidados e leva a consolidação
+    até ontem, em etapas de até DIAS_POR_ETAPA dias, cada uma na sua
+    transação e com upsert, então refazer um dia só corrige os totais. Se
+    outra consolidação já estiver rodando, não faz nada. Devolve o número de
+    linhas (bebida x dia) gravadas.
+    """
+    gravadas = 0
+    inicio = consolidado_ate(db)
+    if inicio is not None:
+        inicio -= datetime.timedelta(days=dias_revisados)
+    while True:
+        with db.transacao():
+            if not db.executar("SELECT pg_try_advisory_xact_lock(%s) AS ok", (CHAVE_LOCK,), fetch='one')['ok']:
+                return gravadas
+            hoje = db.executar("SELECT CURRENT_DATE AS hoje", fetch='one')['hoje']
+            if inicio is None:
+                primeira = db.executar("SELECT MIN(data)::date AS dia FROM movimentacoes", fetch='one')['dia']
+                inicio = min(primeira or hoje, hoje)
+            if inicio >= hoje:
+                return gravadas
+            fim = min(inicio + datetime.timedelta(days=DIAS_POR_ETAPA), hoje)
+            gravadas += db.executar(*consulta_consolidacao(inicio, fim))
+            db.executar("""
+                INSERT INTO vendas_consolidacao (id, consolidado_ate) VALUES (TRUE, %s)
+                ON CONFLICT (id) DO UPDATE SET consolidado_ate = GREATEST(vendas_consolidacao.consolidado_ate,
+                                                                          EXCLUDED.consolidado_ate)
+                """, (fim,))
+            inicio = fim
+
+
+def consulta_consolidacao(inicio, fim):
+    """(sql, params) do upsert das vendas dos dias [inicio, fim) em vendas_diarias."""
+    return """
+        INSERT INTO vendas_diarias (usuario_id, bebida_id, dia, quantidade)
+        SELECT usuario_id, bebida_id, data::date, SUM(quantidade)
+        FROM movimentacoes
+        WHERE tipo = 'saida' AND usuario_id IS NOT NULL
+          AND data >= %s AND data < %s
+        GROUP BY usuario_id, bebida_id, data::date
+        ON CONFLICT (usuario_id, dia, bebida_id) DO UPDATE SET quantidade = EXCLUDED.quantidade
+        """, (inicio, fim)
+
+
+def _vendas_no_periodo():
+    # Dias fechados vêm da tabela consolidada; do corte em diante, do histórico bruto
+    return """
+        WITH vendas AS (
+            SELECT bebida_id, quantidade
+            FROM vendas_diarias
+            WHERE usuario_id = %(usuario)s AND dia >= %(inicio)s AND dia <= %(fim)s AND dia < %(corte)s
+            UNION ALL
+            SELECT bebida_id, quantidade
+            FROM movimentacoes
+            WHERE tipo = 'saida' AND usuario_id = %(usuario)s
+              AND data >= GREATEST(%(inicio)s::date, %(corte)s::date) AND data < %(fim)s::date + 1
+        )
+    """
+
+
+def _parametros(db, usuario_id, data_inicio, data_fim):
+    return {
+        'usuario': usuario_id,
+        'inicio': data_inicio,
+        'fim': data_fim,
+        'corte': consolidado_ate(db) or datetime.date.min,
+    }
+
+
+def relatorio(db, usuario_id, data_inicio, data_fim):
+    """
+    Devolve (mais_vendidos, valor_total) para o intervalo de dias
+    [data_inicio, data_fim], ambos inclusivos. A receita usa o preço de venda
+    atual de cada bebida, como sempre fez o relatório.
+    """
+    params = _parametros(db, usuario_id, data_inicio, data_fim)
+    mais_vendidos = db.executar(_vendas_no_periodo() + """
+        SELECT p.nome, SUM(v.quantidade) as total_vendido
+        FROM vendas v
+                 JOIN bebidas p ON v.bebida_id = p.id
+        GROUP BY p.nome
+        ORDER BY total_vendido DESC
+        """, params, fetch='all')
+    valor_total = db.executar(_vendas_no_periodo() + """
+        SELECT SUM(v.quantidade * p.preco_venda) as total
+        FROM vendas v
+                 JOIN bebidas p ON v.bebida_id = p.id
+        """, params, fetch='one')
+    return mais_vendidos, valor_total
+
+
+COLUNAS_EXPORTACAO = ['codigo', 'bebida', 'total_vendido', 'preco_venda', 'receita']
+
+
+def consulta_exportacao(db, usuario_id, data_inicio, data_fim):
+    """
+    (sql, params) do relatório do período por bebida, uma linha por bebida
+    com as colunas de COLUNAS_EXPORTACAO, para exportar em CSV ou XLSX.
+    """
+    return _vendas_no_periodo() + """
+        SELECT p.codigo, p.nome AS bebida, SUM(v.quantidade) AS total_vendido, p.preco_venda,
+               ROUND(SUM(v.quantidade * p.preco_venda)::numeric, 2) AS receita
+        FROM vendas v
+                 JOIN bebidas p ON v.bebida_id = p.id
+        GROUP BY p.id
+        ORDER BY total_vendido DESC, p.nome
+        """, _parametros(db, usuario_id, data_inicio, data_fim)
+
+
+def verificar(db, usuario_id=None):
+    """
+    Compara a tabela consolidada com o histórico bruto nos dias já fechados e
+    devolve as divergências (usuario_id, bebida_id, dia, consolidado, historico).
+    Os dias cujas movimentações já foram arquivadas (ver arquivamento.py)
+    ficam de fora: só a consolidação ainda os tem.
+    """
+    corte = consolidado_ate(db)
+    if corte is None:
+        return []
+    arquivado = db.executar("SELECT arquivado_ate FROM arquivamento_limites WHERE tabela = 'movimentacoes'",
+                            fetch='one')
+    return db.executar("""
+        SELECT usuario_id, bebida_id, dia, c.quantidade AS consolidado, h.quantidade AS historico
+        FROM (SELECT usuario_id, bebida_id, dia, quantidade
+              FROM vendas_diarias
+              WHERE dia < %(corte)s AND dia >= %(arquivado)s
+                AND (%(usuario)s IS NULL OR usuario_id = %(usuario)s)) c
+        FULL JOIN (SELECT usuario_id, bebida_id, data::date AS dia, SUM(quantidade) AS quantidade
+                   FROM movimentacoes
+                   WHERE tipo = 'saida' AND usuario_id IS NOT NULL AND data < %(corte)s AND data >= %(arquivado)s
+                     AND (%(usuario)s IS NULL OR usuario_id = %(usuario)s)
+                   GROUP BY usuario_id, bebida_id, data::date) h
+            USING (usuario_id, bebida_id, dia)
+        WHERE c.quantidade IS DISTINCT FROM h.quantidade
+        ORDER BY dia, usuario_id, bebida_id
+        """, {'corte': corte, 'usuario': usuario_id,
+              'arquivado': arquivado['arquivado_ate'] if arquivado else datetime.date.min}, fetch='all')